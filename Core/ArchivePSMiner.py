@@ -15,9 +15,11 @@ from Core.PSMetric.Atomicity import Atomicity
 from Core.PSMetric.LocalPerturbation import BivariateLocalPerturbation
 from Core.PSMetric.MeanFitness import MeanFitness
 from Core.PSMetric.Metric import Metric
+from Core.PSMetric.MetricCache import MetricCache, CachedMetric
 from Core.PSMetric.Simplicity import Simplicity
 from Core.SearchSpace import SearchSpace
 from Core.TerminationCriteria import TerminationCriteria, PSEvaluationLimit, IterationLimit
+from Core.custom_types import ArrayOfFloats
 from Core.get_init import just_empty
 from Core.get_local import specialisations
 from Core.selection import truncation_selection
@@ -47,6 +49,7 @@ class ArchivePSMiner(AbstractPSMiner):
     archive: set[EvaluatedPS]  # the archive, which will contain all the selected PSs
 
     used_evaluations: int  # counts how many F_\psi evaluations have happened
+    scoring_metrics: list[Metric]  # the metrics, wrapped in CachedMetric when a MetricCache is used
 
     def __init__(self,
                  pRef: PRef,
@@ -54,14 +57,29 @@ class ArchivePSMiner(AbstractPSMiner):
                  get_init: GetInitType,
                  get_local: GetLocalType,
                  population_size: int,
-                 selection: SelectionType):
+                 selection: SelectionType,
+                 use_observation_cache: bool = True,
+                 metric_cache: Optional[MetricCache] = None):
         super().__init__(pRef)
         self.used_evaluations = 0
 
         self.pRef = pRef
         self.metrics = metrics
 
-        for metric in self.metrics:
+        # the metrics are still used directly in with_aggregated_scores, where their types matter
+        if metric_cache is None:
+            self.scoring_metrics = self.metrics
+        else:
+            self.scoring_metrics = [CachedMetric(metric, metric_cache) for metric in self.metrics]
+
+        # the children are specialisations of the parents, whose observations will be in the cache.
+        # This needs to happen before set_pRef, so that the PRefs derived by the metrics share the cache.
+        # The cache is attached to a view of the PRef, so that it is released with the miner
+        if use_observation_cache and self.pRef.observation_cache is None:
+            self.pRef = self.pRef.get_view()
+            self.pRef.enable_observation_cache()
+
+        for metric in self.scoring_metrics:
             metric.set_pRef(self.pRef)
 
         self.get_init = get_init
@@ -135,10 +153,19 @@ class ArchivePSMiner(AbstractPSMiner):
         :param newborns: the individuals to be evaluated
         :return: the same individuals as the input, but now .metric_scores will be valid
         """
-        for individual in newborns:
-            if individual.metric_scores is None:  # avoid recalculating if already valid
-                individual.metric_scores = [metric.get_single_score(individual) for metric in self.metrics]
-                self.used_evaluations += 1
+        # avoid recalculating if already valid
+        to_evaluate = list({id(individual): individual
+                            for individual in newborns
+                            if individual.metric_scores is None}.values())
+        if len(to_evaluate) == 0:
+            return newborns
+
+        # each metric is called once for all of the individuals
+        ps_matrix = np.array([individual.values for individual in to_evaluate])
+        score_matrix = np.column_stack([metric.get_scores_batch(ps_matrix) for metric in self.scoring_metrics])
+        for individual, scores in zip(to_evaluate, score_matrix):
+            individual.metric_scores = list(scores)
+        self.used_evaluations += len(to_evaluate)
         return newborns
 
     def get_used_evaluations(self) -> int:
@@ -171,6 +198,59 @@ class ArchivePSMiner(AbstractPSMiner):
         evaluated_archive = self.with_aggregated_scores(list(self.archive))
         return self.top(n=amount, population=evaluated_archive)
 
+    def get_aggregated_standard_errors(self, population: Population) -> ArrayOfFloats:
+        """
+        The standard errors of the aggregated scores (as in with_aggregated_scores, over the same population),
+        from the standard errors of the metrics, which are assumed to be independent.
+        The metrics which can't estimate the error of a PS (eg they don't implement get_standard_errors_batch)
+        are left out of its aggregated error, which is only nan when none of the metrics can estimate it
+        """
+        ps_matrix = np.array([ind.values for ind in population])
+        metric_matrix = np.array([ind.metric_scores for ind in population])
+        error_matrix = np.column_stack([metric.get_standard_errors_batch(ps_matrix) for metric in self.metrics])
+        for column in range(metric_matrix.shape[1]):
+            if not isinstance(self.metrics[column], MeanFitness):
+                score_range = np.ptp(metric_matrix[:, column])
+                error_matrix[:, column] = error_matrix[:, column] / score_range if score_range > 0 else 0
+
+        aggregated_errors = np.sqrt(np.nansum(np.square(error_matrix), axis=1)) / error_matrix.shape[1]
+        aggregated_errors[np.all(np.isnan(error_matrix), axis=1)] = np.nan
+        return aggregated_errors
+
+    def get_results_rescored_on(self, full_pRef: PRef, amount: int, z_score: float = 2.0) -> list[EvaluatedPS]:
+        """
+        For when the miner ran on a sketch of full_pRef (see PRef.sketch), so the scores of the archive are estimates.
+        The PSs which could be in the top amount (ie their score + z_score standard errors reaches the amount-th best
+        score - z_score standard errors) are re-scored on full_pRef, and the best amount of those are returned.
+        The PSs whose errors are unknown (see get_aggregated_standard_errors) always pass.
+        The re-scoring uses new instances of the metrics, so the miner and its metrics are not changed.
+        """
+        evaluated_archive = self.with_aggregated_scores(list(self.archive))
+        if len(evaluated_archive) <= amount:
+            survivors = evaluated_archive
+        else:
+            scores = np.array([ind.aggregated_score for ind in evaluated_archive])
+            errors = self.get_aggregated_standard_errors(evaluated_archive)
+            unknown = np.isnan(errors)
+            lower_bounds = np.where(unknown, -np.inf, scores - z_score * errors)
+            upper_bounds = np.where(unknown, np.inf, scores + z_score * errors)
+            threshold = np.sort(lower_bounds)[-amount]
+            survivors = [ind for ind, upper_bound in zip(evaluated_archive, upper_bounds)
+                         if upper_bound >= threshold]
+
+        full_metrics = [metric.get_fresh_copy() for metric in self.metrics]
+        if self.scoring_metrics is not self.metrics:  # the MetricCache is shared, since it is keyed on the PRef
+            full_metrics = [CachedMetric(metric, scoring_metric.cache)
+                            for metric, scoring_metric in zip(full_metrics, self.scoring_metrics)]
+        for metric in full_metrics:
+            metric.set_pRef(full_pRef)
+
+        ps_matrix = np.array([ind.values for ind in survivors])
+        score_matrix = np.column_stack([metric.get_scores_batch(ps_matrix) for metric in full_metrics])
+        rescored = [EvaluatedPS(ind.values, metric_scores=list(scores))
+                    for ind, scores in zip(survivors, score_matrix)]
+        return self.top(n=amount, population=self.with_aggregated_scores(rescored))
+
     @staticmethod
     def top(n: int, population: Population) -> Population:
         """ Same as in the paper, very straightforward"""
@@ -181,12 +261,12 @@ class ArchivePSMiner(AbstractPSMiner):
         return list(set(population))
 
     @classmethod
-    def with_default_settings(cls, pRef: PRef):
+    def with_default_settings(cls, pRef: PRef, metric_cache: Optional[MetricCache] = None):
         """ atomicity can be measured in many many ways, and the paper suggest an approach that I've improved over time"""
         """The function defined in the paper uses Atomicity(), but you should also try:
             - Linkage(): faster
             - BivariateLocalPerturbation(): much more accurate, but sloooow
-            - BivariateANOVALinkage(): slow but more mathematically sound
+            - BivariateANOVALinkage(): more mathematically sound
             
         """
         return cls(population_size=300,
@@ -194,7 +274,8 @@ class ArchivePSMiner(AbstractPSMiner):
                    metrics=[Simplicity(), MeanFitness(), Atomicity()],
                    get_init=just_empty,
                    get_local=specialisations,
-                   selection=truncation_selection)
+                   selection=truncation_selection,
+                   metric_cache=metric_cache)
 
 
 
@@ -0,0 +1,100 @@
+"""
+A bitmap index over the full solution matrix of a PRef.
+
+For every (variable, value) pair we store a packed bit-vector with one bit per row of the PRef,
+so the observations of a PS can be obtained by AND-ing the bit-vectors of its fixed values,
+instead of repeatedly filtering the (much larger) solution matrix.
+"""
+from typing import Optional
+
+import numpy as np
+
+from Core.PS import STAR
+from Core.SearchSpace import SearchSpace
+from Core.custom_types import ArrayOfInts, ArrayOfBools
+
+# how many bits are set in each possible byte, used to count the rows without unpacking the bitmaps
+POPCOUNT_TABLE = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+
+class BitmapIndex:
+    bitmaps: np.ndarray  # one row per (var, val), ordered as in the hot encoding, each row is a packed bit-vector
+    offsets: ArrayOfInts  # where the bitmaps for each variable start, ie search_space.precomputed_offsets
+    all_rows: np.ndarray  # the bitmap for the empty PS
+    sample_size: int
+    amount_of_words: int
+
+    def __init__(self, full_solution_matrix: np.ndarray, search_space: SearchSpace):
+        self.sample_size = full_solution_matrix.shape[0]
+        self.offsets = search_space.precomputed_offsets
+
+        # the bitmaps are stored as uint64 words so that the ANDs process 64 rows at a time
+        self.amount_of_words = (self.sample_size + 63) // 64
+        self.bitmaps = np.zeros((search_space.hot_encoded_length, self.amount_of_words), dtype=np.uint64)
+        for var, cardinality in enumerate(search_space.cardinalities):
+            column = full_solution_matrix[:, var]
+            for val in range(cardinality):
+                self.bitmaps[self.offsets[var] + val] = self.pack(column == val)
+
+        self.all_rows = self.pack(np.full(shape=self.sample_size, fill_value=True, dtype=bool))
+
+    def pack(self, mask: ArrayOfBools) -> np.ndarray:
+        packed_bytes = np.packbits(mask)
+        padded = np.zeros(shape=self.amount_of_words * 8, dtype=np.uint8)
+        padded[:len(packed_bytes)] = packed_bytes
+        return padded.view(np.uint64)
+
+    def unpack(self, packed: np.ndarray) -> ArrayOfBools:
+        return np.unpackbits(packed.view(np.uint8), count=self.sample_size).view(bool)
+
+    def get_packed_mask(self, ps_values: ArrayOfInts) -> np.ndarray:
+        """ANDs the bitmaps of the fixed values of the PS. Note that the result is a new array"""
+        fixed_vars = np.flatnonzero(ps_values != STAR)
+        if len(fixed_vars) == 0:
+            return self.all_rows.copy()
+
+        which_bitmaps = self.offsets[fixed_vars] + ps_values[fixed_vars]
+        result = self.bitmaps[which_bitmaps[0]].copy()
+        for which_bitmap in which_bitmaps[1:]:
+            np.bitwise_and(result, self.bitmaps[which_bitmap], out=result)
+        return result
+
+    def get_mask(self, ps_values: ArrayOfInts) -> ArrayOfBools:
+        """returns a boolean array, where the rows matching the PS are True"""
+        return self.unpack(self.get_packed_mask(ps_values))
+
+    @staticmethod
+    def row_ids_of_packed(packed: np.ndarray) -> ArrayOfInts:
+        """the (increasing) rows whose bits are set, where only the words which are not 0 are unpacked"""
+        nonzero_words = np.flatnonzero(packed)
+        bits = np.unpackbits(packed[nonzero_words].view(np.uint8)).reshape((-1, 64))
+        which_words, which_bits = np.nonzero(bits)
+        return nonzero_words[which_words] * 64 + which_bits
+
+    def get_row_ids(self, ps_values: ArrayOfInts) -> ArrayOfInts:
+        """returns the indices of the rows matching the PS, without unpacking the whole bitmap"""
+        return self.row_ids_of_packed(self.get_packed_mask(ps_values))
+
+    @staticmethod
+    def count_of_packed(packed: np.ndarray) -> int:
+        return int(np.sum(POPCOUNT_TABLE[packed.view(np.uint8)], dtype=int))
+
+    def count(self, ps_values: ArrayOfInts) -> int:
+        """the amount of observations of the PS, calculated without unpacking the bitmaps"""
+        return self.count_of_packed(self.get_packed_mask(ps_values))
+
+    def get_stats(self,
+                  ps_values: ArrayOfInts,
+                  fitness_array: np.ndarray,
+                  row_weights: Optional[np.ndarray]) -> (float, float, float):
+        """
+        The amount of observations of the PS (the sum of row_weights, if given), and the sums of their fitnesses
+        and squared fitnesses. The count is a popcount, and the sums only visit the matching rows
+        """
+        packed = self.get_packed_mask(ps_values)
+        rows = self.row_ids_of_packed(packed)
+        fitnesses = fitness_array[rows]
+        if row_weights is None:
+            return float(self.count_of_packed(packed)), float(np.sum(fitnesses)), float(np.sum(np.square(fitnesses)))
+        weights = row_weights[rows]
+        return float(np.sum(weights)), float(np.sum(weights * fitnesses)), float(np.sum(weights * np.square(fitnesses)))
@@ -32,7 +32,7 @@ class Explainer:
         self.benchmark_problem = benchmark_problem
         self.ps_catalog = ps_catalog
         self.pRef = pRef
-        self.overall_average = np.average(self.pRef.fitness_array)
+        self.overall_average = self.pRef.mean_fitness()
 
         self.mean_fitness_metric = MeanFitness()
         self.statistically_high_fitness_metric = SignificantlyHighAverage()
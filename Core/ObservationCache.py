@@ -0,0 +1,112 @@
+"""
+A cache for the rows of a PRef which match a PS, meant for the miners which work by specialisation.
+
+When a PS is a specialisation of a cached PS (ie it has one more fixed variable),
+its rows are obtained by filtering only the rows of the cached parent on the new variable,
+rather than the whole PRef. The cache has a bounded size, measured in cached row ids, and uses LRU eviction.
+"""
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import numpy as np
+
+from Core.PS import STAR
+from Core.custom_types import ArrayOfInts
+
+
+class ObservationCache:
+    full_solution_matrix: np.ndarray
+    max_cached_rows: int  # the sum of the lengths of the cached row id arrays
+    max_entries: int
+
+    cached_rows: OrderedDict[bytes, ArrayOfInts]  # the keys are the bytes of the values of the PS
+    total_cached_rows: int
+
+    hits: int
+    derived_hits: int  # when the rows were obtained from the rows of a cached parent
+    misses: int
+
+    def __init__(self, full_solution_matrix: np.ndarray, max_cached_rows: int = 2 ** 24, max_entries: int = 100000):
+        self.full_solution_matrix = full_solution_matrix
+        self.max_cached_rows = max_cached_rows
+        self.max_entries = max_entries
+        self.cached_rows = OrderedDict()
+        self.total_cached_rows = 0
+        self.hits = 0
+        self.derived_hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return (f"ObservationCache({len(self.cached_rows)} entries, {self.total_cached_rows} rows, "
+                f"hits = {self.hits}, derived hits = {self.derived_hits}, misses = {self.misses})")
+
+    def get_statistics(self) -> dict:
+        total_queries = self.hits + self.derived_hits + self.misses
+        return {"hits": self.hits,
+                "derived_hits": self.derived_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.derived_hits) / total_queries if total_queries > 0 else 0.0,
+                "entries": len(self.cached_rows),
+                "cached_rows": self.total_cached_rows}
+
+    @staticmethod
+    def key_of(ps_values: ArrayOfInts) -> bytes:
+        return np.asarray(ps_values, dtype=np.int64).tobytes()
+
+    def get_rows_from_cached_parent(self, ps_values: ArrayOfInts) -> Optional[ArrayOfInts]:
+        """if one of the simplifications of the PS is cached, the smallest one is used to derive the rows"""
+        best_parent_rows = None
+        best_var = None
+        parent_values = np.asarray(ps_values, dtype=np.int64).copy()
+        for var in np.flatnonzero(parent_values != STAR):
+            original_value = parent_values[var]
+            parent_values[var] = STAR
+            parent_rows = self.cached_rows.get(self.key_of(parent_values))
+            parent_values[var] = original_value
+            if parent_rows is not None and (best_parent_rows is None or len(parent_rows) < len(best_parent_rows)):
+                best_parent_rows = parent_rows
+                best_var = var
+
+        if best_parent_rows is None:
+            return None
+        column = self.full_solution_matrix[:, best_var]
+        return best_parent_rows[column[best_parent_rows] == int(ps_values[best_var])]
+
+    def get_rows(self, ps_values: ArrayOfInts, calculate_rows: Callable[[ArrayOfInts], np.ndarray]) -> ArrayOfInts:
+        """
+        :param ps_values: the values of the PS
+        :param calculate_rows: used when neither the PS nor its simplifications are cached,
+                               it can return either a boolean mask or row ids
+        :return: the row ids of the observations of the PS
+        """
+        key = self.key_of(ps_values)
+        rows = self.cached_rows.get(key)
+        if rows is not None:
+            self.hits += 1
+            self.cached_rows.move_to_end(key)
+            return rows
+
+        rows = self.get_rows_from_cached_parent(ps_values)
+        if rows is not None:
+            self.derived_hits += 1
+        else:
+            self.misses += 1
+            rows = calculate_rows(ps_values)
+            if rows.dtype == bool:
+                rows = np.flatnonzero(rows)
+
+        self.register(key, rows)
+        return rows
+
+    def register(self, key: bytes, rows: ArrayOfInts):
+        rows.setflags(write=False)  # the same array is returned to every caller
+        self.cached_rows[key] = rows
+        self.total_cached_rows += len(rows)
+        while len(self.cached_rows) > 1 and (self.total_cached_rows > self.max_cached_rows
+                                            or len(self.cached_rows) > self.max_entries):
+            _, evicted_rows = self.cached_rows.popitem(last=False)
+            self.total_cached_rows -= len(evicted_rows)
+
+    def clear(self):
+        self.cached_rows.clear()
+        self.total_cached_rows = 0
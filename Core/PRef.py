@@ -1,75 +1,320 @@
+import hashlib
+import json
 import os
-from typing import Iterable, Callable, Any
+from typing import Iterable, Callable, Any, Optional, Literal
 
 import numba
 import numpy as np
 from matplotlib import pyplot as plt
-from numba import jit
 
 import utils
+from Core.BitmapIndex import BitmapIndex
 from Core.EvaluatedFS import EvaluatedFS
 from Core.FullSolution import FullSolution
+from Core.ObservationCache import ObservationCache
 from Core.PS import STAR, PS
+from Core.PRefMarginals import PRefMarginals
+from Core.PrecomputationStore import PrecomputationStore
+from Core.QueryPlanner import QueryPlanner
 from Core.SearchSpace import SearchSpace
-from Core.custom_types import ArrayOfFloats, Fitness
+from Core.custom_types import ArrayOfFloats, ArrayOfInts, Fitness
+
+
+ROW_BLOCK_SIZE = 4096  # the rows are split in blocks of this size, which are processed in parallel
+NUMBA_MATCHING_THRESHOLD = 2 ** 12  # PRefs with at least this many rows are filtered using the numba kernels (see benchmark_matching_kernel_by_order)
+
+# Once a parallel kernel has run, the process has the live threads of numba's threading layer, and forking it
+# can deadlock (eg multiprocessing with the default "fork" start method, or parallel evaluation in DEAP or pymoo).
+# Either use the "spawn" or "forkserver" start method, or set Core.PRef.USE_PARALLEL_KERNELS = False before any query,
+# so that only the serial kernels are used. Both settings are read at each query, so they can be overridden
+USE_PARALLEL_KERNELS = True
+
+
+@numba.njit(inline="always")
+def row_matches(fs_matrix, row, fixed_vars, fixed_vals) -> bool:
+    for index in range(len(fixed_vars)):
+        if fs_matrix[row, fixed_vars[index]] != fixed_vals[index]:
+            return False  # most rows are discarded on the first mismatch
+    return True
+
+
+@numba.njit(parallel=True, cache=True, nogil=True)
+def get_matching_mask(fs_matrix, fixed_vars, fixed_vals) -> np.ndarray:
+    """the boolean mask of the rows of fs_matrix which have fixed_vals in the columns fixed_vars"""
+    amount_of_rows = fs_matrix.shape[0]
+    mask = np.empty(amount_of_rows, dtype=np.bool_)
+    for block in numba.prange((amount_of_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE):
+        for row in range(block * ROW_BLOCK_SIZE, min((block + 1) * ROW_BLOCK_SIZE, amount_of_rows)):
+            mask[row] = row_matches(fs_matrix, row, fixed_vars, fixed_vals)
+    return mask
+
+
+@numba.njit(parallel=True, cache=True, nogil=True)
+def get_matching_row_ids(fs_matrix, fixed_vars, fixed_vals) -> np.ndarray:
+    """the same as get_matching_mask, but returns the (increasing) indices of the matching rows"""
+    amount_of_rows = fs_matrix.shape[0]
+    amount_of_blocks = (amount_of_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    mask = np.empty(amount_of_rows, dtype=np.bool_)
+    matches_per_block = np.zeros(amount_of_blocks + 1, dtype=np.int64)
+    for block in numba.prange(amount_of_blocks):
+        amount_of_matches = 0
+        for row in range(block * ROW_BLOCK_SIZE, min((block + 1) * ROW_BLOCK_SIZE, amount_of_rows)):
+            mask[row] = row_matches(fs_matrix, row, fixed_vars, fixed_vals)
+            amount_of_matches += mask[row]
+        matches_per_block[block + 1] = amount_of_matches
+
+    block_starts = np.cumsum(matches_per_block)
+    row_ids = np.empty(block_starts[amount_of_blocks], dtype=np.int64)
+    for block in numba.prange(amount_of_blocks):
+        position = block_starts[block]
+        for row in range(block * ROW_BLOCK_SIZE, min((block + 1) * ROW_BLOCK_SIZE, amount_of_rows)):
+            if mask[row]:
+                row_ids[position] = row
+                position += 1
+    return row_ids
+
+
+@numba.njit(parallel=True, cache=True, nogil=True)
+def get_matching_stats(fs_matrix, fs_fitnesses, fs_weights, fixed_vars, fixed_vals) -> (float, float, float):
+    """The amount of matching rows (as in get_matching_mask), and the sum of their fitnesses and squared fitnesses.
+    When fs_weights is not None, each row counts as fs_weights[row] observations"""
+    amount_of_rows = fs_matrix.shape[0]
+    amount_of_blocks = (amount_of_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    counts = np.zeros(amount_of_blocks, dtype=np.float64)
+    sums = np.zeros(amount_of_blocks, dtype=np.float64)
+    sums_of_squares = np.zeros(amount_of_blocks, dtype=np.float64)
+    for block in numba.prange(amount_of_blocks):
+        for row in range(block * ROW_BLOCK_SIZE, min((block + 1) * ROW_BLOCK_SIZE, amount_of_rows)):
+            if row_matches(fs_matrix, row, fixed_vars, fixed_vals):
+                fitness = fs_fitnesses[row]
+                weight = 1.0 if fs_weights is None else fs_weights[row]
+                counts[block] += weight
+                sums[block] += weight * fitness
+                sums_of_squares[block] += weight * fitness * fitness
+    return np.sum(counts), np.sum(sums), np.sum(sums_of_squares)
+
+
+def get_fitnesses_by_boolean_filtering(fs_matrix, fs_fitnesses, ps_values) -> ArrayOfFloats:
+    """The numpy version of get_matching_row_ids, which is faster for small PRefs since it has no overhead"""
+    remaining_rows = fs_matrix
+    remaining_fitnesses = fs_fitnesses
+
+    for variable_index, variable_value in enumerate(ps_values):
+        if variable_value != STAR:
+            # int(), so that the comparison happens in the dtype of the matrix instead of upcasting the column
+            which_to_keep = remaining_rows[:, variable_index] == int(variable_value)
+
+            # update the current filtered results
+            remaining_rows = remaining_rows[which_to_keep]
+            remaining_fitnesses = remaining_fitnesses[which_to_keep]
+
+    return remaining_fitnesses
+
+
+@numba.njit(parallel=True, cache=True, nogil=True)
+def get_observation_stats_of_ps_matrix(fs_matrix, fs_fitnesses, fs_weights, ps_matrix) -> (np.ndarray, np.ndarray, np.ndarray):
+    """For each row of ps_matrix, returns the amount of observations, the sum of their fitnesses
+    and the sum of the squares of their fitnesses, without ever building the arrays of observations.
+    When fs_weights is not None, each row counts as fs_weights[row] observations"""
+    amount_of_pss = ps_matrix.shape[0]
+    counts = np.zeros(amount_of_pss, dtype=np.float64)
+    sums = np.zeros(amount_of_pss, dtype=np.float64)
+    sums_of_squares = np.zeros(amount_of_pss, dtype=np.float64)
+
+    for ps_index in numba.prange(amount_of_pss):
+        ps_values = ps_matrix[ps_index]
+        fixed_vars = np.flatnonzero(ps_values != STAR)
+        for row in range(fs_matrix.shape[0]):
+            matches = True
+            for var in fixed_vars:
+                if fs_matrix[row, var] != ps_values[var]:
+                    matches = False
+                    break
+            if matches:
+                fitness = fs_fitnesses[row]
+                weight = 1.0 if fs_weights is None else fs_weights[row]
+                counts[ps_index] += weight
+                sums[ps_index] += weight * fitness
+                sums_of_squares[ps_index] += weight * fitness * fitness
+
+    return counts, sums, sums_of_squares
+
+
+# the same kernel without the threads, for when USE_PARALLEL_KERNELS is False (prange runs as range).
+# It is not cached, since its cache entries would have the same name as those of the parallel version
+get_observation_stats_of_ps_matrix_serially = numba.njit(nogil=True)(get_observation_stats_of_ps_matrix.py_func)
 
 
-@jit
-def get_relevant_rows_in_matrix_old(fs_matrix, fs_fitnesses, ps_values) -> np.ndarray:
-    only_relevant_rows = fs_matrix[:, ps_values != STAR]
-    only_relevant_values = ps_values[ps_values != STAR]
-
-    # Rewrite np.all() to use np.alltrue() for Numba compatibility
-    def alltrue(arr):
-        for elem in arr:
-            if not elem:
-                return False
-        return True
-
-    where_matching = np.array([alltrue(row == only_relevant_values) for row in only_relevant_rows])
-    return fs_fitnesses[where_matching]
-
 @numba.njit
-def get_relevant_rows_in_matrix_shortcircuit(full_solution_matrix, fitness_array, values):
-    only_relevant_rows = full_solution_matrix[:, values != STAR]
-    only_relevant_values = values[values != STAR]
-    return np.array([fitness for fs, fitness in zip(only_relevant_rows, fitness_array)
-                     if np.array_equal(fs, only_relevant_values)])
-
-
-@jit
-def get_relevant_rows_in_matrix(fs_matrix, fs_fitnesses, ps_values) -> np.ndarray:
-    # Find the indices where ps_values is not equal to STAR
-    relevant_indices = np.where(ps_values != STAR)[0]
-
-    # Extract only the relevant values from ps_values
-    relevant_values = ps_values[relevant_indices]
-
-    # Extract only the relevant columns from fs_matrix
-    relevant_matrix = fs_matrix[:, relevant_indices]
+def get_leave_one_out_stats(fs_matrix, fs_fitnesses, fs_weights, fixed_vars, fixed_vals) -> (float, float, np.ndarray, np.ndarray):
+    """
+    In a single pass over the fixed values, counts for each row how many of them it mismatches,
+    and which one when exactly one mismatches. Returns the amount of observations and the sum of their fitnesses,
+    for the PS and for each PS obtained by unfixing one of the fixed variables (in the order of fixed_vars).
+    When fs_weights is not None, each row counts as fs_weights[row] observations
+    """
+    sample_size = fs_matrix.shape[0]
+    amount_of_fixed = len(fixed_vars)
+
+    # the loops go column by column without branches, so that they can be vectorised
+    amount_of_mismatches = np.zeros(sample_size, dtype=np.int32)
+    mismatching_index = np.zeros(sample_size, dtype=np.int32)  # only meaningful when there is one mismatch
+    for fixed_index in range(amount_of_fixed):
+        var = fixed_vars[fixed_index]
+        val = fixed_vals[fixed_index]
+        for row in range(sample_size):
+            mismatches = fs_matrix[row, var] != val
+            amount_of_mismatches[row] += mismatches
+            mismatching_index[row] += mismatches * fixed_index
+
+    count = 0.0
+    total = 0.0
+    counts_when_mismatching = np.zeros(amount_of_fixed, dtype=np.float64)
+    sums_when_mismatching = np.zeros(amount_of_fixed, dtype=np.float64)
+    for row in range(sample_size):
+        weight = 1.0 if fs_weights is None else fs_weights[row]
+        if amount_of_mismatches[row] == 0:
+            count += weight
+            total += weight * fs_fitnesses[row]
+        elif amount_of_mismatches[row] == 1:
+            counts_when_mismatching[mismatching_index[row]] += weight
+            sums_when_mismatching[mismatching_index[row]] += weight * fs_fitnesses[row]
+
+    # the observations of a simplification are those of the PS, plus those which only mismatch the unfixed variable
+    return count, total, counts_when_mismatching + count, sums_when_mismatching + total
 
-    # Initialize an empty list to store matching row indices
-    matching_rows = []
 
-    # Iterate over rows of the relevant matrix
-    for row in relevant_matrix:
-        # Initialize a flag to track whether the row matches the relevant values
-        match = True
+@numba.njit
+def get_hamming_ball_stats(fs_matrix, fs_fitnesses, fs_weights, fixed_vars, fixed_vals):
+    """
+    In a single pass over the fixed values, finds for each row how many of them it mismatches, and which ones
+    when there are at most 2 mismatches (only the rows with 2 mismatches need to be revisited).
+    When fs_weights is not None, each row counts as fs_weights[row] observations.
+    Returns the counts and fitness sums of the rows with
+     - no mismatches (as scalars)
+     - exactly one mismatch, indexed by the mismatching position in fixed_vars
+     - exactly two mismatches, indexed by the pair of mismatching positions [i, j], with i < j (the rest is 0)
+    """
+    sample_size = fs_matrix.shape[0]
+    amount_of_fixed = len(fixed_vars)
+
+    # the loops go column by column without branches, so that they can be vectorised
+    amount_of_mismatches = np.zeros(sample_size, dtype=np.int32)
+    sum_of_mismatching_indexes = np.zeros(sample_size, dtype=np.int32)
+    for fixed_index in range(amount_of_fixed):
+        var = fixed_vars[fixed_index]
+        val = fixed_vals[fixed_index]
+        for row in range(sample_size):
+            mismatches = fs_matrix[row, var] != val
+            amount_of_mismatches[row] += mismatches
+            sum_of_mismatching_indexes[row] += mismatches * fixed_index
+
+    count = 0.0
+    total = 0.0
+    counts_with_one = np.zeros(amount_of_fixed, dtype=np.float64)
+    sums_with_one = np.zeros(amount_of_fixed, dtype=np.float64)
+    counts_with_two = np.zeros((amount_of_fixed, amount_of_fixed), dtype=np.float64)
+    sums_with_two = np.zeros((amount_of_fixed, amount_of_fixed), dtype=np.float64)
+    for row in range(sample_size):
+        weight = 1.0 if fs_weights is None else fs_weights[row]
+        fitness = fs_fitnesses[row]
+        if amount_of_mismatches[row] == 0:
+            count += weight
+            total += weight * fitness
+        elif amount_of_mismatches[row] == 1:
+            counts_with_one[sum_of_mismatching_indexes[row]] += weight
+            sums_with_one[sum_of_mismatching_indexes[row]] += weight * fitness
+        elif amount_of_mismatches[row] == 2:
+            # only these rows are scanned again, to find the first mismatch (and from it the second)
+            first = 0
+            while fs_matrix[row, fixed_vars[first]] == fixed_vals[first]:
+                first += 1
+            second = sum_of_mismatching_indexes[row] - first
+            counts_with_two[first, second] += weight
+            sums_with_two[first, second] += weight * fitness
+
+    return count, total, counts_with_one, sums_with_one, counts_with_two, sums_with_two
+
+
+def means_from_observation_stats(counts: np.ndarray, sums: np.ndarray, invalid_value=np.nan) -> ArrayOfFloats:
+    """The mean fitness of the observations, where invalid_value is used for the pss without observations"""
+    means = np.full(shape=len(counts), fill_value=invalid_value, dtype=float)
+    observed = counts > 0
+    means[observed] = sums[observed] / counts[observed]
+    return means
+
+
+def variances_from_observation_stats(counts: np.ndarray,
+                                     sums: np.ndarray,
+                                     sums_of_squares: np.ndarray) -> ArrayOfFloats:
+    """The (population) variance of the observations, as in np.var. It is nan for the pss without observations"""
+    means = means_from_observation_stats(counts, sums)
+    variances = np.full(shape=len(counts), fill_value=np.nan, dtype=float)
+    observed = counts > 0
+    variances[observed] = sums_of_squares[observed] / counts[observed] - np.square(means[observed])
+    return np.maximum(variances, 0, where=observed, out=variances)  # rounding errors can make them slightly negative
+
+
+def t_scores_from_observation_stats(counts: np.ndarray,
+                                    sums: np.ndarray,
+                                    sums_of_squares: np.ndarray,
+                                    population_mean: float) -> ArrayOfFloats:
+    """The t-score of the mean of the observations against the population mean, as in SignificantlyHighAverage.
+    It is nan when there are no observations or they all have the same fitness"""
+    means = means_from_observation_stats(counts, sums)
+    standard_deviations = np.sqrt(variances_from_observation_stats(counts, sums, sums_of_squares))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_scores = (means - population_mean) / (standard_deviations / np.sqrt(counts))
+    t_scores[~np.isfinite(t_scores)] = np.nan
+    return t_scores
+
+
+def allocate_sample_to_strata(stratum_sizes: ArrayOfInts, size: int) -> ArrayOfInts:
+    """divides size between the strata as equally as possible, where the full strata give their share to the others"""
+    allocation = np.zeros(len(stratum_sizes), dtype=np.int64)
+    remaining = min(size, int(np.sum(stratum_sizes)))
+    while remaining > 0:
+        not_full = np.flatnonzero(allocation < stratum_sizes)
+        share = max(remaining // len(not_full), 1)
+        for stratum in not_full:
+            extra = min(share, stratum_sizes[stratum] - allocation[stratum], remaining)
+            allocation[stratum] += extra
+            remaining -= extra
+            if remaining == 0:
+                break
+    return allocation
+
+
+def get_stratified_sample(strata: ArrayOfInts, size: int, rng: np.random.Generator) -> (ArrayOfInts, ArrayOfFloats):
+    """
+    Samples size rows without replacement, where strata[i] is the stratum of row i.
+    :return: the sampled rows, in increasing order, and their inverse inclusion probabilities,
+             ie (rows in the stratum) / (rows sampled from the stratum)
+    """
+    _, stratum_of_rows, stratum_sizes = np.unique(strata, return_inverse=True, return_counts=True)
+    stratum_of_rows = stratum_of_rows.ravel()
+    allocation = allocate_sample_to_strata(stratum_sizes, size)
+    rows_by_stratum = np.split(np.argsort(stratum_of_rows, kind="stable"), np.cumsum(stratum_sizes)[:-1])
+    rows = np.sort(np.concatenate([rng.choice(stratum_rows, amount, replace=False)
+                                   for stratum_rows, amount in zip(rows_by_stratum, allocation) if amount > 0]))
+    inverse_probabilities = stratum_sizes / np.maximum(allocation, 1)
+    return rows, inverse_probabilities[stratum_of_rows[rows]]
 
-        # Iterate over elements of the row and relevant values simultaneously
-        for elem, val in zip(row, relevant_values):
-            if elem != val:
-                match = False
-                break  # Exit inner loop early if mismatch is found
 
-        # If match is still True after iterating over all elements, add the row index to matching_rows
-        matching_rows.append(match)
+def get_weights_as_multiplicities(weights: ArrayOfFloats) -> ArrayOfInts:
+    """the weights of a deduplicated PRef as amounts of repetitions. Fractional weights (eg of a sketch) are rejected,
+    since rounding them would distort the sample: the weighted statistics should be used instead"""
+    multiplicities = np.rint(weights).astype(np.int64)
+    if not np.allclose(weights, multiplicities):
+        raise ValueError("The weights are fractional (eg the PRef is a sketch), so the observations can't be repeated, "
+                         "use the weighted methods instead (eg fitnesses_and_weights_of_observations)")
+    return multiplicities
 
-    # Convert matching_rows to a NumPy array
-    matching_rows = np.array(matching_rows)
 
-    # Return the corresponding fitness values for the matching rows
-    return fs_fitnesses[matching_rows]
+PREF_MATRIX_FILE = "full_solution_matrix.npy"
+PREF_FITNESS_FILE = "fitness_array.npy"
+PREF_WEIGHTS_FILE = "weights.npy"  # only present when the PRef is deduplicated
+PREF_METADATA_FILE = "metadata.json"
 
 
 class PRef:
@@ -80,25 +325,59 @@ class PRef:
     fitness_array: ArrayOfFloats
     full_solution_matrix: np.ndarray
     search_space: SearchSpace
+    bitmap_index: Optional[BitmapIndex]
+    query_planner: Optional[QueryPlanner]
+    observation_cache: Optional[ObservationCache]
+    cached_marginals: Optional[PRefMarginals]  # depends on the fitnesses, so it's not shared with other PRefs
+    cached_fingerprint: Optional[str]  # the PRef is assumed to not be modified after the fingerprint is calculated
+    cached_solutions_fingerprint: Optional[str]  # only of the solutions, so it's shared with with_different_fitnesses
+    solutions_source: Optional[Any]  # the PRef this was derived from with the same solutions, see solutions_fingerprint
+    normalised_from: Optional[Any]  # the PRef whose fitnesses were normalised to obtain these, see fingerprint
+    precomputation_store: Optional[PrecomputationStore]  # where the tables calculated by the metrics are persisted
+    shared_memory: Optional[Any]  # the SharedPRef this was attached from, which keeps the buffers open
+    weights: Optional[ArrayOfFloats]  # how many times each row was observed, see deduplicate(). None means once each
 
     def __init__(self,
                  fitness_array: Iterable[Fitness],
                  full_solution_matrix: np.ndarray,
-                 search_space: SearchSpace):
-        self.fitness_array = np.array(fitness_array)
-        self.full_solution_matrix = full_solution_matrix
+                 search_space: SearchSpace,
+                 weights: Optional[Iterable[float]] = None):
+        self.fitness_array = np.asarray(fitness_array)  # asarray, so that memory mapped arrays are not loaded
+        self.full_solution_matrix = self.as_compact_matrix(full_solution_matrix, search_space)
         self.search_space = search_space
+        self.weights = None if weights is None else np.asarray(weights, dtype=float)
+        self.bitmap_index = None
+        self.query_planner = None
+        self.observation_cache = None
+        self.cached_marginals = None
+        self.cached_fingerprint = None
+        self.cached_solutions_fingerprint = None
+        self.solutions_source = None
+        self.normalised_from = None
+        self.precomputation_store = None
+        self.shared_memory = None
 
     def __repr__(self):
-        mean_fitness = np.average(self.fitness_array)
+        mean_fitness = self.mean_fitness()
+        if self.weights is not None:
+            return f"PRef with {self.sample_size} weighted samples ({self.total_weight:.0f} in total), mean = {mean_fitness:.2f}"
 
         return f"PRef with {self.sample_size} samples, mean = {mean_fitness:.2f}"
 
+    @staticmethod
+    def as_compact_matrix(full_solution_matrix: np.ndarray, search_space: SearchSpace) -> np.ndarray:
+        """Stores the solutions using the narrowest dtype that fits the search space (usually int8),
+        which uses much less memory and makes every filter on the columns faster.
+        Memory mapped matrices are left as they are, since converting them would load them in memory"""
+        if isinstance(full_solution_matrix, np.memmap):
+            return full_solution_matrix
+        return np.asarray(full_solution_matrix, dtype=search_space.compact_dtype)
+
     @classmethod
     def from_full_solutions(cls, full_solutions: Iterable[FullSolution],
                             fitness_values: Iterable[Fitness],
                             search_space: SearchSpace):
-        matrix = np.array([fs.values for fs in full_solutions])
+        matrix = np.array([fs.values for fs in full_solutions], dtype=search_space.compact_dtype)
         return cls(fitness_values, matrix, search_space)
 
 
@@ -117,88 +396,485 @@ class PRef:
         return cls.from_full_solutions(samples, fitnesses, search_space)
 
 
+    def uses_parallel_matching(self) -> bool:
+        """whether the rows are split between the threads of the numba kernels (see USE_PARALLEL_KERNELS)"""
+        return USE_PARALLEL_KERNELS and self.sample_size >= NUMBA_MATCHING_THRESHOLD
+
     def fitnesses_of_observations(self, ps: PS) -> ArrayOfFloats:
         """
         This is the most important function of the class, and it roughly corresponds to the obs_PRef(ps) in the paper
         :param ps: a partial solution, where the * values are represented by -1
         :return: a list of floats, corresponding to the fitnesses of the observations of the ps
-        within the reference population
+        within the reference population. If the PRef is deduplicated, the fitnesses are repeated as in the original.
+        The weights of a sketch are fractional, so they can't be repeated: use fitnesses_and_weights_of_observations
         """
-        remaining_rows = self.full_solution_matrix
-        remaining_fitnesses = self.fitness_array
-
-        for variable_index, variable_value in enumerate(ps.values):
-            if variable_value != STAR:
-                which_to_keep = remaining_rows[:, variable_index] == variable_value
-
-                # update the current filtered results
-                remaining_rows = remaining_rows[which_to_keep]
-                remaining_fitnesses = remaining_fitnesses[which_to_keep]
-
-        return remaining_fitnesses
-
-    def fitnesses_of_observations_experimental(self, ps: PS) -> np.ndarray:
-        return get_relevant_rows_in_matrix_shortcircuit(self.full_solution_matrix, self.fitness_array, ps.values)
-
+        if self.weights is not None:
+            fitnesses, weights = self.fitnesses_and_weights_of_observations(ps)
+            return np.repeat(fitnesses, get_weights_as_multiplicities(weights))
+        if self.uses_observation_engine():
+            return self.fitness_array[self.rows_of_observations(ps)]
+        if self.uses_parallel_matching():
+            return self.fitness_array[get_matching_row_ids(self.full_solution_matrix, *self.get_fixed_vars_and_vals(ps.values))]
+        return get_fitnesses_by_boolean_filtering(self.full_solution_matrix, self.fitness_array, ps.values)
+
+    def fitnesses_and_weights_of_observations(self, ps: PS) -> (ArrayOfFloats, ArrayOfFloats):
+        """
+        The fitnesses of the distinct observations of ps, and how many times each was observed.
+        This is preferable to fitnesses_of_observations for deduplicated PRefs, since nothing is repeated
+        """
+        if self.weights is None:
+            fitnesses = self.fitnesses_of_observations(ps)
+            return fitnesses, np.ones(len(fitnesses))
+        rows = self.rows_of_observations(ps)
+        return self.fitness_array[rows], self.weights[rows]
 
+    def observation_stats(self, ps_matrix: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        The batched version of fitnesses_of_observations, for when only the summary statistics are needed
+        :param ps_matrix: a matrix where each row is the values of a PS, with the * values represented by -1
+        :return: (counts, sums, sums_of_squares), one entry for each PS:
+                the amount of observations (as floats, they are the sums of the weights when deduplicated),
+                and the sum of their fitnesses and squared fitnesses.
+                The means, variances and t-scores can be obtained via the *_from_observation_stats functions
+        """
+        return self.observation_stats_with_weights(ps_matrix, self.weights)
+
+    def observation_stats_with_weights(self,
+                                       ps_matrix: np.ndarray,
+                                       row_weights: Optional[ArrayOfFloats]) -> (np.ndarray, np.ndarray, np.ndarray):
+        """observation_stats, where the rows are weighted by row_weights instead (None means 1 each)"""
+        ps_matrix = np.asarray(ps_matrix, dtype=self.full_solution_matrix.dtype)  # STAR = -1 fits in any compact dtype
+        ps_matrix = ps_matrix.reshape((-1, self.search_space.amount_of_parameters))
+        if not self.uses_observation_engine():
+            # (numba.get_num_threads starts the threading layer, so it is only called when the threads will be used)
+            if self.uses_parallel_matching() and len(ps_matrix) < numba.get_num_threads():
+                # too few PSs to parallelise over them, so the rows are split instead
+                stats = np.array([get_matching_stats(self.full_solution_matrix,
+                                                     self.fitness_array,
+                                                     row_weights,
+                                                     *self.get_fixed_vars_and_vals(ps_values))
+                                  for ps_values in ps_matrix], dtype=float).reshape((-1, 3))
+                counts, sums, sums_of_squares = np.ascontiguousarray(stats.T)
+                return counts, sums, sums_of_squares
+            kernel = get_observation_stats_of_ps_matrix if USE_PARALLEL_KERNELS else get_observation_stats_of_ps_matrix_serially
+            return kernel(self.full_solution_matrix, self.fitness_array, row_weights, ps_matrix)
+
+        counts = np.zeros(len(ps_matrix), dtype=float)
+        sums = np.zeros(len(ps_matrix), dtype=float)
+        sums_of_squares = np.zeros(len(ps_matrix), dtype=float)
+        if self.observation_cache is None and self.query_planner is None:  # only the bitmap index
+            for ps_index, ps_values in enumerate(ps_matrix):
+                counts[ps_index], sums[ps_index], sums_of_squares[ps_index] = \
+                    self.bitmap_index.get_stats(ps_values, self.fitness_array, row_weights)
+            return counts, sums, sums_of_squares
+
+        weights = np.ones(self.sample_size) if row_weights is None else row_weights
+        for ps_index, ps_values in enumerate(ps_matrix):
+            rows = self.calculate_rows_of_observations(ps_values)
+            observations = self.fitness_array[rows]
+            observation_weights = weights[rows]
+            counts[ps_index] = np.sum(observation_weights)
+            sums[ps_index] = np.sum(observation_weights * observations)
+            sums_of_squares[ps_index] = np.sum(observation_weights * np.square(observations))
+        return counts, sums, sums_of_squares
+
+    def standard_errors_of_means(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        """
+        The standard error of the mean fitness of the observations of each PS, when this PRef is a weighted sample
+        (eg a sketch) of a larger population. This is the linearised error of a ratio estimator,
+        sqrt(sum(w^2 (f - mean)^2)) / sum(w), which for an unweighted PRef is the standard deviation / sqrt(n).
+        It ignores the stratification of sketches, so it slightly overestimates their errors.
+        It is nan for the PSs without observations
+        """
+        counts, sums, _ = self.observation_stats(ps_matrix)
+        squared_weights = None if self.weights is None else np.square(self.weights)
+        sq_counts, sq_sums, sq_sums_of_squares = self.observation_stats_with_weights(ps_matrix, squared_weights)
+
+        means = means_from_observation_stats(counts, sums)
+        standard_errors = np.full(len(counts), np.nan)
+        observed = counts > 0
+        variances = (sq_sums_of_squares - 2 * means * sq_sums + np.square(means) * sq_counts)[observed]
+        standard_errors[observed] = np.sqrt(np.maximum(variances, 0)) / counts[observed]
+        return standard_errors
+
+    def leave_one_out_stats(self,
+                            ps: PS,
+                            fitness_array: Optional[ArrayOfFloats] = None) -> (int, float, np.ndarray, np.ndarray):
+        """
+        Calculates, in a single pass, the amount of observations of ps and the sum of their fitnesses,
+        and the same for each of ps.simplifications() (in that order)
+        :param ps: the PS
+        :param fitness_array: if present, it is summed instead of self.fitness_array (eg normalised fitnesses)
+        :return: count, sum, counts of the simplifications, sums of the simplifications
+        """
+        fitnesses = self.fitness_array if fitness_array is None else fitness_array
+        fixed_vars = ps.get_fixed_variable_positions()
+        return get_leave_one_out_stats(self.full_solution_matrix,
+                                       np.asarray(fitnesses, dtype=float),
+                                       self.weights,
+                                       np.asarray(fixed_vars, dtype=np.int64),
+                                       ps.values[fixed_vars].astype(np.int64))
+
+    def hamming_ball_stats(self, ps: PS, fitness_array: Optional[ArrayOfFloats] = None):
+        """
+        Calculates, in a single pass, the counts and fitness sums of the rows which match ps
+        except for 0, 1 or 2 of its fixed variables (the positions refer to ps.get_fixed_variable_positions()).
+        :param ps: the PS
+        :param fitness_array: if present, it is summed instead of self.fitness_array
+        :return: count, sum (no mismatches),
+                 counts, sums for each position (exactly that one mismatches),
+                 counts, sums for each pair of positions [i, j] with i < j (exactly those two mismatch)
+        """
+        fitnesses = self.fitness_array if fitness_array is None else fitness_array
+        fixed_vars = ps.get_fixed_variable_positions()
+        return get_hamming_ball_stats(self.full_solution_matrix,
+                                      np.asarray(fitnesses, dtype=float),
+                                      self.weights,
+                                      np.asarray(fixed_vars, dtype=np.int64),
+                                      ps.values[fixed_vars].astype(np.int64))
+
+    def get_fixed_vars_and_vals(self, ps_values: np.ndarray) -> (ArrayOfInts, np.ndarray):
+        """the arguments of the matching kernels, where the values are in the dtype of the matrix"""
+        ps_values = np.asarray(ps_values)
+        fixed_vars = np.flatnonzero(ps_values != STAR)
+        return fixed_vars, ps_values[fixed_vars].astype(self.full_solution_matrix.dtype)
+
+    def uses_observation_engine(self) -> bool:
+        return (self.observation_cache is not None
+                or self.query_planner is not None
+                or self.bitmap_index is not None)
+
+    def rows_of_observations(self, ps: PS) -> np.ndarray:
+        """Returns which rows match the ps, either as a boolean mask or as increasing row ids.
+        Both can be used to index the fitness array (or any other array aligned with the rows)"""
+        if self.observation_cache is not None:
+            return self.observation_cache.get_rows(ps.values, self.calculate_rows_of_observations)
+        return self.calculate_rows_of_observations(ps.values)
+
+    def calculate_rows_of_observations(self, ps_values: np.ndarray) -> np.ndarray:
+        """Same as rows_of_observations, but it ignores the observation cache"""
+        if self.query_planner is not None:
+            return self.query_planner.get_matching_rows(ps_values)
+        if self.bitmap_index is not None:
+            return self.bitmap_index.get_row_ids(ps_values)
+        if self.uses_parallel_matching():
+            return get_matching_row_ids(self.full_solution_matrix, *self.get_fixed_vars_and_vals(ps_values))
 
-    def fitnesses_of_observations_other_experimental(self, ps: PS) -> np.ndarray:
-        return get_relevant_rows_in_matrix_shortcircuit(self.full_solution_matrix, self.fitness_array, ps.values)
-    def fitnesses_of_observations_and_complement(self, ps: PS) -> (ArrayOfFloats, ArrayOfFloats):
         selected_rows = np.full(shape=self.fitness_array.shape, fill_value=True, dtype=bool)
-
-        for variable_index, variable_value in enumerate(ps.values):
+        for variable_index, variable_value in enumerate(ps_values):
             if variable_value != STAR:
-                rows_where_variable_matches = self.full_solution_matrix[:, variable_index] == variable_value
+                rows_where_variable_matches = self.full_solution_matrix[:, variable_index] == int(variable_value)
                 selected_rows = np.logical_and(selected_rows, rows_where_variable_matches)
+        return selected_rows
 
-        return self.fitness_array[selected_rows], self.fitness_array[np.logical_not(selected_rows)]
+    def fitnesses_of_observations_and_complement(self, ps: PS) -> (ArrayOfFloats, ArrayOfFloats):
+        selected_rows = self.rows_of_observations(ps)
+        if selected_rows.dtype != bool:
+            selected_row_ids = selected_rows
+            selected_rows = np.full(shape=self.fitness_array.shape, fill_value=False, dtype=bool)
+            selected_rows[selected_row_ids] = True
+
+        return self.repeat_by_weights(selected_rows), self.repeat_by_weights(np.logical_not(selected_rows))
+
+    def build_bitmap_index(self):
+        """After calling this, the observation queries will use a bitmap index, which is built only once.
+        Note that the PRefs obtained via with_different_fitnesses share the same index"""
+        self.bitmap_index = BitmapIndex(self.full_solution_matrix, self.search_space)
+
+    def enable_observation_cache(self, max_cached_rows: int = 2 ** 24, max_entries: int = 100000):
+        """After calling this, the rows matching each PS are cached, and the rows of a specialisation of
+        a cached PS are obtained by filtering only the rows of the cached PS.
+        The statistics are available in self.observation_cache.get_statistics()"""
+        self.observation_cache = ObservationCache(self.full_solution_matrix,
+                                                  max_cached_rows=max_cached_rows,
+                                                  max_entries=max_entries)
+
+    def build_query_planner(self, use_posting_lists: bool = False, row_id_threshold: float = 0.05):
+        """After calling this, the observation queries apply the fixed values from the most selective to the least,
+        and the planner statistics (rows scanned per query) are available in self.query_planner.get_statistics().
+        The posting lists avoid scanning the column of the rarest value, but they take 4 times the memory of the
+        (int8) solution matrix"""
+        self.query_planner = QueryPlanner(self.full_solution_matrix,
+                                          self.search_space,
+                                          use_posting_lists=use_posting_lists,
+                                          row_id_threshold=row_id_threshold)
+
+    def get_marginals(self) -> PRefMarginals:
+        """The counts, fitness sums and sums of squares for every (var, val) and pair of (var, val)s,
+        calculated on the first call. Note that the PRef is assumed not to change afterwards"""
+        if self.cached_marginals is None:
+            self.cached_marginals = PRefMarginals(self.full_solution_matrix,
+                                                  self.fitness_array,
+                                                  self.search_space,
+                                                  weights=self.weights)
+        return self.cached_marginals
+
+    def solutions_fingerprint(self, rows_per_chunk: int = 2 ** 16) -> str:
+        """A hash of the search space and the solutions, which are hashed in chunks as int64,
+        so that the result does not depend on the dtype of the matrix"""
+        if self.cached_solutions_fingerprint is None and self.solutions_source is not None:
+            self.cached_solutions_fingerprint = self.solutions_source.solutions_fingerprint(rows_per_chunk)
+        if self.cached_solutions_fingerprint is None:
+            hasher = hashlib.blake2b(digest_size=16)
+            hasher.update(np.asarray(self.search_space.cardinalities, dtype=np.int64).tobytes())
+            for start in range(0, self.sample_size, rows_per_chunk):
+                chunk = self.full_solution_matrix[start:start + rows_per_chunk]
+                hasher.update(np.ascontiguousarray(chunk, dtype=np.int64).tobytes())
+            self.cached_solutions_fingerprint = hasher.hexdigest()
+        return self.cached_solutions_fingerprint
+
+    def fingerprint(self) -> str:
+        """A hash of the search space, the solutions and the fitnesses, used to recognise the same PRef across sessions.
+        The hash of the solutions is shared by the PRefs obtained via with_different_fitnesses, and the PRefs from
+        get_with_normalised_fitnesses derive theirs from the original, since their fitnesses are determined by it"""
+        if self.cached_fingerprint is None and self.normalised_from is not None:
+            self.cached_fingerprint = hashlib.blake2b((self.normalised_from.fingerprint() + "|normalised").encode(),
+                                                      digest_size=16).hexdigest()
+        if self.cached_fingerprint is None:
+            hasher = hashlib.blake2b(digest_size=16)
+            hasher.update(self.solutions_fingerprint().encode())
+            hasher.update(np.ascontiguousarray(self.fitness_array, dtype=np.float64).tobytes())
+            if self.weights is not None:
+                hasher.update(self.weights.tobytes())
+            self.cached_fingerprint = hasher.hexdigest()
+        return self.cached_fingerprint
+
+    def get_or_compute(self, name: str, parameters: dict, compute: Callable[[], np.ndarray]) -> np.ndarray:
+        """Used by the metrics for their tables, which are persisted if this PRef has a precomputation store"""
+        if self.precomputation_store is None:
+            return np.asarray(compute())
+        return self.precomputation_store.get_or_compute(self.fingerprint(), name, parameters, compute)
 
     @property
     def sample_size(self) -> int:
+        """the amount of rows, which for a deduplicated PRef is less than the amount of observations (total_weight)"""
         return len(self.fitness_array)
 
+    @property
+    def total_weight(self) -> float:
+        return float(self.sample_size if self.weights is None else np.sum(self.weights))
+
+    def get_weights(self) -> ArrayOfFloats:
+        return np.ones(self.sample_size) if self.weights is None else self.weights
+
+    def get_multiplicities(self) -> ArrayOfInts:
+        """the weights as amounts of repetitions, which is not possible for sketches (where they are fractional)"""
+        return get_weights_as_multiplicities(self.get_weights())
+
+    def mean_fitness(self) -> float:
+        return float(np.average(self.fitness_array, weights=self.weights))
+
+    def repeat_by_weights(self, rows: np.ndarray) -> ArrayOfFloats:
+        """the fitnesses of the given rows, where those of a deduplicated PRef are repeated as in the original"""
+        if self.weights is None:
+            return self.fitness_array[rows]
+        return np.repeat(self.fitness_array[rows], self.get_multiplicities()[rows])
+
+    def deduplicate(self):
+        """
+        Returns a PRef where the repeated observations (same solution and same fitness) are kept only once,
+        in the order in which they first appear, and weights stores how many times each was observed.
+        The observation queries, the marginals and the metrics take the weights into account,
+        so the statistics are the same as those of this PRef, but they are calculated on fewer rows.
+        """
+        matrix = np.ascontiguousarray(self.full_solution_matrix)
+        row_bytes = matrix.dtype.itemsize * matrix.shape[1]
+        keys = np.empty(self.sample_size, dtype=[("solution", np.void, row_bytes), ("fitness", np.float64)])
+        keys["solution"] = matrix.view(np.dtype((np.void, row_bytes))).ravel()
+        keys["fitness"] = self.fitness_array
+
+        _, first_rows, which_unique = np.unique(keys, return_index=True, return_inverse=True)
+        weights = np.bincount(which_unique.ravel(), weights=self.get_weights(), minlength=len(first_rows))
+        order = np.argsort(first_rows)
+        kept_rows = first_rows[order]
+        result = PRef(fitness_array=self.fitness_array[kept_rows],
+                      full_solution_matrix=matrix[kept_rows],
+                      search_space=self.search_space,
+                      weights=weights[order])
+        result.precomputation_store = self.precomputation_store
+        return result
+
+    def get_fitness_strata(self, amount_of_strata: int) -> ArrayOfInts:
+        """the fitness quantile of each row (as an int in [0, amount_of_strata))"""
+        quantiles = np.quantile(self.fitness_array, np.linspace(0, 1, amount_of_strata + 1)[1:-1])
+        return np.searchsorted(quantiles, self.fitness_array, side="right")
+
+    def get_rarest_var_val_strata(self) -> ArrayOfInts:
+        """the (hot encoded) var, val of each row which is the least frequent in this PRef"""
+        counts = self.get_marginals().univariate_counts
+        strata = np.zeros(self.sample_size, dtype=np.int64)
+        rarest_counts = np.full(self.sample_size, np.inf)
+        for var in range(self.search_space.amount_of_parameters):
+            codes = self.search_space.precomputed_offsets[var] + self.full_solution_matrix[:, var].astype(np.int64)
+            counts_of_codes = counts[codes]
+            is_rarer = counts_of_codes < rarest_counts
+            strata[is_rarer] = codes[is_rarer]
+            rarest_counts[is_rarer] = counts_of_codes[is_rarer]
+        return strata
+
+    def sketch(self,
+               size: int,
+               strategy: Literal["fitness", "var_val"] = "fitness",
+               amount_of_strata: int = 10,
+               seed: Optional[int] = None):
+        """
+        Returns a stratified subsample of (at most) size rows, where each row is weighted by the inverse of its
+        probability of being sampled (times its weight in this PRef), so that the weighted statistics of the sketch
+        estimate those of this PRef. Miners can screen the PSs on the sketch, where the metrics are much cheaper,
+        and then re-score the survivors on this PRef (see standard_errors_of_means).
+        :param strategy: how the rows are stratified:
+            - "fitness": by fitness quantile, with amount_of_strata strata
+            - "var_val": by the rarest (var, val) of each row, so that the rare values are still observed
+        The sample is divided between the strata as equally as possible
+        """
+        if size < 1:
+            raise ValueError(f"The size of the sketch must be positive, but it is {size}")
+        if strategy == "fitness":
+            strata = self.get_fitness_strata(amount_of_strata)
+        elif strategy == "var_val":
+            strata = self.get_rarest_var_val_strata()
+        else:
+            raise ValueError(f"Unknown sketching strategy {strategy}")
+
+        rows, inclusion_weights = get_stratified_sample(strata, size, np.random.default_rng(seed))
+        result = PRef(fitness_array=self.fitness_array[rows],
+                      full_solution_matrix=self.full_solution_matrix[rows],
+                      search_space=self.search_space,
+                      weights=inclusion_weights * self.get_weights()[rows])
+        result.precomputation_store = self.precomputation_store
+        return result
+
+    def expand(self):
+        """The inverse of deduplicate (except for the order of the rows), where each row is repeated by its weight"""
+        if self.weights is None:
+            return self
+        rows = np.repeat(np.arange(self.sample_size), self.get_multiplicities())
+        result = PRef(fitness_array=self.fitness_array[rows],
+                      full_solution_matrix=self.full_solution_matrix[rows],
+                      search_space=self.search_space)
+        result.precomputation_store = self.precomputation_store
+        return result
+
+    def with_different_fitnesses(self, fitness_array: Iterable[Fitness]):
+        """Returns a PRef with the same solutions (and the same indexes, if present), but different fitnesses"""
+        result = PRef(fitness_array=fitness_array,
+                      full_solution_matrix=self.full_solution_matrix,
+                      search_space=self.search_space,
+                      weights=self.weights)
+        result.bitmap_index = self.bitmap_index
+        result.query_planner = self.query_planner
+        result.observation_cache = self.observation_cache
+        result.precomputation_store = self.precomputation_store  # the keys include the fingerprint, so it's safe
+        result.solutions_source = self
+        return result
+
+    def get_view(self):
+        """A PRef which shares everything with this one, where indexes and caches can be enabled without affecting this one"""
+        result = self.with_different_fitnesses(self.fitness_array)
+        result.cached_marginals = self.cached_marginals
+        result.cached_fingerprint = self.cached_fingerprint
+        result.shared_memory = self.shared_memory
+        return result
+
     def get_with_normalised_fitnesses(self):
         normalised_fitnesses = utils.remap_array_in_zero_one(self.fitness_array)
-        return PRef(fitness_array=normalised_fitnesses,  # this is the only thing that changes
-                    full_solution_matrix=self.full_solution_matrix,
-                    search_space=self.search_space)
+        result = self.with_different_fitnesses(normalised_fitnesses)  # the fitnesses are the only thing that changes
+        result.normalised_from = self
+        return result
 
     def get_fitnesses_matching_var_val(self, var: int, val: int) -> ArrayOfFloats:
-        where = self.full_solution_matrix[:, var] == val
-        return self.fitness_array[where]
+        where = self.full_solution_matrix[:, var] == int(val)
+        return self.repeat_by_weights(where)
 
     def get_fitnesses_matching_var_val_pair(self, var_a: int, val_a: int, var_b: int, val_b: int) -> ArrayOfFloats:
-        where = np.logical_and(self.full_solution_matrix[:, var_a] == val_a,
-                               self.full_solution_matrix[:, var_b] == val_b)
-        return self.fitness_array[where]
+        where = np.logical_and(self.full_solution_matrix[:, var_a] == int(val_a),
+                               self.full_solution_matrix[:, var_b] == int(val_b))
+        return self.repeat_by_weights(where)
 
     def get_evaluated_FSs(self) -> list[EvaluatedFS]:
+        """the repeated observations of a deduplicated PRef are repeated here too"""
+        expanded = self.expand()
         return [EvaluatedFS(full_solution=FullSolution(row), fitness=fitness) for row, fitness in
-                zip(self.full_solution_matrix, self.fitness_array)]
+                zip(expanded.full_solution_matrix, expanded.fitness_array)]
 
     def describe_self(self):
         min_fitness = np.min(self.fitness_array)
         max_fitness = np.max(self.fitness_array)
-        avg_fitness = np.average(self.fitness_array)
+        avg_fitness = self.mean_fitness()
         print(
-            f"This PRef contains {self.sample_size} samples, where the minimum is {min_fitness}, the maximum = {max_fitness} and the average is {avg_fitness}")
+            f"This PRef contains {self.total_weight:.0f} samples, where the minimum is {min_fitness}, the maximum = {max_fitness} and the average is {avg_fitness}")
 
     def save(self, file, verbose=False):
         # create the folder if it doesn't exist
         utils.make_folder_if_not_present(file)
+        weights = dict() if self.weights is None else {"weights": self.weights}
         np.savez(file,
                  fsm=self.full_solution_matrix,
                  fitness_array=self.fitness_array,
-                 search_space=self.search_space.cardinalities)
+                 search_space=self.search_space.cardinalities,
+                 **weights)
 
 
     @classmethod
     def load(cls, file: str):
+        """file can either be a .npz file produced by save, or a folder produced by save_as_folder"""
+        if os.path.isdir(file):
+            return cls.open_mmap(file)
+
         results = np.load(file)
         return cls(full_solution_matrix=results["fsm"],
                    fitness_array=results["fitness_array"],
-                   search_space=SearchSpace(results["search_space"]))
+                   search_space=SearchSpace(results["search_space"]),
+                   weights=results["weights"] if "weights" in results else None)
+
+    def save_as_folder(self, folder: str):
+        """
+        Saves the PRef as raw .npy arrays and a small metadata file, which can be opened with open_mmap.
+        The solution matrix is stored in column major order, because the observations are filtered by column
+        """
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, PREF_MATRIX_FILE), np.asfortranarray(self.full_solution_matrix))
+        np.save(os.path.join(folder, PREF_FITNESS_FILE), self.fitness_array)
+        if self.weights is not None:
+            np.save(os.path.join(folder, PREF_WEIGHTS_FILE), self.weights)
+
+        metadata = {"cardinalities": [int(cardinality) for cardinality in self.search_space.cardinalities],
+                    "dtype": str(self.full_solution_matrix.dtype),
+                    "fitness_dtype": str(self.fitness_array.dtype),
+                    "sample_size": self.sample_size}
+        with open(os.path.join(folder, PREF_METADATA_FILE), "w") as file:
+            json.dump(metadata, file, indent=4)
+
+    @classmethod
+    def open_mmap(cls, folder: str):
+        """
+        Opens a PRef saved with save_as_folder without reading it:
+        the arrays are memory mapped (read only), and they are paged in by the OS when they are used.
+        """
+        with open(os.path.join(folder, PREF_METADATA_FILE), "r") as file:
+            metadata = json.load(file)
+
+        full_solution_matrix = np.load(os.path.join(folder, PREF_MATRIX_FILE), mmap_mode="r")
+        fitness_array = np.load(os.path.join(folder, PREF_FITNESS_FILE), mmap_mode="r")
+
+        expected_shape = (metadata["sample_size"], len(metadata["cardinalities"]))
+        if full_solution_matrix.shape != expected_shape or len(fitness_array) != metadata["sample_size"]:
+            raise Exception(f"The PRef in {folder} does not match its metadata, "
+                            f"the solution matrix has shape {full_solution_matrix.shape}, expected {expected_shape}")
+        if str(full_solution_matrix.dtype) != metadata["dtype"]:
+            raise Exception(f"The PRef in {folder} has dtype {full_solution_matrix.dtype}, "
+                            f"but the metadata says {metadata['dtype']}")
+
+        weights_file = os.path.join(folder, PREF_WEIGHTS_FILE)
+        return cls(full_solution_matrix=full_solution_matrix,
+                   fitness_array=fitness_array,
+                   search_space=SearchSpace(metadata["cardinalities"]),
+                   weights=np.load(weights_file, mmap_mode="r") if os.path.exists(weights_file) else None)
+
+    @classmethod
+    def convert_npz_to_folder(cls, npz_file: str, folder: str):
+        """Converts a PRef saved with save into the format used by open_mmap"""
+        cls.load(npz_file).save_as_folder(folder)
 
 
 
@@ -209,12 +885,47 @@ class PRef:
         elif len(pRefs) == 1:
             return pRefs[0]
         else:
-            fsm = np.vstack(tuple(pRef.full_solution_matrix for pRef in pRefs))
-            fitness_array = np.concatenate([pRef.fitness_array for pRef in pRefs])
-            search_space = pRefs[0].search_space
-            return cls(full_solution_matrix=fsm,
-                       fitness_array = fitness_array,
-                       search_space = search_space)
+            from Core.PRefBuilder import PRefBuilder  # PRefBuilder depends on PRef
+            builder = PRefBuilder(pRefs[0].search_space, initial_capacity=sum(pRef.sample_size for pRef in pRefs))
+            for pRef in pRefs:
+                builder.append_pRef(pRef)
+            result = builder.freeze()
+            result.precomputation_store = pRefs[0].precomputation_store
+            if any(pRef.weights is not None for pRef in pRefs):
+                result.weights = np.concatenate([pRef.get_weights() for pRef in pRefs])
+
+            # if the first PRef has its marginals, they are merged with those of the others rather than recalculated
+            if pRefs[0].cached_marginals is not None:
+                marginals = pRefs[0].cached_marginals.copy()
+                for pRef in pRefs[1:]:
+                    marginals.add_tables_of(pRef.get_marginals())
+                marginals.full_solution_matrix = result.full_solution_matrix
+                marginals.fitness_array = np.asarray(result.fitness_array, dtype=float)
+                marginals.weights = result.weights
+                result.cached_marginals = marginals
+            return result
+
+    def to_shared_memory(self):
+        """
+        Copies the PRef (and the tables of its marginals, if calculated) into shared memory, so that other processes
+        can use PRef.attach(result.name) instead of receiving a pickled copy.
+        The result owns the segments: keep it alive while the workers need them, and close it (or use it with 'with').
+        Start the workers with the "spawn" start method, see the docstring of Core.SharedPRef
+        """
+        from Core.SharedPRef import SharedPRef  # SharedPRef depends on PRef
+        return SharedPRef.create(self)
+
+    @classmethod
+    def attach(cls, name: str):
+        """Returns a read-only PRef which uses the shared memory created by to_shared_memory in another process"""
+        from Core.SharedPRef import SharedPRef
+        return SharedPRef.attach(name).pRef
+
+    def with_extra_rows(self, new_rows: np.ndarray, new_fitnesses: Iterable[Fitness]):
+        """Returns a PRef with the new solutions appended. If the marginals were calculated, they are updated"""
+        return PRef.concat([self, PRef(fitness_array=new_fitnesses,
+                                       full_solution_matrix=new_rows,
+                                       search_space=self.search_space)])
 
 def plot_solutions_in_pRef(pRef: PRef):
     x_points, y_points = utils.unzip(list(enumerate(pRef.fitness_array)))
@@ -222,3 +933,66 @@ def plot_solutions_in_pRef(pRef: PRef):
     plt.plot(x_points, y_points)
     plt.show()
 
+
+def benchmark_observation_engines(pRef: PRef, pss: list[PS]) -> dict:
+    """Compares the time taken to calculate the observations of the given pss using
+    numpy boolean filtering, the bitmap index and the numba kernels at the top of this file.
+    Returns a dictionary of engine name -> seconds taken"""
+    without_index = PRef(fitness_array=pRef.fitness_array,
+                         full_solution_matrix=pRef.full_solution_matrix,
+                         search_space=pRef.search_space)
+    with_index = without_index.with_different_fitnesses(pRef.fitness_array)
+    with utils.announce("Building the bitmap index"):
+        with_index.build_bitmap_index()
+
+    def using_numba_kernel(numba_function) -> Callable:
+        def calculate_observations(ps: PS) -> ArrayOfFloats:
+            return pRef.fitness_array[numba_function(pRef.full_solution_matrix, *pRef.get_fixed_vars_and_vals(ps.values))]
+
+        return calculate_observations
+
+    engines = {"numpy": lambda ps: get_fitnesses_by_boolean_filtering(pRef.full_solution_matrix,
+                                                                      pRef.fitness_array,
+                                                                      ps.values),
+               "bitmap": with_index.fitnesses_of_observations,
+               "numba_mask": using_numba_kernel(get_matching_mask),
+               "numba_row_ids": using_numba_kernel(get_matching_row_ids)}
+
+    # the results are checked against numpy, which also makes sure the numba functions are compiled beforehand
+    control_results = [engines["numpy"](ps) for ps in pss]
+    for engine_name, engine in engines.items():
+        for ps, control in zip(pss, control_results):
+            if not np.array_equal(np.sort(engine(ps)), np.sort(control)):
+                raise Exception(f"The engine {engine_name} returned the wrong observations for {ps}")
+
+    times = {}
+    for engine_name, engine in engines.items():
+        with utils.execution_time() as timer:
+            for ps in pss:
+                engine(ps)
+        times[engine_name] = timer.execution_time
+        print(f"{engine_name}: {timer.execution_time:.4f} seconds for {len(pss)} PSs")
+    return times
+
+
+def benchmark_matching_kernel_by_order(pRef: PRef, orders: Iterable[int] = range(1, 21), pss_per_order: int = 100) -> dict:
+    """Compares numpy boolean filtering with get_matching_row_ids on random PSs of each order (amount of fixed vars),
+    which is used to decide NUMBA_MATCHING_THRESHOLD.
+    Returns a dictionary of order -> (seconds taken by numpy, seconds taken by numba)"""
+    # compiles the kernel beforehand
+    get_matching_row_ids(pRef.full_solution_matrix, *pRef.get_fixed_vars_and_vals(PS.empty(pRef.search_space).values))
+
+    times = {}
+    for order in orders:
+        if order > pRef.search_space.amount_of_parameters:
+            break
+        pss = [PS.random_with_fixed_size(pRef.search_space, order) for _ in range(pss_per_order)]
+        with utils.execution_time() as numpy_timer:
+            for ps in pss:
+                get_fitnesses_by_boolean_filtering(pRef.full_solution_matrix, pRef.fitness_array, ps.values)
+        with utils.execution_time() as numba_timer:
+            for ps in pss:
+                pRef.fitness_array[get_matching_row_ids(pRef.full_solution_matrix, *pRef.get_fixed_vars_and_vals(ps.values))]
+        times[order] = (numpy_timer.execution_time, numba_timer.execution_time)
+        print(f"order {order}: numpy = {numpy_timer.execution_time:.4f}s, numba = {numba_timer.execution_time:.4f}s")
+    return times
@@ -0,0 +1,92 @@
+"""
+Builds a PRef by appending solutions to it, without keeping lists of solutions or copying everything repeatedly.
+
+The rows are written into a preallocated matrix (and fitness array), whose capacity is doubled when it runs out.
+The buffers are grown and trimmed with ndarray.resize, which reallocates them in place when possible
+(for large arrays, the allocator usually remaps the pages rather than copying them),
+so the peak memory stays close to the final size of the PRef. freeze() hands the buffers over to the PRef.
+"""
+from typing import Iterable
+
+import numpy as np
+
+from Core.EvaluatedFS import EvaluatedFS
+from Core.FullSolution import FullSolution
+from Core.PRef import PRef
+from Core.SearchSpace import SearchSpace
+from Core.custom_types import Fitness
+
+
+class PRefBuilder:
+    search_space: SearchSpace
+    full_solution_matrix: np.ndarray  # only the first amount_of_rows rows are used
+    fitness_array: np.ndarray
+    amount_of_rows: int
+
+    def __init__(self, search_space: SearchSpace, initial_capacity: int = 1024):
+        self.search_space = search_space
+        self.full_solution_matrix = np.zeros((max(initial_capacity, 1), search_space.amount_of_parameters),
+                                             dtype=search_space.compact_dtype)
+        self.fitness_array = np.zeros(max(initial_capacity, 1), dtype=float)
+        self.amount_of_rows = 0
+
+    def __repr__(self):
+        return f"PRefBuilder({self.amount_of_rows} rows, capacity = {self.capacity})"
+
+    def __len__(self):
+        return self.amount_of_rows
+
+    @property
+    def capacity(self) -> int:
+        return self.full_solution_matrix.shape[0]
+
+    def resize_buffers(self, capacity: int):
+        # refcheck is disabled because the buffers are never exposed before freeze()
+        self.full_solution_matrix.resize((capacity, self.search_space.amount_of_parameters), refcheck=False)
+        self.fitness_array.resize(capacity, refcheck=False)
+
+    def reserve(self, required_capacity: int):
+        """makes sure that there is space for required_capacity rows, at least doubling the capacity when it grows"""
+        if required_capacity > self.capacity:
+            self.resize_buffers(max(required_capacity, 2 * self.capacity))
+
+    def append_rows(self, rows: np.ndarray, fitnesses: Iterable[Fitness]):
+        rows = np.asarray(rows).reshape((-1, self.search_space.amount_of_parameters))
+        fitnesses = np.asarray(fitnesses, dtype=float).reshape(-1)
+        if len(rows) != len(fitnesses):
+            raise ValueError(f"Received {len(rows)} rows but {len(fitnesses)} fitnesses")
+
+        new_amount_of_rows = self.amount_of_rows + len(rows)
+        self.reserve(new_amount_of_rows)
+        self.full_solution_matrix[self.amount_of_rows:new_amount_of_rows] = rows
+        self.fitness_array[self.amount_of_rows:new_amount_of_rows] = fitnesses
+        self.amount_of_rows = new_amount_of_rows
+
+    def append_solution(self, full_solution: FullSolution, fitness: Fitness):
+        self.reserve(self.amount_of_rows + 1)
+        self.full_solution_matrix[self.amount_of_rows] = full_solution.values
+        self.fitness_array[self.amount_of_rows] = fitness
+        self.amount_of_rows += 1
+
+    def append_evaluated_solutions(self, evaluated_fss: Iterable[EvaluatedFS]):
+        for e_fs in evaluated_fss:
+            self.append_solution(e_fs.full_solution, e_fs.fitness)
+
+    def append_pRef(self, pRef: PRef):
+        self.append_rows(pRef.full_solution_matrix, pRef.fitness_array)
+
+    def freeze(self) -> PRef:
+        """
+        Returns the PRef containing the appended rows, which uses the buffers of the builder (trimmed, not copied).
+        The builder is then empty, and can be reused.
+        """
+        self.resize_buffers(self.amount_of_rows)
+        result = PRef(fitness_array=self.fitness_array,
+                      full_solution_matrix=self.full_solution_matrix,
+                      search_space=self.search_space)
+
+        self.full_solution_matrix = np.zeros((1, self.search_space.amount_of_parameters),
+                                             dtype=self.search_space.compact_dtype)
+        self.fitness_array = np.zeros(1, dtype=float)
+        self.amount_of_rows = 0
+        return result
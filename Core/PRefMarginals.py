@@ -0,0 +1,219 @@
+"""
+The univariate and bivariate sufficient statistics of a PRef.
+
+Many metrics need, for every (var, val) and every (var_a, val_a, var_b, val_b),
+the amount of observations, the sum of their fitnesses and the sum of their squared fitnesses.
+Instead of querying the PRef for each of those trivial PSs, they are all calculated in a single pass here.
+
+The tables are indexed using the hot encoding of the search space, ie (var, val) -> precomputed_offsets[var] + val,
+so the bivariate tables are hot_encoded_length x hot_encoded_length matrices.
+"""
+import copy
+from typing import Optional
+
+import numpy as np
+
+from Core.SearchSpace import SearchSpace
+from Core.custom_types import ArrayOfFloats, ArrayOfInts
+
+
+def get_hot_encoded_codes(full_solution_matrix: np.ndarray, search_space: SearchSpace) -> ArrayOfInts:
+    """replaces each value with its index in the hot encoding, ie var, val -> precomputed_offsets[var] + val"""
+    return full_solution_matrix + search_space.precomputed_offsets[:-1].astype(np.int64)
+
+
+def get_weighted_cooccurrences(full_solution_matrix: np.ndarray,
+                               search_space: SearchSpace,
+                               many_row_weights: list[ArrayOfFloats],
+                               max_chunk_cells: int = 2 ** 22) -> list[np.ndarray]:
+    """
+    For each of the given row weights, calculates the hot_encoded_length x hot_encoded_length matrix where
+    [i, j] = the sum of the weights of the rows which have both i and j (in their hot encoding).
+    This is done as a product of one-hot matrices, processing the rows in chunks to keep the memory bounded
+    """
+    hot_encoded_length = search_space.hot_encoded_length
+    results = [np.zeros((hot_encoded_length, hot_encoded_length), dtype=float) for _ in many_row_weights]
+    chunk_size = max(1, max_chunk_cells // max(hot_encoded_length, 1))
+    for start in range(0, full_solution_matrix.shape[0], chunk_size):
+        chunk_codes = get_hot_encoded_codes(full_solution_matrix[start:start + chunk_size], search_space)
+        one_hot = np.zeros((len(chunk_codes), hot_encoded_length), dtype=float)
+        one_hot[np.arange(len(chunk_codes))[:, np.newaxis], chunk_codes] = 1.0
+        for result, row_weights in zip(results, many_row_weights):
+            result += one_hot.T @ (one_hot * row_weights[start:start + chunk_size, np.newaxis])
+    return results
+
+
+def get_weighted_value_counts(full_solution_matrix: np.ndarray,
+                              search_space: SearchSpace,
+                              row_weights: Optional[ArrayOfFloats]) -> ArrayOfFloats:
+    """the hot encoded array where [i] = the sum of the weights of the rows which have i (in their hot encoding)"""
+    return np.concatenate([np.bincount(full_solution_matrix[:, var], weights=row_weights, minlength=cardinality)
+                           for var, cardinality in enumerate(search_space.cardinalities)]).astype(float)
+
+
+class PRefMarginals:
+    search_space: SearchSpace
+    full_solution_matrix: np.ndarray
+    fitness_array: ArrayOfFloats
+    weights: Optional[ArrayOfFloats]  # the multiplicity of each row, as in PRef.weights
+
+    univariate_counts: ArrayOfFloats
+    univariate_sums: ArrayOfFloats
+    univariate_sums_of_squares: ArrayOfFloats
+
+    # these are only calculated when they are first needed, since they are much larger
+    bivariate_counts: Optional[np.ndarray]
+    bivariate_sums: Optional[np.ndarray]
+    bivariate_sums_of_squares: Optional[np.ndarray]
+
+    # the rows added by update, which are only appended to full_solution_matrix when the rows are needed again
+    pending_rows: list[np.ndarray]
+    pending_fitnesses: list[ArrayOfFloats]
+
+    def __init__(self,
+                 full_solution_matrix: np.ndarray,
+                 fitness_array: ArrayOfFloats,
+                 search_space: SearchSpace,
+                 weights: Optional[ArrayOfFloats] = None):
+        self.search_space = search_space
+        self.full_solution_matrix = full_solution_matrix
+        self.fitness_array = np.asarray(fitness_array, dtype=float)
+        self.weights = None if weights is None else np.asarray(weights, dtype=float)
+
+        self.univariate_counts = get_weighted_value_counts(full_solution_matrix, search_space, self.weights)
+        self.univariate_sums = get_weighted_value_counts(full_solution_matrix,
+                                                         search_space,
+                                                         self.get_weights() * self.fitness_array)
+        self.univariate_sums_of_squares = get_weighted_value_counts(full_solution_matrix,
+                                                                    search_space,
+                                                                    self.get_weights() * np.square(self.fitness_array))
+
+        self.bivariate_counts = None
+        self.bivariate_sums = None
+        self.bivariate_sums_of_squares = None
+        self.pending_rows = []
+        self.pending_fitnesses = []
+
+    @classmethod
+    def from_tables(cls,
+                    full_solution_matrix: np.ndarray,
+                    fitness_array: ArrayOfFloats,
+                    search_space: SearchSpace,
+                    tables: dict[str, Optional[np.ndarray]],
+                    weights: Optional[ArrayOfFloats] = None):
+        """uses tables which were already calculated (eg in another process), the keys are the names of the attributes"""
+        result = cls.__new__(cls)
+        result.search_space = search_space
+        result.full_solution_matrix = full_solution_matrix
+        result.fitness_array = np.asarray(fitness_array, dtype=float)
+        result.weights = weights
+        for name in ["univariate_counts", "univariate_sums", "univariate_sums_of_squares",
+                     "bivariate_counts", "bivariate_sums", "bivariate_sums_of_squares"]:
+            setattr(result, name, tables.get(name))
+        result.pending_rows = []
+        result.pending_fitnesses = []
+        return result
+
+    def __repr__(self):
+        return f"PRefMarginals({self.search_space}, {self.sample_size} samples)"
+
+    @property
+    def sample_size(self) -> int:
+        return len(self.fitness_array) + sum(len(fitnesses) for fitnesses in self.pending_fitnesses)
+
+    def get_weights(self) -> ArrayOfFloats:
+        return np.ones_like(self.fitness_array) if self.weights is None else self.weights
+
+    def copy(self):
+        """the tables are copied, while the solutions and the fitnesses are shared"""
+        result = copy.copy(self)
+        result.pending_rows = list(self.pending_rows)
+        result.pending_fitnesses = list(self.pending_fitnesses)
+        for name in ["univariate_counts", "univariate_sums", "univariate_sums_of_squares",
+                     "bivariate_counts", "bivariate_sums", "bivariate_sums_of_squares"]:
+            table = getattr(self, name)
+            setattr(result, name, None if table is None else table.copy())
+        return result
+
+    def add_tables_of(self, other):
+        """
+        Adds the tables of other (calculated on other rows) to these, since they are all counts and sums.
+        Note that this only changes the tables, the caller is responsible for the solutions and the fitnesses
+        """
+        self.univariate_counts += other.univariate_counts
+        self.univariate_sums += other.univariate_sums
+        self.univariate_sums_of_squares += other.univariate_sums_of_squares
+        if self.bivariate_counts is not None:
+            other.calculate_bivariate_tables()
+            self.bivariate_counts += other.bivariate_counts
+            self.bivariate_sums += other.bivariate_sums
+            self.bivariate_sums_of_squares += other.bivariate_sums_of_squares
+
+    def update(self, new_rows: np.ndarray, new_fitnesses: ArrayOfFloats):
+        """
+        Includes the new rows in the tables, which only requires going through the new rows.
+        The rows are kept aside rather than appended to the matrix, which would copy it,
+        so that they are only merged if the rows are needed again (see merge_pending_rows)
+        """
+        new_rows = np.asarray(new_rows)
+        new_fitnesses = np.asarray(new_fitnesses, dtype=float)
+        self.add_tables_of(PRefMarginals(new_rows, new_fitnesses, self.search_space))
+        self.pending_rows.append(new_rows)
+        self.pending_fitnesses.append(new_fitnesses)
+
+    def merge_pending_rows(self):
+        """appends the rows added by update to the solutions, the fitnesses and the weights (as 1 each)"""
+        if len(self.pending_rows) == 0:
+            return
+        amount_of_pending = sum(len(fitnesses) for fitnesses in self.pending_fitnesses)
+        self.full_solution_matrix = np.vstack([self.full_solution_matrix] + self.pending_rows)
+        self.fitness_array = np.concatenate([self.fitness_array] + self.pending_fitnesses)
+        if self.weights is not None:
+            self.weights = np.concatenate((self.weights, np.ones(amount_of_pending)))
+        self.pending_rows = []
+        self.pending_fitnesses = []
+
+    def get_mean_fitness(self) -> float:
+        """the (weighted) mean fitness of the rows, from the tables of the first variable"""
+        end = self.search_space.precomputed_offsets[1]
+        return float(np.sum(self.univariate_sums[:end]) / np.sum(self.univariate_counts[:end]))
+
+    def calculate_bivariate_tables(self):
+        if self.bivariate_counts is not None:
+            return
+        self.merge_pending_rows()
+        (self.bivariate_counts,
+         self.bivariate_sums,
+         self.bivariate_sums_of_squares) = get_weighted_cooccurrences(self.full_solution_matrix,
+                                                                      self.search_space,
+                                                                      [self.get_weights(),
+                                                                       self.get_weights() * self.fitness_array,
+                                                                       self.get_weights() * np.square(self.fitness_array)])
+
+    @staticmethod
+    def means_from_counts_and_sums(counts: np.ndarray, sums: np.ndarray) -> np.ndarray:
+        """the means are nan where there are no observations, as np.average would give (without the warning)"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(counts > 0, sums / counts, np.nan)
+
+    def get_univariate_means(self) -> ArrayOfFloats:
+        return self.means_from_counts_and_sums(self.univariate_counts, self.univariate_sums)
+
+    def get_bivariate_means(self) -> np.ndarray:
+        self.calculate_bivariate_tables()
+        return self.means_from_counts_and_sums(self.bivariate_counts, self.bivariate_sums)
+
+    def get_univariate_block(self, hot_encoded_array: np.ndarray, var: int) -> np.ndarray:
+        """returns the entries for var, indexed by val"""
+        offsets = self.search_space.precomputed_offsets
+        return hot_encoded_array[offsets[var]:offsets[var + 1]]
+
+    def get_bivariate_block(self, hot_encoded_matrix: np.ndarray, var_a: int, var_b: int) -> np.ndarray:
+        """returns the entries for var_a, var_b, indexed by [val_a, val_b]"""
+        offsets = self.search_space.precomputed_offsets
+        return hot_encoded_matrix[offsets[var_a]:offsets[var_a + 1], offsets[var_b]:offsets[var_b + 1]]
+
+    def per_variable(self, hot_encoded_array: np.ndarray) -> list[ArrayOfFloats]:
+        """converts a hot encoded array into a list with an array for each variable"""
+        return [self.get_univariate_block(hot_encoded_array, var)
+                for var in range(self.search_space.amount_of_parameters)]
@@ -1,14 +1,36 @@
-import itertools
-import random
-from typing import Optional
+from typing import Optional, Union
 
 import numpy as np
+from numba import njit
 
 import utils
 from Core.PRef import PRef
+from Core.PRefMarginals import get_weighted_value_counts, get_weighted_cooccurrences
 from Core.PS import PS, STAR
+from Core.PSMetric.Linkage import Linkage, aggregate_linkages_of_fixed_pairs, get_linkages_of_fixed_pairs
+from Core.PSMetric.SparseLinkageTable import SparseLinkageTable
 from Core.PSMetric.Metric import Metric
-from Core.custom_types import ArrayOfFloats
+from Core.custom_types import ArrayOfFloats, ArrayOfInts
+
+
+@njit
+def get_hot_encoded_stats_within_rows(fs_matrix: np.ndarray,
+                                      fitnesses: ArrayOfFloats,
+                                      weights: Optional[ArrayOfFloats],
+                                      row_ids: ArrayOfInts,
+                                      offsets: ArrayOfInts) -> (ArrayOfFloats, ArrayOfFloats):
+    """the counts and the fitness sums of each (var, val), hot encoded, only counting the given rows
+    (each as weights[row] observations, when weights is not None)"""
+    counts = np.zeros(offsets[-1], dtype=np.float64)
+    sums = np.zeros(offsets[-1], dtype=np.float64)
+    for row in row_ids:
+        weight = 1.0 if weights is None else weights[row]
+        fitness = fitnesses[row]
+        for var in range(fs_matrix.shape[1]):
+            code = offsets[var] + fs_matrix[row, var]
+            counts[code] += weight
+            sums[code] += weight * fitness
+    return counts, sums
 
 
 class Additivity(Metric):
@@ -27,15 +49,14 @@ class Additivity(Metric):
             return f"Additivity({self.which})"
 
     def get_fitnesses_split_by_error(self, ps: PS) -> (float, float, float):
-        fixed_vars = ps.get_fixed_variable_positions()
-        relevant_rows_in_pRef = self.pRef.full_solution_matrix[:, fixed_vars]
-        correct_values = ps.values[fixed_vars]
-        error_counts = np.sum(relevant_rows_in_pRef != correct_values, axis=1)
+        count, total, counts_with_one, sums_with_one, counts_with_two, sums_with_two = self.pRef.hamming_ball_stats(ps)
 
-        def mean_with_amount_of_errors(error_count: int) -> np.ndarray:
-            return np.mean(self.pRef.fitness_array[error_counts == error_count])
+        def mean_or_nan(amount: int, sum_of_fitnesses: float) -> float:
+            return sum_of_fitnesses / amount if amount > 0 else np.nan  # as np.mean would give
 
-        return mean_with_amount_of_errors(0), mean_with_amount_of_errors(1), mean_with_amount_of_errors(2)
+        return (mean_or_nan(count, total),
+                mean_or_nan(np.sum(counts_with_one), np.sum(sums_with_one)),
+                mean_or_nan(np.sum(counts_with_two), np.sum(sums_with_two)))
 
 
     def get_single_score(self, ps: PS) -> float:
@@ -106,6 +127,7 @@ class MeanError(Metric):
 class Influence(Metric):
     pRef: Optional[PRef]
     trivial_means: Optional[list[list[float]]]
+    hot_encoded_trivial_means: Optional[ArrayOfFloats]
     overall_mean: Optional[float]
 
     def __init__(self):
@@ -124,51 +146,60 @@ class Influence(Metric):
             return np.average(fitnesses)
 
     def calculate_trivial_means(self) -> list[list[float]]:
-        def value_for_combination(var, val) -> float:
-            ps = PS.empty(self.pRef.search_space).with_fixed_value(var, val)
-            return self.mf(ps)
-        return [[value_for_combination(var, val)
-                 for val in range(self.pRef.search_space.cardinalities[var])]
-                for var in range(self.pRef.search_space.amount_of_parameters)]
+        """Requires self.overall_mean, which is used when there are no observations (as in self.mf)"""
+        marginals = self.pRef.get_marginals()
+        means = np.where(marginals.univariate_counts > 0, marginals.get_univariate_means(), self.overall_mean)
+        return [var_means.tolist() for var_means in marginals.per_variable(means)]
 
     def set_pRef(self, pRef: PRef):
         self.pRef = pRef
-        self.overall_mean = np.average(pRef.fitness_array)
+        self.overall_mean = pRef.mean_fitness()
         self.trivial_means = self.calculate_trivial_means()
-
+        self.hot_encoded_trivial_means = np.concatenate(self.trivial_means)
+
+
+    def get_specialisation_means(self, ps: PS) -> ArrayOfFloats:
+        """
+        Hot encoded, the mf of ps.with_fixed_value(var, val) for every unfixed var (the other entries are meaningless).
+        They are all obtained by counting the values of the columns within the observations of ps
+        """
+        rows = self.pRef.rows_of_observations(ps)
+        row_ids = np.flatnonzero(rows) if rows.dtype == bool else rows
+        counts, sums = get_hot_encoded_stats_within_rows(self.pRef.full_solution_matrix,
+                                                         np.asarray(self.pRef.fitness_array, dtype=float),
+                                                         self.pRef.weights,
+                                                         row_ids,
+                                                         self.pRef.search_space.precomputed_offsets.astype(np.int64))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(counts > 0, sums / counts, self.overall_mean)
 
     def get_external_internal_influence(self, ps: PS) -> (float, float):
-        empty_ps = PS.empty(search_space= self.pRef.search_space)
-        empty_ps_mf = self.mf(empty_ps)
-        ps_mf = self.mf(ps)
-
         if ps.is_empty():
             return (100, 0)
         if ps.is_fully_fixed():
             return (100,0)
 
-        def absence_influence_for_var_val(var: int, val: int) -> int:
-            trivial_mf = self.trivial_means[var][val]
-            ps_with_trivial_mf = self.mf(ps.with_fixed_value(var, val))
-            effect_on_empty = trivial_mf - empty_ps_mf
-            effect_on_ps = ps_with_trivial_mf - ps_mf
-            return np.abs(effect_on_ps - effect_on_empty)
-        def absence_influence_for_var(var: int) -> float:
-            influences = [absence_influence_for_var_val(var, val)
-                          for val in range(self.pRef.search_space.cardinalities[var])]
-            return np.max(influences)
-
-        def presence_influence_for_var(var: int) -> int:
-            trivial_mf = self.trivial_means[var][ps[var]]
-            without_trivial_mf = self.mf(ps.with_unfixed_value(var))
-            effect_on_empty = trivial_mf - empty_ps_mf
-            effect_on_ps = ps_mf - without_trivial_mf
-            return np.abs(effect_on_ps - effect_on_empty)
-
-
-        unfixed_vars = [index for index, value in enumerate(ps.values) if value == STAR]
-        absence_influences = np.array([absence_influence_for_var(var) for var in unfixed_vars])
-        presence_influences = np.array([presence_influence_for_var(var) for var in ps.get_fixed_variable_positions()])
+        empty_ps_mf = self.overall_mean  # the empty ps matches every row
+        fixed_vars = np.array(ps.get_fixed_variable_positions(), dtype=int)
+        unfixed_vars = np.flatnonzero(ps.values == STAR)
+
+        # the simplifications come from the leave one out kernel
+        count, total, simplification_counts, simplification_sums = self.pRef.leave_one_out_stats(ps)
+        ps_mf = total / count if count > 0 else self.overall_mean
+        with np.errstate(divide="ignore", invalid="ignore"):
+            without_trivial_mf = np.where(simplification_counts > 0,
+                                          simplification_sums / simplification_counts,
+                                          self.overall_mean)
+
+        # absence influences, the max over the values of each unfixed var
+        effect_on_empty = self.hot_encoded_trivial_means - empty_ps_mf
+        effect_on_ps = self.get_specialisation_means(ps) - ps_mf
+        influences = np.abs(effect_on_ps - effect_on_empty)
+        absence_influences = np.maximum.reduceat(influences, self.pRef.search_space.precomputed_offsets[:-1])[unfixed_vars]
+
+        # presence influences, for each fixed var
+        trivial_mf = self.hot_encoded_trivial_means[self.pRef.search_space.precomputed_offsets[fixed_vars] + ps.values[fixed_vars]]
+        presence_influences = np.abs((ps_mf - without_trivial_mf) - (trivial_mf - empty_ps_mf))
 
         presence_score = np.average(presence_influences)
         absence_score = np.average(absence_influences)
@@ -186,119 +217,144 @@ class Influence(Metric):
 def sort_by_influence(pss: list[PS], pRef: PRef) -> list[PS]:
     evaluator = Influence()
     evaluator.set_pRef(pRef)
-    return sorted(pss, key=lambda x:evaluator.get_single_score(x), reverse=True)
+    scores = evaluator.get_scores_batch(np.array([ps.values for ps in pss]))
+    return [pss[index] for index in np.argsort(-scores, kind="stable")]
 
 
 class MutualInformation(Metric):
-    sorted_pRef: Optional[PRef]
+    """
+    The linkage between two variables is the mutual information between them,
+    in the distribution obtained by applying binary tournament selection to the PRef.
+    """
+    pRef: Optional[PRef]
+    exact: bool  # if False, the selection distribution is estimated by sampling tournaments
+    amount_of_samples: Optional[int]  # only used when not exact, defaults to the sample size of the PRef
 
-    univariate_probability_table: Optional[list]
-    bivariate_probability_table: Optional[list]
+    row_weights: Optional[ArrayOfFloats]  # the probability of each row of the PRef being selected
+    univariate_probability_table: Optional[ArrayOfFloats]  # hot encoded, as in PRefMarginals
+    bivariate_probability_table: Optional[np.ndarray]  # hot encoded, as in PRefMarginals
 
-    linkage_table: Optional[np.ndarray]
+    linkage_table: Optional[Union[np.ndarray, SparseLinkageTable]]
+    top_k: Optional[int]  # when set, the linkage table is sparse, and only keeps the top_k partners of each variable
 
-    def __init__(self):
+    def __init__(self, exact: bool = True, amount_of_samples: Optional[int] = None, top_k: Optional[int] = None):
         super().__init__()
-        self.sorted_pRef = None
+        self.pRef = None
+        self.exact = exact
+        self.amount_of_samples = amount_of_samples
+        self.top_k = top_k
+        self.row_weights = None
         self.univariate_probability_table = None
         self.bivariate_probability_table = None
         self.linkage_table = None
 
     def __repr__(self):
-        return "MutualInformation"#
-
+        return "MutualInformation"
 
+    @classmethod
+    def get_ranks(cls, pRef: PRef) -> ArrayOfInts:
+        """the position of each row when sorted by decreasing fitness (ties keep their original order)"""
+        order = np.argsort(-np.asarray(pRef.fitness_array), kind="stable")
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(len(order))
+        return ranks
 
     @classmethod
-    def get_sorted_pRef(cls, pRef: PRef) -> PRef:
-        indexed_fitnesses = list(enumerate(pRef.fitness_array))
-        indexed_fitnesses.sort(key=utils.second, reverse=True)
-        indexes, fitnesses = utils.unzip(indexed_fitnesses)
+    def get_tournament_selection_probabilities(cls, sample_size: int) -> ArrayOfFloats:
+        """
+        In a binary tournament (with replacement) the winner is the best of the two picks,
+        so the probability of selecting the solution with rank r is P(min(pick_1, pick_2) = r) = (2(n-r) - 1) / n^2
+        """
+        ranks = np.arange(sample_size)
+        return (2 * (sample_size - ranks) - 1) / (sample_size ** 2)
+
+    def get_row_weights(self, pRef: PRef) -> ArrayOfFloats:
+        """
+        The probability of each row being selected. When the PRef is weighted, a row with weight w occupies an interval
+        of length w in the ranks (for integer weights, w consecutive ranks as in pRef.expand()),
+        and its probability is that of the winner's rank being in that interval, which also works for fractional weights
+        """
+        if pRef.weights is None:
+            ranks = self.get_ranks(pRef)
+            if self.exact:
+                return self.get_tournament_selection_probabilities(pRef.sample_size)[ranks]
+
+            amount_of_samples = pRef.sample_size if self.amount_of_samples is None else self.amount_of_samples
+            winner_ranks = np.min(np.random.randint(pRef.sample_size, size=(amount_of_samples, 2)), axis=1)
+            times_selected_per_rank = np.bincount(winner_ranks, minlength=pRef.sample_size)
+            return times_selected_per_rank[ranks] / amount_of_samples
+
+        order = np.argsort(-np.asarray(pRef.fitness_array), kind="stable")
+        weights = pRef.get_weights()[order]
+        interval_ends = np.cumsum(weights)
+        interval_starts = interval_ends - weights
+        total_weight = interval_ends[-1]
+        if self.exact:
+            # P(min(pick_1, pick_2) >= x) = (1 - x / total_weight)^2, which for integer weights sums the ranks above
+            probabilities = (np.square(total_weight - interval_starts)
+                             - np.square(total_weight - interval_ends)) / (total_weight ** 2)
+        else:
+            amount_of_samples = int(round(total_weight)) if self.amount_of_samples is None else self.amount_of_samples
+            winner_positions = np.min(np.random.uniform(0, total_weight, size=(amount_of_samples, 2)), axis=1)
+            winner_rows = np.minimum(np.searchsorted(interval_ends, winner_positions, side="right"), pRef.sample_size - 1)
+            probabilities = np.bincount(winner_rows, minlength=pRef.sample_size) / amount_of_samples
+
+        row_weights = np.empty(pRef.sample_size, dtype=float)
+        row_weights[order] = probabilities
+        return row_weights
 
-        new_matrix = pRef.full_solution_matrix[indexes]
-        return PRef(fitnesses, new_matrix, search_space=pRef.search_space)
     def set_pRef(self, pRef: PRef):
-        self.sorted_pRef = self.get_sorted_pRef(pRef)
+        self.pRef = pRef
+        self.row_weights = self.get_row_weights(pRef)
 
         self.univariate_probability_table, self.bivariate_probability_table = self.calculate_probability_tables()
         self.linkage_table = self.get_linkage_table()
-
-    def calculate_probability_tables(self) -> (list, list):
-        indexes = list(range(len(self.sorted_pRef.fitness_array)))
-        def tournament_selection(tournament_size: int) -> np.ndarray:
-            picks = random.choices(indexes, k=tournament_size)
-            winner_index = min(picks)
-            return self.sorted_pRef.full_solution_matrix[winner_index]
-
-
-        univariate_counts = [np.zeros(card) for card in self.sorted_pRef.search_space.cardinalities]
-        cs = self.sorted_pRef.search_space.cardinalities
-        bivariate_count_table = [[np.zeros((c2, c1), dtype=int)
-                                  for c1 in cs]
-                                 for c2 in cs]
-        def register_solution_for_univariate(solution: np.ndarray):
-            for var, value in enumerate(solution):
-                univariate_counts[var][value] += 1
-
-
-        def register_solution_for_bivariate(solution: np.ndarray):
-            for var_a, value_a in enumerate(solution):
-                for var_b in range(var_a+1, len(solution)):
-                    value_b = solution[var_b]
-                    bivariate_count_table[var_a][var_b][value_a, value_b] += 1
-
-
-        amount_of_samples = len(self.sorted_pRef.fitness_array)
-        for sample_number in range(amount_of_samples):
-            sample = tournament_selection(2)
-            register_solution_for_univariate(sample)
-            register_solution_for_bivariate(sample)
-            if sample_number%(amount_of_samples // 100) == 0:
-                print(f"MI data gathering progress: {100*sample_number/amount_of_samples:.2f}%")
-
-        def counts_to_probabilities(counts: np.ndarray):
-            """ used for both arrays and matrices"""
-            return (counts / np.sum(counts))
-
-
-        univariate_probabilities = [counts_to_probabilities(var_counts) for var_counts in univariate_counts]
-        bivariate_probabilities = [[counts_to_probabilities(bivariate_count_table[var_a][var_b]) if var_b > var_a else None
-                                    for var_b in range(len(cs))]
-                                   for var_a in range(len(cs))]
+        if self.top_k is not None:
+            self.linkage_table = SparseLinkageTable.from_dense(self.linkage_table, self.top_k, include_diagonal=False)
+
+    def update(self, new_rows: np.ndarray, new_fitnesses: ArrayOfFloats):
+        """The row weights depend on the ranks of the fitnesses in the whole PRef, which the new rows can change,
+        so the tables are recalculated from zero"""
+        self.set_pRef(self.pRef.with_extra_rows(new_rows, new_fitnesses))
+
+    def calculate_probability_tables(self) -> (ArrayOfFloats, np.ndarray):
+        """the probability of each value and of each pair of values in the selected solutions"""
+        univariate_probabilities = get_weighted_value_counts(self.pRef.full_solution_matrix,
+                                                             self.pRef.search_space,
+                                                             self.row_weights)
+        [bivariate_probabilities] = get_weighted_cooccurrences(self.pRef.full_solution_matrix,
+                                                               self.pRef.search_space,
+                                                               [self.row_weights])
         return univariate_probabilities, bivariate_probabilities
 
-    def get_linkage_between_vars(self, var_a:int, var_b:int) -> float:
-
-        def mutual_information(value_a: int, value_b: int) -> float:
-            p_a = self.univariate_probability_table[var_a][value_a]
-            p_b = self.univariate_probability_table[var_b][value_b]
-
-            p_a_b = self.bivariate_probability_table[var_a][var_b][value_a, value_b]
-            return p_a_b * np.log(p_a_b/(p_a * p_b))
-
+    def get_mutual_information_addends(self) -> np.ndarray:
+        """hot encoded, where the pairs of values which are never selected contribute 0 (ie 0 log 0 = 0)"""
+        p_a = self.univariate_probability_table[:, np.newaxis]
+        p_b = self.univariate_probability_table[np.newaxis, :]
+        p_a_b = self.bivariate_probability_table
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(p_a_b > 0, p_a_b * np.log(p_a_b / (p_a * p_b)), 0.0)
 
-        ss = self.sorted_pRef.search_space
-        return sum(mutual_information(value_a, value_b)
-                   for value_a in range(ss.cardinalities[var_a])
-                   for value_b in range(ss.cardinalities[var_b]))
+    def get_linkage_between_vars(self, var_a: int, var_b: int) -> float:
+        offsets = self.pRef.search_space.precomputed_offsets
+        addends = self.get_mutual_information_addends()
+        return float(np.sum(addends[offsets[var_a]:offsets[var_a + 1], offsets[var_b]:offsets[var_b + 1]]))
 
     def get_linkage_table(self) -> np.ndarray:
-        param_count = self.sorted_pRef.search_space.amount_of_parameters
-        table = np.zeros((param_count, param_count), dtype=float)
-        for var_a in range(param_count):
-            for var_b in range(var_a+1, param_count):
-                table[var_a][var_b] = self.get_linkage_between_vars(var_a, var_b)
-
-        table += table.T
-
+        table = Linkage.sum_within_blocks(self.get_mutual_information_addends(),
+                                          self.pRef.search_space.precomputed_offsets)
+        np.fill_diagonal(table, 0)
         return table
 
-    def get_linkages_in_ps(self, ps: PS) -> list[float]:
-        fixed_vars = ps.get_fixed_variable_positions()
-        return [self.linkage_table[var_a, var_b] for var_a, var_b in itertools.combinations(fixed_vars, r=2)]
+    def get_linkages_in_ps(self, ps: PS) -> ArrayOfFloats:
+        return get_linkages_of_fixed_pairs(self.linkage_table, ps.values)
 
     def get_single_score(self, ps: PS) -> float:
         linkages = self.get_linkages_in_ps(ps)
         if len(linkages) == 0:
             return 0
-        return np.median(linkages)
\ No newline at end of file
+        return np.median(linkages)
+
+    def get_scores_batch(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        medians, amounts_of_pairs = aggregate_linkages_of_fixed_pairs(ps_matrix, self.linkage_table, np.nanmedian)
+        return np.where(amounts_of_pairs > 0, medians, 0)
\ No newline at end of file
@@ -37,32 +37,26 @@ class Atomicity(Metric):
     def get_normalised_pRef(pRef: PRef) -> PRef:
         min_fitness = np.min(pRef.fitness_array)
         normalised_fitnesses = pRef.fitness_array - min_fitness
-        sum_fitness = np.sum(normalised_fitnesses, dtype=float)
+        sum_fitness = np.sum(normalised_fitnesses * pRef.get_weights(), dtype=float)
 
         if sum_fitness == 0:
             raise Exception(f"The sum of fitnesses for {pRef} is 0, could not normalise")
 
         normalised_fitnesses /= sum_fitness
 
-        return PRef(fitness_array=normalised_fitnesses,  # this is the only thing that changes
-                    full_solution_matrix=pRef.full_solution_matrix,
-                    search_space=pRef.search_space)
+        return pRef.with_different_fitnesses(normalised_fitnesses)  # this is the only thing that changes
 
     def get_benefit(self, ps: PS) -> float:
-        return float(np.sum(self.normalised_pRef.fitnesses_of_observations(ps)))
+        fitnesses, weights = self.normalised_pRef.fitnesses_and_weights_of_observations(ps)
+        return float(np.sum(fitnesses * weights))
 
     def get_global_isolated_benefits(self) -> list[list[float]]:
         """Requires self.normalised_pRef"""
-        ss = self.normalised_pRef.search_space
-        empty: PS = PS.empty(ss)
-
-        def benefit_when_isolating(var: int, val: int) -> float:
-            isolated = empty.with_fixed_value(var, val)
-            return self.get_benefit(isolated)
-
-        return [[benefit_when_isolating(var, val)
-                 for val in range(ss.cardinalities[var])]
-                for var in range(ss.amount_of_parameters)]
+        # the normalised fitnesses only depend on the fitnesses of the PRef, so its fingerprint is enough
+        hot_encoded_benefits = self.pRef.get_or_compute("Atomicity.global_isolated_benefits", self.get_parameters(),
+                                                        lambda: self.normalised_pRef.get_marginals().univariate_sums)
+        offsets = self.normalised_pRef.search_space.precomputed_offsets
+        return [benefits.tolist() for benefits in np.split(hot_encoded_benefits, offsets[1:-1])]
 
     def get_isolated_benefits(self, ps: PS) -> ArrayOfFloats:
         return np.array([self.global_isolated_benefits[var][val]
@@ -70,16 +64,16 @@ class Atomicity(Metric):
                          if val != STAR])
 
     def get_excluded_benefits(self, ps: PS) -> ArrayOfFloats:
-        exclusions = ps.simplifications()
-        return np.array([self.get_benefit(excluded) for excluded in exclusions])
+        _, _, _, excluded_benefits = self.normalised_pRef.leave_one_out_stats(ps)
+        return excluded_benefits
 
     def get_single_score(self, ps: PS):
-        pAB = self.get_benefit(ps)
+        # the benefits of the ps and of its simplifications are calculated together
+        _, pAB, _, excluded = self.normalised_pRef.leave_one_out_stats(ps)
         if pAB == 0.0:
             return pAB
 
         isolated = self.get_isolated_benefits(ps)
-        excluded = self.get_excluded_benefits(ps)
 
         if len(isolated) == 0:  # ie we have the empty ps
             return 0
@@ -1,3 +1,5 @@
+import numpy as np
+
 from Core.PRef import PRef
 from Core.PS import PS
 from Core.PSMetric.Metric import Metric
@@ -41,6 +43,11 @@ class Averager(Metric):
         return sum([score * weight
                     for score, weight in zip(self.get_normalised_scores(ps), self.weights)]) / sum(self.weights)
 
+    def get_normalised_scores_batch(self, ps_matrix: np.ndarray) -> np.ndarray:
+        self.used_evaluations += len(ps_matrix)
+        return sum([metric.get_normalised_scores_batch(ps_matrix) * weight
+                    for metric, weight in zip(self.metrics, self.weights)]) / sum(self.weights)
+
 
     def get_scores_for_debug(self, ps: PS) -> list[float]:
         return [metric.get_single_normalised_score(ps) for metric in self.metrics]
\ No newline at end of file
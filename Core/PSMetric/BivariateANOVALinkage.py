@@ -1,105 +1,154 @@
 import itertools
-import warnings
-from typing import TypeAlias, Optional
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import TypeAlias, Optional, Union
 
 import numpy as np
 from scipy.stats import f
 
+import utils
 from Core.PRef import PRef
+from Core.PRefMarginals import PRefMarginals, get_hot_encoded_codes
 from Core.PS import PS, STAR
-from Core.PSMetric.Linkage import Linkage
+from Core.PSMetric.Linkage import Linkage, aggregate_linkages_of_fixed_pairs, get_linkages_of_fixed_pairs
+from Core.PSMetric.SparseLinkageTable import SparseLinkageTable
 from Core.PSMetric.Metric import Metric
+from Core.SearchSpace import SearchSpace
+from Core.custom_types import ArrayOfFloats, ArrayOfInts
 
 LinkageTable: TypeAlias = np.ndarray
 
 
+def get_cross_tables_of_vars(full_solution_matrix: np.ndarray,
+                             fitness_array: ArrayOfFloats,
+                             search_space: SearchSpace,
+                             vars_a: ArrayOfInts,
+                             weights: Optional[ArrayOfFloats] = None,
+                             max_chunk_cells: int = 2 ** 22) -> (np.ndarray, np.ndarray):
+    """
+    Returns the rows of the bivariate counts and fitness sums tables (hot encoded, as in PRefMarginals)
+    which belong to the values of vars_a. This is a module level function so that it can be sent to other processes.
+    The rows of the PRef are processed in chunks (of about max_chunk_cells cells) to keep the memory bounded
+    """
+    hot_encoded_length = search_space.hot_encoded_length
+    amount_of_vars = search_space.amount_of_parameters
+    table_starts = np.concatenate(([0], np.cumsum([search_space.cardinalities[var_a] for var_a in vars_a]))).astype(int)
+    counts = np.zeros((table_starts[-1], hot_encoded_length), dtype=float)
+    sums = np.zeros((table_starts[-1], hot_encoded_length), dtype=float)
+
+    chunk_size = max(1, max_chunk_cells // max(amount_of_vars, 1))
+    for start in range(0, full_solution_matrix.shape[0], chunk_size):
+        chunk = np.asarray(full_solution_matrix[start:start + chunk_size])
+        chunk_weights = None if weights is None else weights[start:start + chunk_size]
+        codes = get_hot_encoded_codes(chunk, search_space)
+        weighted_fitnesses = np.asarray(fitness_array[start:start + chunk_size], dtype=float)
+        if chunk_weights is not None:
+            weighted_fitnesses = weighted_fitnesses * chunk_weights
+        repeated_fitnesses = np.repeat(weighted_fitnesses, amount_of_vars)
+        repeated_weights = None if chunk_weights is None else np.repeat(chunk_weights, amount_of_vars)
+
+        for var_a, table_start, table_end in zip(vars_a, table_starts[:-1], table_starts[1:]):
+            cells = (chunk[:, var_a, np.newaxis].astype(np.int64) * hot_encoded_length + codes).ravel()
+            amount_of_cells = (table_end - table_start) * hot_encoded_length
+            counts[table_start:table_end] += np.bincount(cells, weights=repeated_weights, minlength=amount_of_cells)\
+                .reshape((-1, hot_encoded_length))
+            sums[table_start:table_end] += np.bincount(cells, weights=repeated_fitnesses, minlength=amount_of_cells)\
+                .reshape((-1, hot_encoded_length))
+    return counts, sums
+
+
+def get_cross_tables_of_vars_in_shared_pRef(shared_pRef_name: str, vars_a: ArrayOfInts) -> (np.ndarray, np.ndarray):
+    """the same as get_cross_tables_of_vars, where the PRef is attached from shared memory rather than pickled"""
+    pRef = PRef.attach(shared_pRef_name)
+    return get_cross_tables_of_vars(pRef.full_solution_matrix, pRef.fitness_array, pRef.search_space, vars_a,
+                                    weights=pRef.weights)
+
+
 class BivariateANOVALinkage(Metric):
-    linkage_table: Optional[LinkageTable]
-    normalised_linkage_table: Optional[LinkageTable]
+    linkage_table: Optional[Union[LinkageTable, SparseLinkageTable]]
+    normalised_linkage_table: Optional[Union[LinkageTable, SparseLinkageTable]]
+    processes: Optional[int]  # when set, the pairs of variables are split across a pool of processes
+    top_k: Optional[int]  # when set, the tables are sparse, and only keep the top_k partners of each variable
 
-    def __init__(self):
+    def __init__(self, processes: Optional[int] = None, top_k: Optional[int] = None):
         super().__init__()
         self.linkage_table = None
         self.normalised_linkage_table = None
+        self.processes = processes
+        self.top_k = top_k
 
     def __repr__(self):
         return "BiVariateANOVALinkage"
 
     def set_pRef(self, pRef: PRef):
         # print("Calculating linkages...", end="")
-        self.linkage_table = self.get_linkage_table(pRef)
+        # the stored table is the dense one, which doesn't depend on the amount of processes or on top_k (applied below)
+        self.linkage_table = pRef.get_or_compute("BivariateANOVALinkage.linkage_table", {},
+                                                 lambda: self.get_linkage_table(pRef))
         self.normalised_linkage_table = Linkage.get_normalised_linkage_table(self.linkage_table)
+        if self.top_k is not None:
+            self.linkage_table = SparseLinkageTable.from_dense(self.linkage_table, self.top_k, include_diagonal=False)
+            self.normalised_linkage_table = self.linkage_table.with_values_from(self.normalised_linkage_table)
         # print("Finished")
 
+    def get_bivariate_tables(self, pRef: PRef) -> (np.ndarray, np.ndarray):
+        """the bivariate counts and fitness sums, hot encoded as in PRefMarginals"""
+        if self.processes is None:
+            marginals = pRef.get_marginals()
+            marginals.calculate_bivariate_tables()
+            return marginals.bivariate_counts, marginals.bivariate_sums
+
+        chunks_of_vars = np.array_split(np.arange(pRef.search_space.amount_of_parameters), self.processes)
+        # the workers are spawned rather than forked: forking after a numba parallel kernel ran (eg in the
+        # observation queries of PRef) deadlocks, since the threads of numba's threading layer are not forked
+        spawn_context = multiprocessing.get_context("spawn")
+        with pRef.to_shared_memory() as shared_pRef, ProcessPoolExecutor(max_workers=self.processes,
+                                                                         mp_context=spawn_context) as executor:
+            chunk_results = list(executor.map(get_cross_tables_of_vars_in_shared_pRef,
+                                              itertools.repeat(shared_pRef.name),
+                                              chunks_of_vars))
+        counts_rows, sums_rows = utils.unzip(chunk_results)
+        return np.vstack(counts_rows), np.vstack(sums_rows)
+
     def get_ANOVA_interaction_table(self, pRef: PRef) -> LinkageTable:
         """every entry in this table will be a p-value, so in theory smaller values have stronger linkage"""
-        solutions = pRef.full_solution_matrix
         fitnesses = pRef.fitness_array
-
-        grand_mean = np.mean(fitnesses)
-        n = pRef.sample_size
-        dof_total = n - 1
-        amount_of_variables = pRef.search_space.amount_of_parameters
-
-        levels = pRef.search_space.cardinalities
-
+        n = pRef.total_weight
         if n == 0:
             raise Exception("0 samples in ANOVA when calculating linkage table.")
 
-        where_values = [[(solutions[:, i] == level_i) for level_i in range(levels[i])]
-                        for i in range(amount_of_variables)]
-
-        def interaction_test(i: int, j: int):
-            """ Perform a 2-factor ANOVA test with interaction term """
-
-            where_values_i = where_values[i]
-            where_values_j = where_values[j]
-
-            # Calculating the sum of squares for the interaction
-            # (Normally we'd also calculate the marginal sum of squares, but we don't need them here.
-
-            # debug
-            warnings.filterwarnings("error")
-            try:
-                sum_sq_interaction = np.sum([(np.mean(fitnesses[where_val_i & where_val_j]) -
-                                              np.mean(fitnesses[where_val_i]) -
-                                              np.mean(fitnesses[where_val_j]) +
-                                              grand_mean) ** 2 for where_val_i, where_val_j in
-                                             itertools.product(where_values_i, where_values_j)])
-            except RuntimeWarning as w:  # sometimes we get a mean of empty slice error
-                # print(f"Received the warning {w} when calculating the sum_sq_interaction")
-                sum_sq_interaction = 0
-
-            warnings.resetwarnings()
-
-            # Calculate error sum of squares
-            ss_error = np.sum((fitnesses - np.mean(fitnesses)) ** 2)
-
-            # Calculate degrees of freedom
-            dof_factor_i = pRef.search_space.cardinalities[i] - 1
-            dof_factor_j = pRef.search_space.cardinalities[j] - 1
-            dof_interaction = dof_factor_i * dof_factor_j
-            dof_error = dof_total - (dof_factor_i + dof_factor_j + dof_interaction)
-
-            # Calculate mean squares
-            ms_interaction = sum_sq_interaction / dof_interaction
-            ms_error = ss_error / dof_error
-
-            # Calculate F statistic
-            f_statistic = (ms_interaction / ms_error) if ms_error != 0 else np.inf
-
-            # Calculate p-value
-            p_value = 1 - f.cdf(f_statistic, dof_interaction, dof_error)
-            return p_value
-
-        def calculate_interaction(data: np.ndarray):
-            num_features = data.shape[1]
-            interaction_table = np.zeros((num_features, num_features))
-            for i, j in itertools.combinations(range(num_features), 2):
-                interaction_table[i, j] = interaction_test(i, j)
-            return interaction_table + interaction_table.T  # Make the table symmetric
-
-        return calculate_interaction(solutions)
+        grand_mean = pRef.mean_fitness()
+        dof_total = n - 1
+        offsets = pRef.search_space.precomputed_offsets
+
+        # Calculating the sum of squares for the interaction, for every pair of variables at once
+        # (Normally we'd also calculate the marginal sum of squares, but we don't need them here.)
+        marginal_means = pRef.get_marginals().get_univariate_means()
+        cell_means = PRefMarginals.means_from_counts_and_sums(*self.get_bivariate_tables(pRef))
+        interaction_addends = (cell_means - marginal_means[:, np.newaxis] - marginal_means[np.newaxis, :] + grand_mean) ** 2
+        sum_sq_interaction = Linkage.sum_within_blocks(interaction_addends, offsets)
+        # when some combination of values is not observed, the interaction can't be measured
+        sum_sq_interaction[np.isnan(sum_sq_interaction)] = 0
+
+        # Calculate error sum of squares
+        ss_error = np.sum(pRef.get_weights() * (fitnesses - grand_mean) ** 2)
+
+        # Calculate degrees of freedom
+        dof_factors = np.array(pRef.search_space.cardinalities) - 1
+        dof_interaction = np.outer(dof_factors, dof_factors)
+        dof_error = dof_total - (dof_factors[:, np.newaxis] + dof_factors[np.newaxis, :] + dof_interaction)
+
+        # Calculate mean squares and the F statistic, only for the pairs of different variables
+        i, j = np.triu_indices(pRef.search_space.amount_of_parameters, k=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ms_interaction = sum_sq_interaction[i, j] / dof_interaction[i, j]
+            ms_error = ss_error / dof_error[i, j]
+            f_statistic = np.where(ms_error != 0, ms_interaction / ms_error, np.inf)
+
+        # Calculate the p-values
+        interaction_table = np.zeros((pRef.search_space.amount_of_parameters, pRef.search_space.amount_of_parameters))
+        interaction_table[i, j] = f.sf(f_statistic, dof_interaction[i, j], dof_error[i, j])
+        return interaction_table + interaction_table.T  # Make the table symmetric
 
     def get_linkage_table(self, pRef: PRef):
         # from_anova = self.get_ANOVA_interaction_table(pRef)
@@ -109,22 +158,29 @@ class BivariateANOVALinkage(Metric):
         return table
 
     def get_normalised_linkage_scores(self, ps: PS, include_reflexive=False) -> np.ndarray:
-        fixed = ps.values != STAR
-        fixed_combinations: np.array = np.outer(fixed, fixed)
-        fixed_combinations = np.triu(fixed_combinations, k=0 if include_reflexive else 1)
-        return self.normalised_linkage_table[fixed_combinations]
+        return get_linkages_of_fixed_pairs(self.normalised_linkage_table, ps.values, include_diagonal=include_reflexive)
 
     def get_single_normalised_score(self, ps: PS) -> float:
         self.used_evaluations += 1
         if ps.fixed_count() < 2:
             return 0
-        else:
-            return np.average(self.get_normalised_linkage_scores(ps))
+        linkages = self.get_normalised_linkage_scores(ps)
+        if len(linkages) == 0:  # with top_k, the fixed variables might not be partners of each other
+            return 0
+        return np.average(linkages)
 
 
     def get_single_score(self, ps: PS) -> float:
         return self.get_single_normalised_score(ps)
 
+    def get_normalised_scores_batch(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        self.used_evaluations += len(ps_matrix)
+        averages, amounts_of_pairs = aggregate_linkages_of_fixed_pairs(ps_matrix, self.normalised_linkage_table, np.nanmean)
+        return np.where(amounts_of_pairs > 0, averages, 0)
+
+    def get_scores_batch(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        return self.get_normalised_scores_batch(ps_matrix)
+
     def get_quantized_linkage_table(self, linkage_table: LinkageTable):
         in_zero_one_range = Linkage.get_normalised_linkage_table(linkage_table)
         return np.array(in_zero_one_range > 0.5, dtype=float)
@@ -13,7 +13,7 @@ from numba import njit
 
 import utils
 from BenchmarkProblems.BenchmarkProblem import BenchmarkProblem
-from Core.PRef import PRef
+from Core.PRef import PRef, means_from_observation_stats
 from Core.PS import PS, STAR
 from Core.PSMetric.Additivity import Additivity, Influence, MeanError, MutualInformation
 from Core.PSMetric.Atomicity import Atomicity
@@ -23,74 +23,103 @@ from Core.PSMetric.LocalPerturbation import BivariateLocalPerturbation
 from Core.PSMetric.MeanFitness import MeanFitness
 from Core.PSMetric.Metric import Metric
 from Core.PSMetric.Simplicity import Simplicity
-from Core.custom_types import ArrayOfFloats
+from Core.custom_types import ArrayOfFloats, ArrayOfInts
 from utils import announce
 
 @njit
-def filter_by_var_val(fsm: np.ndarray,
-                      fitnesses,
-                      normalised_fitnesses,
-                      var: int,
-                      val: int) -> (np.ndarray, np.ndarray, np.ndarray):
-    which = fsm[:, var] == val
-    new_fsm = fsm[which]
-    if fitnesses is None:
-        new_fitnesses = None
-    else:
-        new_fitnesses = fitnesses[which]
-    new_normalised_fitnesses = normalised_fitnesses[which]
-    return new_fsm, new_fitnesses, new_normalised_fitnesses
+def get_rows_where_column_has_value(column: np.ndarray, val: int) -> ArrayOfInts:
+    """the row ids where column == val, without allocating anything proportional to the whole column"""
+    amount = 0
+    for row in range(len(column)):
+        if column[row] == val:
+            amount += 1
+    result = np.empty(amount, dtype=np.int64)
+    position = 0
+    for row in range(len(column)):
+        if column[row] == val:
+            result[position] = row
+            position += 1
+    return result
+
+
+@njit
+def filter_rows_by_column_value(column: np.ndarray, row_ids: ArrayOfInts, val: int) -> ArrayOfInts:
+    """the subset of row_ids where column == val"""
+    amount = 0
+    for row in row_ids:
+        if column[row] == val:
+            amount += 1
+    result = np.empty(amount, dtype=np.int64)
+    position = 0
+    for row in row_ids:
+        if column[row] == val:
+            result[position] = row
+            position += 1
+    return result
+
 
 class RowsOfPRef:
+    """
+    A subset of the rows of a PRef, stored as row ids.
+    The arrays are shared (and never modified) between all the subsets, so filtering only allocates the new row ids
+    """
     fsm: np.ndarray
     fitnesses: Optional[ArrayOfFloats]
     normalised_fitnesses: ArrayOfFloats
-
-
-    def __init__(self, fsm: np.ndarray, fitnesses: Optional[ArrayOfFloats], normalised_fitnesses: ArrayOfFloats):
+    row_ids: Optional[ArrayOfInts]  # None means that all the rows are included
+    weights: Optional[ArrayOfFloats]  # as in PRef.weights
+
+    def __init__(self,
+                 fsm: np.ndarray,
+                 fitnesses: Optional[ArrayOfFloats],
+                 normalised_fitnesses: ArrayOfFloats,
+                 row_ids: Optional[ArrayOfInts] = None,
+                 weights: Optional[ArrayOfFloats] = None):
         self.fsm = fsm
         self.fitnesses = fitnesses
         self.normalised_fitnesses = normalised_fitnesses
+        self.row_ids = row_ids
+        self.weights = weights
 
     @classmethod
     def all_from_pRef(cls, pRef: PRef, normalised_fitnesses: ArrayOfFloats):
-        fsm = pRef.full_solution_matrix.copy()
-        fitnesses = pRef.fitness_array.copy()
-        normalised_fitnesses = normalised_fitnesses.copy()
-        return cls(fsm, fitnesses, normalised_fitnesses)
+        return cls(pRef.full_solution_matrix, pRef.fitness_array, normalised_fitnesses, weights=pRef.weights)
 
+    def get_selected(self, array: Optional[ArrayOfFloats]) -> Optional[ArrayOfFloats]:
+        if array is None or self.row_ids is None:
+            return array
+        return array[self.row_ids]
 
     def invalidate_fitnesses(self):
         self.fitnesses = None
 
-
     def filter_by_var_val(self, var: int, val: int):
-        self.fsm, self.fitnesses, self.normalised_fitnesses = filter_by_var_val(self.fsm,
-                                                                                self.fitnesses,
-                                                                                self.normalised_fitnesses,
-                                                                                var,
-                                                                                val)
-
+        column = self.fsm[:, var]
+        if self.row_ids is None:
+            self.row_ids = get_rows_where_column_has_value(column, val)
+        else:
+            self.row_ids = filter_rows_by_column_value(column, self.row_ids, val)
 
     def get_mean_fitness(self) -> float:
         if self.fitnesses is None:
             raise ValueError("in RowsOfPRef, fitnesses is None")
 
-        if len(self.fitnesses) == 0:
+        fitnesses = self.get_selected(self.fitnesses)
+        if len(fitnesses) == 0:
             return -np.inf
-        return np.average(self.fitnesses)
+        return np.average(fitnesses, weights=self.get_selected(self.weights))
 
     def get_normalised_mean_fitness(self) -> float:
-        return float(np.sum(self.normalised_fitnesses))
+        normalised_fitnesses = self.get_selected(self.normalised_fitnesses)
+        if self.weights is not None:
+            return float(np.sum(normalised_fitnesses * self.get_selected(self.weights)))
+        return float(np.sum(normalised_fitnesses))
 
     def copy(self):
-        return RowsOfPRef(self.fsm, self.fitnesses, self.normalised_fitnesses)
+        return RowsOfPRef(self.fsm, self.fitnesses, self.normalised_fitnesses, self.row_ids, self.weights)
 
     def copy_with_invalidated_fitnesses(self):
-        return RowsOfPRef(self.fsm, None, self.normalised_fitnesses)
-
-
-
+        return RowsOfPRef(self.fsm, None, self.normalised_fitnesses, self.row_ids, self.weights)
 
 
 class Classic3PSEvaluator:
@@ -121,7 +150,7 @@ class Classic3PSEvaluator:
     def __init__(self, pRef: PRef):
         self.pRef = pRef
 
-        self.normalised_fitnesses = self.get_normalised_fitness_array(self.pRef.fitness_array)
+        self.normalised_fitnesses = self.get_normalised_fitness_array(self.pRef.fitness_array, self.pRef.weights)
         self.cached_isolated_benefits = self.calculate_isolated_benefits()
         self.used_evaluations = 0
 
@@ -132,10 +161,13 @@ class Classic3PSEvaluator:
         self.alternative_atomicity_evaluator.set_pRef(pRef)
 
     @classmethod
-    def get_normalised_fitness_array(cls, fitness_array: ArrayOfFloats) -> ArrayOfFloats:
+    def get_normalised_fitness_array(cls,
+                                     fitness_array: ArrayOfFloats,
+                                     weights: Optional[ArrayOfFloats] = None) -> ArrayOfFloats:
+        """the sum is weighted when the PRef is deduplicated, so that the normalised fitnesses of its observations add up to 1"""
         min_fitness = np.min(fitness_array)
         normalised_fitnesses = fitness_array - min_fitness
-        sum_fitness = np.sum(normalised_fitnesses, dtype=float)
+        sum_fitness = np.sum(normalised_fitnesses if weights is None else normalised_fitnesses * weights, dtype=float)
 
         if sum_fitness == 0:
             raise Exception(f"The sum of fitnesses is 0, could not normalise")
@@ -150,20 +182,66 @@ class Classic3PSEvaluator:
     def normalised_mf_of_rows(self, which_rows: RowsOfPRef) -> float:
         return which_rows.get_normalised_mean_fitness()
 
+    def calculate_hot_encoded_isolated_benefits(self) -> np.ndarray:
+        """
+        For each var, val, the sum of the normalised fitnesses of its observations.
+        Since normalising is just (fitness - min) / sum(fitness - min), these are obtained from the marginals of the PRef,
+        which can be merged when the PRef grows
+        """
+        marginals = self.pRef.get_marginals()
+        min_fitness = np.min(self.pRef.fitness_array)
+        sum_fitness = np.sum((self.pRef.fitness_array - min_fitness) * self.pRef.get_weights(), dtype=float)
+        return (marginals.univariate_sums - marginals.univariate_counts * min_fitness) / sum_fitness
+
     def calculate_isolated_benefits(self) -> list[list[float]]:
-        """Requires self.normalised_pRef"""
-        def benefit_when_isolating(var: int, val: int) -> float:
-            relevant_rows = self.pRef.full_solution_matrix[:, var] == val
-            return float(np.sum(self.normalised_fitnesses[relevant_rows]))
+        # the normalised fitnesses only depend on the fitnesses of the PRef, so its fingerprint is enough
+        # (and the evaluator has no other parameters)
+        hot_encoded_benefits = self.pRef.get_or_compute("Classic3PSEvaluator.isolated_benefits", {},
+                                                        self.calculate_hot_encoded_isolated_benefits)
+        offsets = self.pRef.search_space.precomputed_offsets
+        return [benefits.tolist() for benefits in np.split(hot_encoded_benefits, offsets[1:-1])]
+
+    def update(self, new_rows: np.ndarray, new_fitnesses: ArrayOfFloats):
+        """
+        Includes new solutions in the PRef. The isolated benefits are obtained from the merged marginals,
+        but the normalised fitnesses and the mutual information (see MutualInformation.update) are recalculated
+        """
+        self.pRef = self.pRef.with_extra_rows(new_rows, new_fitnesses)
+        self.normalised_fitnesses = self.get_normalised_fitness_array(self.pRef.fitness_array, self.pRef.weights)
 
-        ss = self.pRef.search_space
-        return [[benefit_when_isolating(var, val)
-                 for val in range(ss.cardinalities[var])]
-                for var in range(ss.amount_of_parameters)]
+        offsets = self.pRef.search_space.precomputed_offsets
+        self.cached_isolated_benefits = [benefits.tolist()
+                                         for benefits in np.split(self.calculate_hot_encoded_isolated_benefits(),
+                                                                  offsets[1:-1])]
+
+        self.mf_range = self.get_mf_range(self.pRef)
+        self.atomicity_range = self.get_atomicity_range(self.cached_isolated_benefits)
+        self.alternative_atomicity_evaluator.set_pRef(self.pRef)
 
     def get_simplicity_of_PS(self, ps: PS) -> float:
         return float(np.sum(ps.values == STAR))
 
+    def get_fixed_vars_in_filtering_order(self, ps: PS) -> ArrayOfInts:
+        # if available, the planner applies the most selective values first, so that the rows shrink faster
+        if self.pRef.query_planner is not None:
+            fixed_vars, _ = self.pRef.query_planner.get_plan(ps.values)
+            return fixed_vars
+        return ps.get_fixed_variable_positions()
+
+    def get_rows_for_ps(self, ps: PS) -> RowsOfPRef:
+        """Returns the rows for ps, without the rows of its simplifications"""
+        if self.pRef.observation_cache is not None:  # the cache always returns row ids
+            return RowsOfPRef(self.pRef.full_solution_matrix,
+                              self.pRef.fitness_array,
+                              self.normalised_fitnesses,
+                              self.pRef.rows_of_observations(ps),
+                              self.pRef.weights)
+
+        rows = RowsOfPRef.all_from_pRef(self.pRef, normalised_fitnesses=self.normalised_fitnesses)
+        for var in self.get_fixed_vars_in_filtering_order(ps):
+            rows.filter_by_var_val(var, ps[var])
+        return rows
+
     def get_relevant_rows_for_ps(self, ps: PS) -> (RowsOfPRef, list[RowsOfPRef]):
         """Returns the mean rows for ps, and the rows for the simplifications of ps"""
 
@@ -180,13 +258,17 @@ class Classic3PSEvaluator:
         with_all_fixed = RowsOfPRef.all_from_pRef(self.pRef, normalised_fitnesses=self.normalised_fitnesses)
         except_one_fixed = []
 
-        for var in ps.get_fixed_variable_positions():
+        fixed_vars = self.get_fixed_vars_in_filtering_order(ps)
+
+        for var in fixed_vars:
             value = ps[var]
             except_one_fixed = [subset_where_column_has_value(original, var, value)  # TODO uncomment these when using atomicity
                       for original in except_one_fixed]
             except_one_fixed.append(with_all_fixed.copy_with_invalidated_fitnesses())   # done temporarly since we don't use atomicity anymore
             with_all_fixed = subset_where_column_has_value(with_all_fixed, var, value)
 
+        # the simplifications are returned in the order of the variables, as the isolated benefits are
+        except_one_fixed = [rows for var, rows in sorted(zip(fixed_vars, except_one_fixed), key=utils.first)]
         return with_all_fixed, except_one_fixed
 
     def get_relevant_isolated_benefits(self, ps: PS) -> ArrayOfFloats:
@@ -219,7 +301,7 @@ class Classic3PSEvaluator:
 
     def get_S_MF_A_experimental(self, ps: PS, invalid_value: float = 0) -> np.ndarray:   # it is 3 floats
         self.used_evaluations += 1
-        rows_all_fixed, excluding_one = self.get_relevant_rows_for_ps(ps)
+        rows_all_fixed = self.get_rows_for_ps(ps)
 
         simplicity = self.get_simplicity_of_PS(ps)
         mean_fitness = self.mf_of_rows(rows_all_fixed)
@@ -254,7 +336,7 @@ class Classic3PSEvaluator:
     def get_S_MF_A(self, ps: PS, invalid_value: float = 0) -> np.ndarray:   # it is 3 floats
         """this one is normalised"""
         self.used_evaluations += 1
-        rows_all_fixed, excluding_one = self.get_relevant_rows_for_ps(ps)
+        rows_all_fixed = self.get_rows_for_ps(ps)  # the simplifications are only needed for the original atomicity
 
 
         simplicity = self.get_simplicity_of_PS(ps)
@@ -275,17 +357,35 @@ class Classic3PSEvaluator:
         return np.array([simplicity, mean_fitness, atomicity])
 
 
+    def get_S_MF_A_batch(self, ps_matrix: np.ndarray, invalid_value: float = 0) -> np.ndarray:
+        """
+        The same as get_S_MF_A, for each row of ps_matrix (where * is represented by -1).
+        Returns a matrix with a row of 3 floats for each PS
+        """
+        ps_matrix = np.asarray(ps_matrix).reshape((-1, self.pRef.search_space.amount_of_parameters))
+        self.used_evaluations += len(ps_matrix)
+
+        simplicity = np.sum(ps_matrix == STAR, axis=1) / ps_matrix.shape[1]
+
+        counts, sums, _ = self.pRef.observation_stats(ps_matrix)
+        mean_fitness = means_from_observation_stats(counts, sums, invalid_value=-np.inf)
+        mean_fitness = utils.remap_in_range_0_1_knowing_range(mean_fitness, self.mf_range)
+
+        atomicity = self.alternative_atomicity_evaluator.get_scores_batch(ps_matrix)
+
+        # note that, as in get_S_MF_A, an invalid atomicity invalidates the mean fitness
+        mean_fitness[~(np.isfinite(mean_fitness) & np.isfinite(atomicity))] = invalid_value
+        return np.column_stack((simplicity, mean_fitness, atomicity))
+
     def get_atomicity_contributions(self, ps: PS, normalised = False) -> np.ndarray:
         """ this function is used for explainability purposes, mainly"""
         self.used_evaluations +=1
 
-        rows_of_all_fixed, except_for_one = self.get_relevant_rows_for_ps(ps)
-        pAB = self.normalised_mf_of_rows(rows_of_all_fixed)
+        _, pAB, _, excluded = self.pRef.leave_one_out_stats(ps, fitness_array=self.normalised_fitnesses)
         if pAB == 0.0:
             return np.array([0 for _ in ps.get_fixed_variable_positions()])
 
         isolated = self.get_relevant_isolated_benefits(ps)
-        excluded = np.array([self.normalised_mf_of_rows(rows) for rows in except_for_one])
 
         if len(isolated) == 0:  # ie we have the empty ps
             return np.array([])
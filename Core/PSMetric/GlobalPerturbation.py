@@ -5,8 +5,9 @@ import numpy as np
 
 import utils
 from Core.PRef import PRef
+from Core.PRefMarginals import PRefMarginals
 from Core.PS import PS, STAR
-from Core.PSMetric.Linkage import Linkage
+from Core.PSMetric.Linkage import Linkage, aggregate_linkages_of_fixed_pairs
 from Core.PSMetric.LocalPerturbation import BivariateLocalPerturbation, UnivariateLocalPerturbation
 from Core.PSMetric.Metric import Metric
 from Core.custom_types import ArrayOfFloats
@@ -16,12 +17,16 @@ LinkageTable: TypeAlias = np.ndarray
 
 
 class UnivariateGlobalPerturbation(Metric):
+    pRef: Optional[PRef]
     importance_array: Optional[ImportanceArray]
-    normalised_importance_array: Optional[ImportanceArray]
+    cached_normalised_importance_array: Optional[ImportanceArray]  # use normalised_importance_array, which is lazy
+    updated_marginals: Optional[PRefMarginals]  # the marginals of the PRef, including the rows added by update
 
     def __init__(self):
+        self.pRef = None
         self.importance_array = None
-        self.normalised_importance_array = None
+        self.cached_normalised_importance_array = None
+        self.updated_marginals = None
         super().__init__()
 
     def __repr__(self):
@@ -29,26 +34,38 @@ class UnivariateGlobalPerturbation(Metric):
 
     @staticmethod
     def get_importance_array(pRef: PRef) -> ImportanceArray:
-        levels = [list(range(cardinality)) for cardinality in pRef.search_space.cardinalities]
-
-        def get_mean_fitness_for_each_val(locus: int) -> ArrayOfFloats:
-            def mean_fit(val):
-                return np.mean(pRef.get_fitnesses_matching_var_val(locus, val))
-
-            return np.array([mean_fit(val) for val in levels[locus]])
+        return UnivariateGlobalPerturbation.get_importance_array_of_marginals(pRef.get_marginals())
 
-        def get_variance_in_var(locus: int) -> float:
-            return float(np.var(get_mean_fitness_for_each_val(locus)))
+    @staticmethod
+    def get_importance_array_of_marginals(marginals: PRefMarginals) -> ImportanceArray:
+        mean_fitnesses = marginals.per_variable(marginals.get_univariate_means())  # nan for unobserved values
 
-        return np.array([get_variance_in_var(i) for i in range(pRef.search_space.amount_of_parameters)])
+        return np.array([float(np.var(mean_fitnesses_for_locus)) for mean_fitnesses_for_locus in mean_fitnesses])
 
     @staticmethod
     def get_normalised_importance_array(importance_array: ImportanceArray) -> ImportanceArray:
         return utils.remap_array_in_zero_one(importance_array)
 
     def set_pRef(self, pRef: PRef):
-        self.importance_array = self.get_importance_array(pRef)
-        self.normalised_importance_array = self.get_normalised_importance_array(self.importance_array)
+        self.pRef = pRef
+        self.importance_array = pRef.get_or_compute("UnivariateGlobalPerturbation.importance_array", self.get_parameters(),
+                                                    lambda: self.get_importance_array(pRef))
+        self.cached_normalised_importance_array = None
+        self.updated_marginals = None
+
+    def update(self, new_rows: np.ndarray, new_fitnesses: ArrayOfFloats):
+        """the importance array only depends on the marginals, which are updated with the new rows only"""
+        if self.updated_marginals is None:
+            self.updated_marginals = self.pRef.get_marginals().copy()
+        self.updated_marginals.update(new_rows, new_fitnesses)
+        self.importance_array = self.get_importance_array_of_marginals(self.updated_marginals)
+        self.cached_normalised_importance_array = None
+
+    @property
+    def normalised_importance_array(self) -> ImportanceArray:
+        if self.cached_normalised_importance_array is None:
+            self.cached_normalised_importance_array = self.get_normalised_importance_array(self.importance_array)
+        return self.cached_normalised_importance_array
 
     def get_single_normalised_score(self, ps: PS) -> float:
         return np.min(self.normalised_importance_array, where=ps.values != STAR, initial=1)
@@ -56,14 +73,25 @@ class UnivariateGlobalPerturbation(Metric):
     def get_single_score(self, ps: PS) -> float:
         return self.get_single_normalised_score(ps)
 
+    def get_normalised_scores_batch(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        return np.min(np.broadcast_to(self.normalised_importance_array, ps_matrix.shape),
+                      where=ps_matrix != STAR, initial=1, axis=1)
+
+    def get_scores_batch(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        return self.get_normalised_scores_batch(ps_matrix)
+
 
 class BivariateGlobalPerturbation(Metric):
+    pRef: Optional[PRef]
     linkage_table: Optional[ImportanceArray]
-    normalised_linkage_table: Optional[ImportanceArray]
+    cached_normalised_linkage_table: Optional[ImportanceArray]  # use normalised_linkage_table, which is lazy
+    updated_marginals: Optional[PRefMarginals]  # the marginals of the PRef, including the rows added by update
 
     def __init__(self):
+        self.pRef = None
         self.linkage_table = None
-        self.normalised_linkage_table = None
+        self.cached_normalised_linkage_table = None
+        self.updated_marginals = None
         super().__init__()
 
     def __repr__(self):
@@ -71,26 +99,22 @@ class BivariateGlobalPerturbation(Metric):
 
     @staticmethod
     def get_linkage_table(pRef: PRef) -> ImportanceArray:
+        return BivariateGlobalPerturbation.get_linkage_table_of_marginals(pRef.get_marginals())
 
-        levels = [list(range(cardinality)) for cardinality in pRef.search_space.cardinalities]
-
-        def get_mean_fitness_for_each_combination(locus_a: int, locus_b: int) -> ArrayOfFloats:
-            def mean_fit(val_a, val_b):
-                return np.mean(pRef.get_fitnesses_matching_var_val_pair(locus_a, val_a, locus_b, val_b))
-
-            return np.array([mean_fit(val_a, val_b)
-                             for val_a in levels[locus_a]
-                             for val_b in levels[locus_b]])
+    @staticmethod
+    def get_linkage_table_of_marginals(marginals: PRefMarginals) -> ImportanceArray:
+        search_space = marginals.search_space
+        bivariate_means = marginals.get_bivariate_means()  # nan for unobserved combinations
 
         def get_variance_in_loci(locus_a: int, locus_b: int) -> float:
-            return float(np.var(get_mean_fitness_for_each_combination(locus_a, locus_b)))
+            return float(np.var(marginals.get_bivariate_block(bivariate_means, locus_a, locus_b)))
 
-        linkage_table = np.zeros((pRef.search_space.amount_of_parameters, pRef.search_space.amount_of_parameters))
-        for var_a in range(pRef.search_space.amount_of_parameters):
-            for var_b in range(var_a + 1, pRef.search_space.amount_of_parameters):
+        linkage_table = np.zeros((search_space.amount_of_parameters, search_space.amount_of_parameters))
+        for var_a in range(search_space.amount_of_parameters):
+            for var_b in range(var_a + 1, search_space.amount_of_parameters):
                 linkage_table[var_a][var_b] = get_variance_in_loci(var_a, var_b)
 
-        univariate_variances = UnivariateGlobalPerturbation.get_importance_array(pRef)  # for the diagonal
+        univariate_variances = UnivariateGlobalPerturbation.get_importance_array_of_marginals(marginals)  # diagonal
         np.fill_diagonal(linkage_table, univariate_variances)
         # then we mirror it for convenience...
         upper_triangle = np.triu(linkage_table, k=1)
@@ -98,8 +122,28 @@ class BivariateGlobalPerturbation(Metric):
         return linkage_table
 
     def set_pRef(self, pRef: PRef):
-        self.linkage_table = self.get_linkage_table(pRef)
-        self.normalised_linkage_table = Linkage.get_normalised_linkage_table(self.linkage_table, include_diagonal=True)
+        self.pRef = pRef
+        self.linkage_table = pRef.get_or_compute("BivariateGlobalPerturbation.linkage_table", self.get_parameters(),
+                                                 lambda: self.get_linkage_table(pRef))
+        self.cached_normalised_linkage_table = None
+        self.updated_marginals = None
+
+    def update(self, new_rows: np.ndarray, new_fitnesses: ArrayOfFloats):
+        """the linkage table only depends on the marginals, which are updated with the new rows only"""
+        if self.updated_marginals is None:
+            # the bivariate tables of the PRef are calculated first, so that only those of the new rows are added
+            self.pRef.get_marginals().calculate_bivariate_tables()
+            self.updated_marginals = self.pRef.get_marginals().copy()
+        self.updated_marginals.update(new_rows, new_fitnesses)
+        self.linkage_table = self.get_linkage_table_of_marginals(self.updated_marginals)
+        self.cached_normalised_linkage_table = None
+
+    @property
+    def normalised_linkage_table(self) -> ImportanceArray:
+        if self.cached_normalised_linkage_table is None:
+            self.cached_normalised_linkage_table = Linkage.get_normalised_linkage_table(self.linkage_table,
+                                                                                        include_diagonal=True)
+        return self.cached_normalised_linkage_table
 
     def get_all_normalised_linkages(self, ps: PS, include_reflexive=False) -> list[float]:
         if include_reflexive:
@@ -116,6 +160,18 @@ class BivariateGlobalPerturbation(Metric):
     def get_single_score(self, ps: PS) -> float:
         return self.get_single_normalised_score(ps)
 
+    def get_normalised_scores_batch(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        minimums, amounts_of_pairs = aggregate_linkages_of_fixed_pairs(ps_matrix,
+                                                                       self.normalised_linkage_table,
+                                                                       np.nanmin,
+                                                                       include_diagonal=True)
+        if np.any(amounts_of_pairs == 0):
+            raise ValueError(f"{self} is not defined for the empty PS")
+        return minimums
+
+    def get_scores_batch(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        return self.get_normalised_scores_batch(ps_matrix)
+
 
 class AlternativeBivariateGlobalLinkage(Metric):
     linkage_table: Optional[ImportanceArray]
@@ -1,125 +1,293 @@
-from typing import TypeAlias, Optional
+from typing import TypeAlias, Optional, Callable, Union
 
 import numpy as np
+from numba import njit, prange
 
+import utils
 from Core.PRef import PRef
+from Core.PRefMarginals import PRefMarginals
 from Core.PS import PS, STAR
 from Core.PSMetric.Metric import Metric
+from Core.PSMetric.SparseLinkageTable import SparseLinkageTable, aggregate_linkages_of_rows
+from Core.SearchSpace import SearchSpace
+from Core.custom_types import ArrayOfFloats, ArrayOfInts
 
 LinkageTable: TypeAlias = np.ndarray
 
 
+def get_linkages_of_fixed_pairs(linkage_table: Union[LinkageTable, SparseLinkageTable],
+                                ps_values: ArrayOfInts,
+                                include_diagonal: bool = False) -> ArrayOfFloats:
+    """the linkages between the fixed variables of the PS, only going through the fixed variables"""
+    if isinstance(linkage_table, SparseLinkageTable):
+        return linkage_table.get_linkages_of_fixed_pairs(ps_values, include_diagonal)
+    fixed_vars = np.flatnonzero(np.asarray(ps_values) != STAR)
+    linkages_within_ps = linkage_table[np.ix_(fixed_vars, fixed_vars)]
+    return linkages_within_ps[np.triu_indices(len(fixed_vars), k=0 if include_diagonal else 1)]
+
+
+@njit
+def get_linkages_of_fixed_pairs_in_dense_rows(linkage_table: LinkageTable,
+                                              ps_matrix: np.ndarray,
+                                              include_diagonal: bool) -> (ArrayOfFloats, ArrayOfInts):
+    """The same as get_linkages_of_fixed_pairs_in_rows, for a dense table"""
+    amount_of_rows, amount_of_vars = ps_matrix.shape
+    starts = np.zeros(amount_of_rows + 1, dtype=np.int64)
+    for row in range(amount_of_rows):
+        amount_of_fixed = 0
+        for var in range(amount_of_vars):
+            if ps_matrix[row, var] != STAR:
+                amount_of_fixed += 1
+        amount_of_pairs = amount_of_fixed * (amount_of_fixed + 1 if include_diagonal else amount_of_fixed - 1) // 2
+        starts[row + 1] = starts[row] + amount_of_pairs
+
+    linkages = np.empty(starts[amount_of_rows], dtype=np.float64)
+    fixed_vars = np.empty(amount_of_vars, dtype=np.int64)
+    for row in range(amount_of_rows):
+        amount_of_fixed = 0
+        for var in range(amount_of_vars):
+            if ps_matrix[row, var] != STAR:
+                fixed_vars[amount_of_fixed] = var
+                amount_of_fixed += 1
+
+        position = starts[row]
+        for index_a in range(amount_of_fixed):
+            for index_b in range(index_a if include_diagonal else index_a + 1, amount_of_fixed):
+                linkages[position] = linkage_table[fixed_vars[index_a], fixed_vars[index_b]]
+                position += 1
+    return linkages, starts
+
+
+def aggregate_linkages_of_fixed_pairs(ps_matrix: np.ndarray,
+                                      linkage_table: Union[LinkageTable, SparseLinkageTable],
+                                      nan_aggregate: Callable,
+                                      include_diagonal: bool = False) -> (ArrayOfFloats, ArrayOfInts):
+    """
+    For each row of ps_matrix (where * is represented by -1), aggregates the linkages between its fixed variables,
+    which are gathered without going through the other pairs. See aggregate_linkages_of_rows for nan_aggregate.
+    :return: the aggregates, which are nan when the PS has no pairs or when one of its linkages is nan
+             (as the non-nan aggregates would give), and the amount of pairs of each PS
+    """
+    if isinstance(linkage_table, SparseLinkageTable):
+        return linkage_table.aggregate_linkages_of_fixed_pairs(ps_matrix, nan_aggregate, include_diagonal)
+
+    linkages, starts = get_linkages_of_fixed_pairs_in_dense_rows(np.asarray(linkage_table, dtype=np.float64),
+                                                                 np.asarray(ps_matrix, dtype=np.int64),
+                                                                 include_diagonal)
+    return aggregate_linkages_of_rows(linkages, starts, nan_aggregate)
+
+
+@njit(parallel=True, error_model="numpy")
+def get_linkage_tables_of_pairs(full_solution_matrix: np.ndarray,
+                                fitness_array: ArrayOfFloats,
+                                row_weights: Optional[ArrayOfFloats],
+                                offsets: ArrayOfInts,
+                                univariate_counts: ArrayOfFloats,
+                                univariate_sums: ArrayOfFloats) -> (LinkageTable, LinkageTable):
+    """
+    Calculates the mean benefit linkage table and the chi squared linkage table,
+    where the pairs of variables are distributed across the cores
+    and the contingency table of each pair is counted directly from the solution matrix.
+    When row_weights is not None, each row counts as row_weights[row] observations.
+    """
+    amount_of_rows, amount_of_vars = full_solution_matrix.shape
+    if row_weights is None:
+        n = float(amount_of_rows)
+        overall_average = np.mean(fitness_array)
+    else:
+        n = np.sum(row_weights)
+        overall_average = np.sum(row_weights * fitness_array) / n
+    univariate_benefits = univariate_sums / univariate_counts - overall_average  # nan when unobserved
+    univariate_probabilities = univariate_counts / n
+
+    pairs_a = np.empty(amount_of_vars * (amount_of_vars + 1) // 2, dtype=np.int64)
+    pairs_b = np.empty_like(pairs_a)
+    which_pair = 0
+    for var_a in range(amount_of_vars):
+        for var_b in range(var_a, amount_of_vars):
+            pairs_a[which_pair] = var_a
+            pairs_b[which_pair] = var_b
+            which_pair += 1
+
+    mean_benefit_table = np.zeros((amount_of_vars, amount_of_vars))
+    chi_squared_table = np.zeros((amount_of_vars, amount_of_vars))
+    for which_pair in prange(len(pairs_a)):
+        var_a = pairs_a[which_pair]
+        var_b = pairs_b[which_pair]
+        start_a = offsets[var_a]
+        start_b = offsets[var_b]
+        cardinality_a = offsets[var_a + 1] - start_a
+        cardinality_b = offsets[var_b + 1] - start_b
+
+        counts = np.zeros((cardinality_a, cardinality_b))
+        sums = np.zeros((cardinality_a, cardinality_b))
+        if var_a == var_b:  # fixing the same variable twice only keeps the second value
+            for val_a in range(cardinality_a):
+                for val_b in range(cardinality_b):
+                    counts[val_a, val_b] = univariate_counts[start_b + val_b]
+                    sums[val_a, val_b] = univariate_sums[start_b + val_b]
+        else:
+            for row in range(amount_of_rows):
+                val_a = full_solution_matrix[row, var_a]
+                val_b = full_solution_matrix[row, var_b]
+                weight = 1.0 if row_weights is None else row_weights[row]
+                counts[val_a, val_b] += weight
+                sums[val_a, val_b] += weight * fitness_array[row]
+
+        mean_benefit = 0.0
+        chi_squared = 0.0
+        for val_a in range(cardinality_a):
+            for val_b in range(cardinality_b):
+                expected_benefit = univariate_benefits[start_a + val_a] + univariate_benefits[start_b + val_b]
+                observed_benefit = sums[val_a, val_b] / counts[val_a, val_b] - overall_average
+                mean_benefit += abs(expected_benefit - observed_benefit)
+
+                expected_probability = univariate_probabilities[start_a + val_a] * univariate_probabilities[start_b + val_b]
+                observed_probability = counts[val_a, val_b] / n
+                chi_squared += ((n * observed_probability - n * expected_probability) ** 2) / (n * expected_probability)
+
+        mean_benefit_table[var_a, var_b] = mean_benefit
+        mean_benefit_table[var_b, var_a] = mean_benefit
+        chi_squared_table[var_a, var_b] = chi_squared
+        chi_squared_table[var_b, var_a] = chi_squared
+
+    return mean_benefit_table, chi_squared_table
+
+
 class Linkage(Metric):
-    linkage_table: Optional[LinkageTable]
-    normalised_linkage_table: Optional[LinkageTable]
+    pRef: Optional[PRef]
+    top_k: Optional[int]  # when set, the tables are sparse, and only keep the top_k partners of each variable
+    linkage_table: Optional[Union[LinkageTable, SparseLinkageTable]]
+    cached_normalised_linkage_table: Optional[Union[LinkageTable, SparseLinkageTable]]  # use normalised_linkage_table
+    updated_marginals: Optional[PRefMarginals]  # the marginals of the PRef, including the rows added by update
 
-    def __init__(self):
+    def __init__(self, top_k: Optional[int] = None):
         super().__init__()
+        self.pRef = None
+        self.top_k = top_k
         self.linkage_table = None
-        self.normalised_linkage_table = None
+        self.cached_normalised_linkage_table = None
+        self.updated_marginals = None
 
     def __repr__(self):
         return "Linkage"
 
     def set_pRef(self, pRef: PRef):
         # print("Calculating linkages...", end="")
-        self.linkage_table = self.get_linkage_table_fast(pRef)
+        self.pRef = pRef
+        # the stored table is the dense one, which doesn't depend on top_k (it is applied in sparsify_tables)
+        self.linkage_table = pRef.get_or_compute("Linkage.linkage_table", {},
+                                                 lambda: self.get_linkage_table_fast(pRef))
         # self.normalised_linkage_table = self.get_quantized_linkage_table(self.linkage_table)
         # print("Finished")
-        self.normalised_linkage_table = self.get_normalised_linkage_table(self.linkage_table)
+        self.cached_normalised_linkage_table = None
+        self.updated_marginals = None
+        self.sparsify_tables()
+
+    def update(self, new_rows: np.ndarray, new_fitnesses: ArrayOfFloats):
+        """the linkage table only depends on the marginals, which are updated with the new rows only
+        (on a copy of the tables, so that those of the PRef are not changed)"""
+        if self.updated_marginals is None:
+            self.updated_marginals = self.pRef.get_marginals().copy()
+        self.updated_marginals.update(new_rows, new_fitnesses)
+        self.linkage_table = self.get_linkage_table_of_marginals(self.updated_marginals)
+        self.cached_normalised_linkage_table = None
+        self.sparsify_tables()
+
+    def sparsify_tables(self):
+        """if top_k is set, the dense tables are replaced by sparse ones, where the normalised table is calculated first
+        (from the dense one, since the normalisation depends on all the pairs)"""
+        if self.top_k is None:
+            return
+        dense_normalised_linkage_table = self.get_normalised_linkage_table(self.linkage_table)
+        self.linkage_table = SparseLinkageTable.from_dense(self.linkage_table, self.top_k)
+        self.cached_normalised_linkage_table = self.linkage_table.with_values_from(dense_normalised_linkage_table)
+
+    @property
+    def normalised_linkage_table(self) -> Union[LinkageTable, SparseLinkageTable]:
+        if self.cached_normalised_linkage_table is None:
+            self.cached_normalised_linkage_table = self.get_normalised_linkage_table(self.linkage_table)
+        return self.cached_normalised_linkage_table
 
     @staticmethod
-    def get_linkage_table_fast(pRef: PRef) -> LinkageTable:
-        overall_average = np.average(pRef.fitness_array)
-
-        def get_mean_benefit_of_ps(ps: PS):
-            return np.average(pRef.fitnesses_of_observations(ps)) - overall_average
-
-        def one_fixed_var(var, val) -> PS:
-            return PS.empty(pRef.search_space).with_fixed_value(var, val)
-
-        def two_fixed_vars(var_x, val_x, var_y, val_y) -> PS:
-            return (PS.empty(pRef.search_space)
-                    .with_fixed_value(var_x, val_x)
-                    .with_fixed_value(var_y, val_y))
-
-        marginal_benefits = [[get_mean_benefit_of_ps(one_fixed_var(var, val))
-                              for val in range(cardinality)]
-                             for var, cardinality in enumerate(pRef.search_space.cardinalities)]
+    def get_observed_with_repeated_vars(bivariate_table: np.ndarray,
+                                        univariate_table: ArrayOfFloats,
+                                        offsets: ArrayOfInts) -> np.ndarray:
+        """
+        Returns a copy of the bivariate table where the diagonal blocks are replaced as if var_x, val_a, var_x, val_b
+        was the PS with only var_x = val_b, since fixing the same variable twice only keeps the second value
+        """
+        result = bivariate_table.copy()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            result[start:end, start:end] = univariate_table[np.newaxis, start:end]
+        return result
 
-        def interaction_effect_between_vars(var_x: int, var_y: int) -> float:
+    @staticmethod
+    def sum_within_blocks(hot_encoded_matrix: np.ndarray, offsets: ArrayOfInts) -> LinkageTable:
+        """sums the entries of each (var_x, var_y) block, resulting in a d x d table"""
+        row_sums = np.add.reduceat(hot_encoded_matrix, offsets[:-1], axis=0)
+        return np.add.reduceat(row_sums, offsets[:-1], axis=1)
 
-            def addend(val_a, val_b):
-                expected_conditional = marginal_benefits[var_x][val_a] + marginal_benefits[var_y][val_b]
-                observed_conditional = get_mean_benefit_of_ps(two_fixed_vars(var_x, val_a, var_y, val_b))
+    @staticmethod
+    def get_linkage_table_fast(pRef: PRef) -> LinkageTable:
+        """For each pair of variables, the sum of |benefit(a) + benefit(b) - benefit(a, b)| over their values"""
+        return Linkage.get_linkage_table_of_marginals(pRef.get_marginals(), pRef.mean_fitness())
 
-                return abs(expected_conditional - observed_conditional)
+    @staticmethod
+    def get_linkage_table_of_marginals(marginals: PRefMarginals, overall_average: Optional[float] = None) -> LinkageTable:
+        """the same as get_linkage_table_fast, where the overall average can also be obtained from the marginals"""
+        if overall_average is None:
+            overall_average = marginals.get_mean_fitness()
+        offsets = marginals.search_space.precomputed_offsets
 
-            cardinality_x = pRef.search_space.cardinalities[var_x]
-            cardinality_y = pRef.search_space.cardinalities[var_y]
-            return sum(addend(val_a, val_b)
-                       for val_a in range(cardinality_x)
-                       for val_b in range(cardinality_y))
+        # the mean benefits are nan when there are no observations, as in np.average
+        marginal_benefits = marginals.get_univariate_means() - overall_average
+        observed_conditional = Linkage.get_observed_with_repeated_vars(marginals.get_bivariate_means() - overall_average,
+                                                                       marginal_benefits,
+                                                                       offsets)
+        expected_conditional = marginal_benefits[:, np.newaxis] + marginal_benefits[np.newaxis, :]
 
-        linkage_table = np.zeros((pRef.search_space.amount_of_parameters, pRef.search_space.amount_of_parameters))
-        for var_a in range(pRef.search_space.amount_of_parameters):
-            for var_b in range(var_a, pRef.search_space.amount_of_parameters):
-                linkage_table[var_a][var_b] = interaction_effect_between_vars(var_a, var_b)
-
-        # then we mirror it for convenience...
-        upper_triangle = np.triu(linkage_table, k=1)
-        linkage_table = linkage_table + upper_triangle.T
-        return linkage_table
+        return Linkage.sum_within_blocks(np.abs(expected_conditional - observed_conditional), offsets)
 
     @staticmethod
     def get_linkage_table_using_chi_squared(pRef: PRef) -> LinkageTable:
-        n = pRef.sample_size
-
-        def get_p_of_ps(ps: PS):
-            amount = len(pRef.fitnesses_of_observations(ps))
-            return amount / n
-
-        def one_fixed_var(var, val) -> PS:
-            return PS.empty(pRef.search_space).with_fixed_value(var, val)
-
-        def two_fixed_vars(var_x, val_x, var_y, val_y) -> PS:
-            return (PS.empty(pRef.search_space)
-                    .with_fixed_value(var_x, val_x)
-                    .with_fixed_value(var_y, val_y))
-
-        marginal_probabilities = [[get_p_of_ps(one_fixed_var(var, val))
-                                   for val in range(cardinality)]
-                                  for var, cardinality in enumerate(pRef.search_space.cardinalities)]
+        """For each pair of variables, the chi squared statistic of their contingency table"""
+        n = pRef.total_weight
+        marginals = pRef.get_marginals()
+        marginals.calculate_bivariate_tables()
+        offsets = pRef.search_space.precomputed_offsets
+
+        marginal_probabilities = marginals.univariate_counts / n
+        observed_conditional = Linkage.get_observed_with_repeated_vars(marginals.bivariate_counts / n,
+                                                                       marginal_probabilities,
+                                                                       offsets)
+        expected_conditional = marginal_probabilities[:, np.newaxis] * marginal_probabilities[np.newaxis, :]
+
+        with np.errstate(divide="ignore", invalid="ignore"):  # unobserved values give nan, rather than an exception
+            chi_square_addends = (((n * observed_conditional - n * expected_conditional) ** 2)
+                                  / (n * expected_conditional))
+        return Linkage.sum_within_blocks(chi_square_addends, offsets)
 
-        def interaction_effect_between_vars(var_x: int, var_y: int) -> float:
-            """Returns the chi squared value between x and y"""
-
-            def chi_square_addend(val_a, val_b):
-                expected_conditional = marginal_probabilities[var_x][val_a] * marginal_probabilities[var_y][val_b]
-                observed_conditional = get_p_of_ps(two_fixed_vars(var_x, val_a, var_y, val_b))
-
-                return ((n * observed_conditional - n * expected_conditional) ** 2) / (n * expected_conditional)
-
-            cardinality_x = pRef.search_space.cardinalities[var_x]
-            cardinality_y = pRef.search_space.cardinalities[var_y]
-            return sum(chi_square_addend(val_a, val_b)
-                       for val_a in range(cardinality_x)
-                       for val_b in range(cardinality_y))
-
-        linkage_table = np.zeros((pRef.search_space.amount_of_parameters, pRef.search_space.amount_of_parameters))
-        for var_a in range(pRef.search_space.amount_of_parameters):
-            for var_b in range(var_a, pRef.search_space.amount_of_parameters):
-                linkage_table[var_a][var_b] = interaction_effect_between_vars(var_a, var_b)
-
-        # then we mirror it for convenience...
-        upper_triangle = np.triu(linkage_table, k=1)
-        linkage_table = linkage_table + upper_triangle.T
-        return linkage_table
+    @staticmethod
+    def get_linkage_tables_parallel(pRef: PRef) -> (LinkageTable, LinkageTable):
+        """
+        Returns the same tables as get_linkage_table_fast and get_linkage_table_using_chi_squared,
+        but the contingency table of each pair of variables is gathered from the solution matrix in parallel,
+        so the memory usage doesn't grow with the square of the hot encoded length.
+        """
+        marginals = pRef.get_marginals()
+        # each pair reads two whole columns, so they should be contiguous
+        return get_linkage_tables_of_pairs(np.asfortranarray(pRef.full_solution_matrix),
+                                           np.asarray(pRef.fitness_array, dtype=float),
+                                           pRef.weights,
+                                           pRef.search_space.precomputed_offsets.astype(np.int64),
+                                           marginals.univariate_counts,
+                                           marginals.univariate_sums)
 
     @staticmethod
     def get_linkage_table(pRef: PRef) -> LinkageTable:
         """TODO this is incredibly slow..."""
-        overall_avg_fitness = np.average(pRef.fitness_array)
+        overall_avg_fitness = pRef.mean_fitness()
 
         empty = PS.empty(pRef.search_space)
         trivial_pss = [[empty.with_fixed_value(var_index, val)
@@ -177,22 +345,18 @@ class Linkage(Metric):
         return quantized_linkage_table
 
     def get_linkage_scores(self, ps: PS) -> np.ndarray:
-        fixed = ps.values != STAR
-        fixed_combinations: np.array = np.outer(fixed, fixed)
-        fixed_combinations = np.triu(fixed_combinations, k=1)
-        return self.linkage_table[fixed_combinations]
+        return get_linkages_of_fixed_pairs(self.linkage_table, ps.values)
 
     def get_normalised_linkage_scores(self, ps: PS) -> np.ndarray:
-        fixed = ps.values != STAR
-        fixed_combinations: np.array = np.outer(fixed, fixed)
-        fixed_combinations = np.triu(fixed_combinations, k=0)
-        return self.normalised_linkage_table[fixed_combinations]
+        return get_linkages_of_fixed_pairs(self.normalised_linkage_table, ps.values, include_diagonal=True)
 
     def get_single_score_using_avg(self, ps: PS) -> float:
         if ps.fixed_count() < 2:
             return 0
-        else:
-            return np.min(self.get_linkage_scores(ps))
+        linkages = self.get_linkage_scores(ps)
+        if len(linkages) == 0:  # with top_k, the fixed variables might not be partners of each other
+            return 0
+        return np.min(linkages)
 
     def get_single_normalised_score(self, ps: PS) -> float:
         self.used_evaluations += 1
@@ -203,3 +367,51 @@ class Linkage(Metric):
 
     def get_single_score(self, ps: PS) -> float:
         return self.get_single_score_using_avg(ps)
+
+    def get_scores_batch(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        minimums, amounts_of_pairs = aggregate_linkages_of_fixed_pairs(ps_matrix, self.linkage_table, np.nanmin)
+        return np.where(amounts_of_pairs > 0, minimums, 0)
+
+    def get_normalised_scores_batch(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        self.used_evaluations += len(ps_matrix)
+        averages, _ = aggregate_linkages_of_fixed_pairs(ps_matrix,
+                                                        self.normalised_linkage_table,
+                                                        np.nanmean,
+                                                        include_diagonal=True)
+        return np.where(np.sum(ps_matrix != STAR, axis=1) >= 2, averages, 0)
+
+
+def benchmark_linkage_tables(amounts_of_vars: list[int], sample_sizes: list[int], cardinality: int = 2) -> list[dict]:
+    """
+    Times the vectorised and the parallel linkage tables on random PRefs of every given size,
+    after checking that both give the same tables. Returns a row of results for each (d, n)
+    """
+    results = []
+    for amount_of_vars in amounts_of_vars:
+        for sample_size in sample_sizes:
+            search_space = SearchSpace([cardinality] * amount_of_vars)
+            full_solution_matrix = np.random.randint(cardinality, size=(sample_size, amount_of_vars))
+            fitness_array = np.random.random(sample_size)
+            pRef = PRef(fitness_array, full_solution_matrix, search_space)
+
+            with utils.execution_time() as marginals_timer:
+                pRef.get_marginals().calculate_bivariate_tables()
+            with utils.execution_time() as vectorised_timer:
+                mean_benefit_table = Linkage.get_linkage_table_fast(pRef)
+                chi_squared_table = Linkage.get_linkage_table_using_chi_squared(pRef)
+            Linkage.get_linkage_tables_parallel(pRef)  # to compile it beforehand
+            with utils.execution_time() as parallel_timer:
+                parallel_mean_benefit_table, parallel_chi_squared_table = Linkage.get_linkage_tables_parallel(pRef)
+
+            if not (np.allclose(mean_benefit_table, parallel_mean_benefit_table, equal_nan=True) and
+                    np.allclose(chi_squared_table, parallel_chi_squared_table, equal_nan=True)):
+                raise Exception(f"The parallel linkage tables differ from the vectorised ones for d = {amount_of_vars}, n = {sample_size}")
+
+            result = {"d": amount_of_vars,
+                      "n": sample_size,
+                      "marginals": marginals_timer.execution_time,
+                      "vectorised": vectorised_timer.execution_time,
+                      "parallel": parallel_timer.execution_time}
+            print(result)
+            results.append(result)
+    return results
@@ -1,4 +1,3 @@
-import itertools
 import warnings
 from typing import Optional
 
@@ -12,20 +11,16 @@ from Core.custom_types import ArrayOfBools, ArrayOfFloats
 
 class LocalPerturbationCalculator:
     pRef: PRef
-    cached_value_locations: list[list[ArrayOfBools]]
 
     def __init__(self, pRef: PRef):
         self.pRef = pRef
-        self.cached_value_locations = self.get_cached_value_locations(pRef)
 
-    @staticmethod
-    def get_cached_value_locations(pRef: PRef) -> list[list[ArrayOfBools]]:
-        def get_where_var_val(var: int, val: int) -> ArrayOfBools:
-            return pRef.full_solution_matrix[:, var] == val
-
-        return [[get_where_var_val(var, val)
-                 for val in range(cardinality)]
-                for var, cardinality in enumerate(pRef.search_space.cardinalities)]
+    def get_where_ps_matches_ignoring_loci(self, ps: PS, loci: list[int]) -> ArrayOfBools:
+        where_ps_matches = np.full(shape=self.pRef.sample_size, fill_value=True, dtype=bool)
+        for var, val in enumerate(ps.values):
+            if val != STAR and var not in loci:
+                where_ps_matches = np.logical_and(where_ps_matches, self.pRef.full_solution_matrix[:, var] == val)
+        return where_ps_matches
 
     def get_univariate_perturbation_fitnesses(self, ps: PS, locus: int) -> (ArrayOfFloats, ArrayOfFloats):
         """ The name is horrible, but essentially it returns
@@ -33,19 +28,12 @@ class LocalPerturbationCalculator:
 
         assert (ps.values[locus] != STAR)
 
-        where_ps_matches_ignoring_locus = np.full(shape=self.pRef.sample_size, fill_value=True, dtype=bool)
-        for var, val in enumerate(ps.values):
-            if val != STAR and var != locus:
-                where_ps_matches_ignoring_locus = np.logical_and(where_ps_matches_ignoring_locus,
-                                                                 self.cached_value_locations[var][val])
-
-        locus_val = ps.values[locus]
-
-        where_locus = self.cached_value_locations[locus][locus_val]
+        where_ps_matches_ignoring_locus = self.get_where_ps_matches_ignoring_loci(ps, [locus])
+        where_locus = self.pRef.full_solution_matrix[:, locus] == ps.values[locus]
         where_value_matches = np.logical_and(where_ps_matches_ignoring_locus, where_locus)
         where_complement_matches = np.logical_and(where_ps_matches_ignoring_locus, np.logical_not(where_locus))
 
-        return (self.pRef.fitness_array[where_value_matches], self.pRef.fitness_array[where_complement_matches])
+        return (self.pRef.repeat_by_weights(where_value_matches), self.pRef.repeat_by_weights(where_complement_matches))
 
     def get_bivariate_perturbation_fitnesses(self, ps: PS, locus_a: int, locus_b) -> (ArrayOfFloats, ArrayOfFloats):
         """ returns the fitnesses of x(a, b), x(not a, b), x(a, not b), x(not a, not b)"""
@@ -53,17 +41,10 @@ class LocalPerturbationCalculator:
         assert (ps.values[locus_a] != STAR)
         assert (ps.values[locus_b] != STAR)
 
-        where_ps_matches_ignoring_loci = np.full(shape=self.pRef.sample_size, fill_value=True, dtype=bool)
-        for var, val in enumerate(ps.values):
-            if val != STAR and var != locus_a and var != locus_b:
-                where_ps_matches_ignoring_loci = np.logical_and(where_ps_matches_ignoring_loci,
-                                                                self.cached_value_locations[var][val])
-
-        val_a = ps.values[locus_a]
-        val_b = ps.values[locus_b]
+        where_ps_matches_ignoring_loci = self.get_where_ps_matches_ignoring_loci(ps, [locus_a, locus_b])
 
-        where_a = self.cached_value_locations[locus_a][val_a]
-        where_b = self.cached_value_locations[locus_b][val_b]
+        where_a = self.pRef.full_solution_matrix[:, locus_a] == ps.values[locus_a]
+        where_b = self.pRef.full_solution_matrix[:, locus_b] == ps.values[locus_b]
         where_not_a = np.logical_not(where_a)
         where_not_b = np.logical_not(where_b)
 
@@ -73,36 +54,55 @@ class LocalPerturbationCalculator:
         where_not_a_not_b = np.logical_and(where_not_a, where_not_b)
 
         def fits(where_condition: ArrayOfBools):
-            return self.pRef.fitness_array[np.logical_and(where_ps_matches_ignoring_loci, where_condition)]
+            return self.pRef.repeat_by_weights(np.logical_and(where_ps_matches_ignoring_loci, where_condition))
 
         return fits(where_a_b), fits(where_not_a_b), fits(where_a_not_b), fits(where_not_a_not_b)
 
-    def get_delta_f_of_ps_at_locus_univariate(self, ps: PS, locus: int) -> float:
-        value_matches, complement_matches = self.get_univariate_perturbation_fitnesses(ps, locus)
+    def get_delta_fs_of_ps_univariate(self, ps: PS) -> ArrayOfFloats:
+        """
+        For each fixed locus of ps, |mean(observations of ps) - mean(observations of ps but with locus changed)|,
+        all obtained from a single pass over the PRef
+        """
+        count, total, counts_with_one, sums_with_one, _, _ = self.pRef.hamming_ball_stats(ps)
 
-        if len(value_matches) == 0 or len(complement_matches) == 0:
+        insufficient = (counts_with_one == 0) | (count == 0)
+        if np.any(insufficient):
             warnings.warn(
                 f"Encountered a PS with insufficient observations when calculating Univariate Local perturbation")
-            return 0  # panic
 
-        fs_y = np.average(value_matches)
-        fs_n = np.average(complement_matches)
-        return abs(fs_y - fs_n)
+        f_yy = total / count if count > 0 else np.nan
+        with np.errstate(divide="ignore", invalid="ignore"):
+            delta_fs = np.abs(f_yy - sums_with_one / counts_with_one)
+        delta_fs[insufficient] = 0  # panic
+        return delta_fs
+
+    def get_delta_fs_of_ps_bivariate(self, ps: PS) -> np.ndarray:
+        """
+        Returns a table where [i, j], for i < j, is f(a, b) + f(not a, not b) - f(not a, b) - f(a, not b),
+        where a and b are the i-th and j-th fixed loci of ps. All obtained from a single pass over the PRef
+        """
+        count, total, counts_with_one, sums_with_one, counts_with_two, sums_with_two = self.pRef.hamming_ball_stats(ps)
+
+        f_yy = total / count if count > 0 else np.nan
+        with np.errstate(divide="ignore", invalid="ignore"):
+            f_one = sums_with_one / counts_with_one
+            f_nn = sums_with_two / counts_with_two
+        f_ny = f_one[:, np.newaxis]
+        f_yn = f_one[np.newaxis, :]
+        delta_fs = f_yy + f_nn - f_yn - f_ny
+
+        insufficient = (count == 0) | (counts_with_two == 0) | (counts_with_one[:, np.newaxis] == 0) | (counts_with_one[np.newaxis, :] == 0)
+        delta_fs[insufficient] = 0  # panic
+        return np.triu(delta_fs, k=1)
 
-    def get_delta_f_of_ps_at_loci_bivariate(self, ps: PS, locus_a: int, locus_b: int) -> float:
-        fs = self.get_bivariate_perturbation_fitnesses(ps, locus_a, locus_b)
-        fs_yy, fs_ny, fs_yn, fs_nn = fs
-        if any(len(fs) == 0 for fs in fs):
-            # warnings.warn(
-            #    f"Encountered a Core with insufficient observations ({ps}) when calculating bivLocal perturbation")
-            return 0  # panic
-
-        f_yy = np.average(fs_yy)
-        f_yn = np.average(fs_yn)
-        f_ny = np.average(fs_ny)
-        f_nn = np.average(fs_nn)
+    def get_delta_f_of_ps_at_locus_univariate(self, ps: PS, locus: int) -> float:
+        position = list(ps.get_fixed_variable_positions()).index(locus)
+        return float(self.get_delta_fs_of_ps_univariate(ps)[position])
 
-        return f_yy + f_nn - f_yn - f_ny
+    def get_delta_f_of_ps_at_loci_bivariate(self, ps: PS, locus_a: int, locus_b: int) -> float:
+        fixed_loci = list(ps.get_fixed_variable_positions())
+        position_a, position_b = sorted([fixed_loci.index(locus_a), fixed_loci.index(locus_b)])
+        return float(self.get_delta_fs_of_ps_bivariate(ps)[position_a, position_b])
 
 
 class UnivariateLocalPerturbation(Metric):
@@ -119,12 +119,10 @@ class UnivariateLocalPerturbation(Metric):
         self.linkage_calculator = LocalPerturbationCalculator(pRef)
 
     def get_local_importance_array(self, ps: PS):
-        fixed_loci = ps.get_fixed_variable_positions()
-        return [self.linkage_calculator.get_delta_f_of_ps_at_locus_univariate(ps, i) for i in fixed_loci]
+        return list(self.linkage_calculator.get_delta_fs_of_ps_univariate(ps))
 
     def get_single_score(self, ps: PS) -> float:
-        fixed_loci = ps.get_fixed_variable_positions()
-        dfs = [self.linkage_calculator.get_delta_f_of_ps_at_locus_univariate(ps, i) for i in fixed_loci]
+        dfs = self.linkage_calculator.get_delta_fs_of_ps_univariate(ps)
         return np.average(dfs)
 
     def get_single_normalised_score(self, ps: PS) -> float:
@@ -155,10 +153,8 @@ class BivariateLocalPerturbation(Metric):
                 return self.linkage_calculator.get_delta_f_of_ps_at_locus_univariate(ps, fixed_locus)
             else:
                 return 0
-        fixed_loci = ps.get_fixed_variable_positions()
-        pairs = list(itertools.combinations(fixed_loci, r=2))
-        dfs = [self.linkage_calculator.get_delta_f_of_ps_at_loci_bivariate(ps, a, b) for a, b in pairs]
-        return np.average(dfs)
+        delta_fs = self.linkage_calculator.get_delta_fs_of_ps_bivariate(ps)
+        return np.average(delta_fs[np.triu_indices(ps.fixed_count(), k=1)])
 
     def get_single_normalised_score(self, ps: PS) -> float:
         if ps.fixed_count() < 2:
@@ -173,15 +169,6 @@ class BivariateLocalPerturbation(Metric):
         return perturbation_normalised
 
     def get_local_linkage_table(self, ps: PS) -> np.ndarray:
-        fixed_loci = ps.get_fixed_variable_positions()
-        locus_index_within_loci = {locus: position for position, locus in enumerate(fixed_loci)}
-        pairs = list(itertools.combinations(fixed_loci, r=2))
-
-        linkage_table = np.zeros((ps.fixed_count(), ps.fixed_count()), dtype=float)
-        for a, b in pairs:
-            x = locus_index_within_loci[a]
-            y = locus_index_within_loci[b]
-            linkage_table[x, y] = self.linkage_calculator.get_delta_f_of_ps_at_loci_bivariate(ps, a, b)
-
+        linkage_table = self.linkage_calculator.get_delta_fs_of_ps_bivariate(ps)
         linkage_table += linkage_table.T
         return np.sqrt(linkage_table)
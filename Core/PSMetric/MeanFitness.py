@@ -2,7 +2,7 @@ from typing import Optional
 
 import numpy as np
 
-from Core.PRef import PRef
+from Core.PRef import PRef, means_from_observation_stats
 from Core.PS import PS
 from Core.PSMetric.Metric import Metric
 
@@ -33,29 +33,40 @@ class MeanFitness(Metric):
         return "MeanFitness"
 
     def get_single_score_removed(self, ps: PS) -> float:
-        observed_fitnesses = self.pRef.fitnesses_of_observations(ps)
+        observed_fitnesses, weights = self.pRef.fitnesses_and_weights_of_observations(ps)
         if len(observed_fitnesses) == 0:
             # warnings.warn(f"The passed Core {ps} has no observations, and thus the MeanFitness could not be calculated")
             return -1
 
-        return np.average(observed_fitnesses)
+        return np.average(observed_fitnesses, weights=weights)
 
     def get_single_score(self, ps: PS) -> float:
-        observed_fitnesses = self.pRef.fitnesses_of_observations(ps)
+        observed_fitnesses, weights = self.pRef.fitnesses_and_weights_of_observations(ps)
         if len(observed_fitnesses) == 0:
             # warnings.warn(f"The passed Core {ps} has no observations, and thus the MeanFitness could not be calculated")
             return 0
 
-        return np.average(observed_fitnesses)
+        return np.average(observed_fitnesses, weights=weights)
 
 
     def get_single_normalised_score(self, ps: PS) -> float:
-        observed_fitnesses = self.normalised_pRef.fitnesses_of_observations(ps)
+        observed_fitnesses, weights = self.normalised_pRef.fitnesses_and_weights_of_observations(ps)
         if len(observed_fitnesses) == 0:
             # warnings.warn(f"The passed Core {ps} has no observations, and thus the MeanFitness could not be calculated")
             return 0
 
-        return np.average(observed_fitnesses)
+        return np.average(observed_fitnesses, weights=weights)
+
+    def get_scores_batch(self, ps_matrix: np.ndarray) -> np.ndarray:
+        counts, sums, _ = self.pRef.observation_stats(ps_matrix)
+        return means_from_observation_stats(counts, sums, invalid_value=0)
+
+    def get_normalised_scores_batch(self, ps_matrix: np.ndarray) -> np.ndarray:
+        counts, sums, _ = self.normalised_pRef.observation_stats(ps_matrix)
+        return means_from_observation_stats(counts, sums, invalid_value=0)
+
+    def get_standard_errors_batch(self, ps_matrix: np.ndarray) -> np.ndarray:
+        return self.pRef.standard_errors_of_means(ps_matrix)
 
 
 class ChanceOfGood(Metric):
@@ -70,17 +81,16 @@ class ChanceOfGood(Metric):
     def set_pRef(self, pRef: PRef):
         self.pRef = pRef
 
-        self.median_fitness = float(np.median(pRef.fitness_array))
+        self.median_fitness = float(np.median(pRef.repeat_by_weights(slice(None))))
 
     def __repr__(self):
         return "ChanceOfGood"
 
     def get_single_normalised_score(self, ps: PS) -> float:
-        observations = self.pRef.fitnesses_of_observations(ps)
+        observations, weights = self.pRef.fitnesses_and_weights_of_observations(ps)
         if len(observations) == 0:
             return 0
 
-        amount_which_are_better_than_median = sum([1 for observation in observations
-                                                   if observation > self.median_fitness])
+        amount_which_are_better_than_median = np.sum(weights[observations > self.median_fitness])
 
-        return amount_which_are_better_than_median / len(observations)
+        return amount_which_are_better_than_median / np.sum(weights)
@@ -1,3 +1,4 @@
+import inspect
 from typing import Iterable
 
 import numpy as np
@@ -17,6 +18,23 @@ class Metric:
         """ Return a string which describes the Criterion, eg 'Robustness' """
         raise Exception(f"Error: a realisation of PSMetric does not implement __repr__")
 
+    def get_parameters(self) -> dict:
+        """the values of the constructor parameters, which are stored in attributes of the same name"""
+        names = [name for name in inspect.signature(type(self).__init__).parameters if name != "self"]
+        return {name: getattr(self, name) for name in names if hasattr(self, name)}
+
+    def get_fresh_copy(self):
+        """a new instance with the same constructor parameters, which still needs set_pRef.
+        The parameters which are metrics (eg those of Averager) are fresh copies too, so nothing is shared with self"""
+        def fresh_copy_of_parameter(value):
+            if isinstance(value, Metric):
+                return value.get_fresh_copy()
+            if isinstance(value, (list, tuple)):
+                return type(value)(fresh_copy_of_parameter(item) for item in value)
+            return value
+
+        return type(self)(**{name: fresh_copy_of_parameter(value) for name, value in self.get_parameters().items()})
+
     def set_pRef(self, pRef: PRef):
         raise Exception(f"Error: a realisation of PSMetric({self.__repr__()}) does not implement set_pRef")
 
@@ -28,10 +46,29 @@ class Metric:
         raise Exception(
             f"Error: a realisation of PSMetric({self.__repr__()}) does not implement get_single_normalised_score")
 
+    def update(self, new_rows: np.ndarray, new_fitnesses: ArrayOfFloats):
+        """Includes new solutions in the PRef, for the metrics that can do this without starting from zero"""
+        raise Exception(f"Error: a realisation of PSMetric({self.__repr__()}) does not implement update")
+
     def get_unnormalised_scores(self, pss: Iterable[PS]) -> ArrayOfFloats:
         """default implementation, subclasses might overwrite this"""
         return np.array([self.get_single_score(ps) for ps in pss])
 
+    def get_scores_batch(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        """get_single_score for each row of ps_matrix (where * is represented by -1).
+        This is the default implementation, subclasses might overwrite it with a vectorised one"""
+        return np.array([self.get_single_score(PS(values)) for values in ps_matrix], dtype=float)
+
+    def get_normalised_scores_batch(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        """get_single_normalised_score for each row of ps_matrix (where * is represented by -1).
+        This is the default implementation, subclasses might overwrite it with a vectorised one"""
+        return np.array([self.get_single_normalised_score(PS(values)) for values in ps_matrix], dtype=float)
+
+
+    def get_standard_errors_batch(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        """The standard errors of get_scores_batch, for when the PRef is a sample (eg PRef.sketch).
+        They are nan when the metric can't estimate them"""
+        return np.full(len(ps_matrix), np.nan)
 
 
 
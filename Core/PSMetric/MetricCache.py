@@ -0,0 +1,192 @@
+"""
+A memoisation layer for the scores of PSs, which can be shared between metrics, miners and the explanation.
+
+The scores are keyed by (the fingerprint of the PRef, the identity of the metric, the values of the PS),
+so the same cache can hold the scores of many metrics over many PRefs without mixing them up.
+The cache has a bounded amount of entries and uses LRU eviction. Optionally, the evicted entries are spilled
+onto a shelve file, which can also be flushed at the end of a run so that a later session (eg a Detector) can
+reuse the scores calculated while mining.
+"""
+import hashlib
+import shelve
+from collections import OrderedDict
+from typing import Optional, Callable, Any
+
+import numpy as np
+
+from Core.PRef import PRef
+from Core.PS import PS
+from Core.PSMetric.Metric import Metric
+from Core.custom_types import ArrayOfFloats
+
+
+class MetricCache:
+    capacity: int
+    cached_scores: OrderedDict[bytes, float]
+
+    spill_file: Optional[str]
+    spilled_scores: Optional[shelve.Shelf]  # the keys are hashes of the keys of cached_scores
+
+    hits: int
+    disk_hits: int
+    misses: int
+
+    def __init__(self, capacity: int = 2 ** 20, spill_file: Optional[str] = None):
+        self.capacity = capacity
+        self.cached_scores = OrderedDict()
+        self.spill_file = spill_file
+        self.spilled_scores = None if spill_file is None else shelve.open(spill_file)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return (f"MetricCache({len(self.cached_scores)} entries, "
+                f"hits = {self.hits}, disk hits = {self.disk_hits}, misses = {self.misses})")
+
+    def get_statistics(self) -> dict:
+        total_queries = self.hits + self.disk_hits + self.misses
+        return {"hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / total_queries if total_queries > 0 else 0.0,
+                "entries": len(self.cached_scores)}
+
+    @staticmethod
+    def key_of(pRef_fingerprint: str, metric_identity: str, ps_values: np.ndarray) -> bytes:
+        header = f"{pRef_fingerprint}|{metric_identity}|".encode()
+        return header + np.asarray(ps_values, dtype=np.int64).tobytes()
+
+    @staticmethod
+    def spill_key_of(key: bytes) -> str:
+        return hashlib.blake2b(key, digest_size=20).hexdigest()
+
+    def get(self, key: bytes) -> Optional[float]:
+        score = self.cached_scores.get(key)
+        if score is not None:
+            self.hits += 1
+            self.cached_scores.move_to_end(key)
+            return score
+
+        if self.spilled_scores is not None:
+            score = self.spilled_scores.get(self.spill_key_of(key))
+            if score is not None:
+                self.disk_hits += 1
+                self.put(key, score)
+                return score
+
+        self.misses += 1
+        return None
+
+    def put(self, key: bytes, score: float):
+        self.cached_scores[key] = score
+        self.cached_scores.move_to_end(key)
+        while len(self.cached_scores) > self.capacity:
+            evicted_key, evicted_score = self.cached_scores.popitem(last=False)
+            if self.spilled_scores is not None:
+                self.spilled_scores[self.spill_key_of(evicted_key)] = evicted_score
+
+    def flush(self):
+        """writes all of the entries in memory onto the spill file, if there is one"""
+        if self.spilled_scores is None:
+            return
+        for key, score in self.cached_scores.items():
+            self.spilled_scores[self.spill_key_of(key)] = score
+        self.spilled_scores.sync()
+
+    def close(self):
+        if self.spilled_scores is not None:
+            self.flush()
+            self.spilled_scores.close()
+            self.spilled_scores = None
+
+    def clear(self):
+        self.cached_scores.clear()
+
+
+def get_identity_of_metric(metric: Any) -> str:
+    """
+    The class of the metric and the values of its constructor parameters (see Metric.get_parameters),
+    eg Linkage(top_k=2), so that metrics of the same class with different settings are told apart
+    """
+    if isinstance(metric, (list, tuple)):
+        return "[" + ", ".join(get_identity_of_metric(item) for item in metric) + "]"
+    if not isinstance(metric, Metric):
+        return repr(metric)
+
+    settings = [f"{name}={get_identity_of_metric(value)}" for name, value in metric.get_parameters().items()]
+    return f"{type(metric).__qualname__}({', '.join(settings)})"
+
+
+class CachedMetric(Metric):
+    """Wraps any metric, so that its scores are obtained from a MetricCache when possible"""
+    metric: Metric
+    cache: MetricCache
+    identity: str
+    pRef_fingerprint: Optional[str]
+
+    def __init__(self, metric: Metric, cache: MetricCache, identity: Optional[str] = None):
+        # Metric.__init__ is not called, since used_evaluations belongs to the wrapped metric
+        self.metric = metric
+        self.cache = cache
+        self.identity = get_identity_of_metric(metric) if identity is None else identity
+        self.pRef_fingerprint = None
+
+    def __repr__(self):
+        return repr(self.metric)
+
+    @property
+    def used_evaluations(self) -> int:
+        return self.metric.used_evaluations
+
+    @used_evaluations.setter
+    def used_evaluations(self, value: int):
+        self.metric.used_evaluations = value
+
+    def set_pRef(self, pRef: PRef):
+        self.metric.set_pRef(pRef)
+        self.pRef_fingerprint = pRef.fingerprint()
+
+    def get_cached_scores(self,
+                          ps_matrix: np.ndarray,
+                          kind: str,
+                          calculate_scores: Callable[[np.ndarray], ArrayOfFloats]) -> ArrayOfFloats:
+        """the scores that are not in the cache are calculated together, using calculate_scores"""
+        ps_matrix = np.asarray(ps_matrix)
+        keys = [self.cache.key_of(self.pRef_fingerprint, f"{self.identity}:{kind}", values) for values in ps_matrix]
+        scores = np.empty(len(keys), dtype=float)
+        missing_rows_by_key = {}  # the duplicated PSs are only calculated once
+        for row, key in enumerate(keys):
+            if key in missing_rows_by_key:
+                missing_rows_by_key[key].append(row)
+                self.cache.hits += 1  # it will not be calculated again
+                continue
+            score = self.cache.get(key)
+            if score is None:
+                missing_rows_by_key[key] = [row]
+            else:
+                scores[row] = score
+        if len(missing_rows_by_key) == 0:
+            return scores
+
+        first_rows = [rows[0] for rows in missing_rows_by_key.values()]
+        calculated_scores = calculate_scores(ps_matrix[first_rows])
+        for (key, rows), score in zip(missing_rows_by_key.items(), calculated_scores):
+            self.cache.put(key, float(score))
+            scores[rows] = score
+        return scores
+
+    def get_single_score(self, ps: PS) -> float:
+        return float(self.get_scores_batch(ps.values.reshape((1, -1)))[0])
+
+    def get_single_normalised_score(self, ps: PS) -> float:
+        return float(self.get_normalised_scores_batch(ps.values.reshape((1, -1)))[0])
+
+    def get_scores_batch(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        return self.get_cached_scores(ps_matrix, "score", self.metric.get_scores_batch)
+
+    def get_normalised_scores_batch(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        return self.get_cached_scores(ps_matrix, "normalised", self.metric.get_normalised_scores_batch)
+
+    def get_standard_errors_batch(self, ps_matrix: np.ndarray) -> ArrayOfFloats:
+        return self.metric.get_standard_errors_batch(ps_matrix)
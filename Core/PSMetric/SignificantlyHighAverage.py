@@ -19,16 +19,23 @@ class SignificantlyHighAverage(Metric):
 
     def set_pRef(self, pRef: PRef):
         self.pRef = pRef
-        self.pRef_mean = np.average(self.pRef.fitness_array)
+        self.pRef_mean = self.pRef.mean_fitness()
 
     def __repr__(self):
         return "Significance of Core"
 
+    def get_observation_summary(self, ps: PS) -> (float, float, float):
+        """the amount of observations, their mean and their (population) standard deviation, taking the weights into account"""
+        observations, weights = self.pRef.fitnesses_and_weights_of_observations(ps)
+        n = np.sum(weights)
+        if n == 0:
+            return 0, np.nan, np.nan
+        sample_mean = np.average(observations, weights=weights)
+        sample_stdev = np.sqrt(np.average(np.square(observations - sample_mean), weights=weights))
+        return n, sample_mean, sample_stdev
+
     def get_p_value_and_sample_mean(self, ps: PS) -> (float, float):
-        observations = self.pRef.fitnesses_of_observations(ps)
-        n = len(observations)
-        sample_mean = np.average(observations)
-        sample_stdev = np.std(observations)
+        n, sample_mean, sample_stdev = self.get_observation_summary(ps)
 
         if n < 1 or sample_stdev == 0:
             return -1, -1
@@ -39,10 +46,7 @@ class SignificantlyHighAverage(Metric):
 
     def get_single_normalised_score(self, ps: PS) -> float:
         self.used_evaluations += 1
-        observations = self.pRef.fitnesses_of_observations(ps)
-        n = len(observations)
-        sample_mean = np.average(observations)
-        sample_stdev = np.std(observations)
+        n, sample_mean, sample_stdev = self.get_observation_summary(ps)
 
         if n < 1 or sample_stdev == 0:
             return 0
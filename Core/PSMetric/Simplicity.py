@@ -20,3 +20,12 @@ class Simplicity(Metric):
 
     def get_single_normalised_score(self, ps: PS) -> float:
         return float(np.sum(ps.values == STAR) / len(ps))
+
+    def get_scores_batch(self, ps_matrix: np.ndarray) -> np.ndarray:
+        return np.sum(ps_matrix == STAR, axis=1).astype(float)
+
+    def get_normalised_scores_batch(self, ps_matrix: np.ndarray) -> np.ndarray:
+        return np.sum(ps_matrix == STAR, axis=1) / ps_matrix.shape[1]
+
+    def get_standard_errors_batch(self, ps_matrix: np.ndarray) -> np.ndarray:
+        return np.zeros(len(ps_matrix))  # it doesn't depend on the PRef
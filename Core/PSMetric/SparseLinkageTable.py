@@ -0,0 +1,173 @@
+"""
+A linkage table which only keeps the strongest partners of each variable, for search spaces with thousands of variables.
+
+A dense d x d table of floats takes 8MB when d = 1000, and selecting the pairs of a PS from it used to require
+a d x d mask. Here, each variable keeps its top_k partners (the pairs are kept if either variable chose the other,
+so that the table stays symmetric), stored in CSR format (indptr, indices, data).
+The linkages of the fixed pairs of a PS are then gathered by only going through the partners of its fixed variables.
+When top_k >= d - 1 every pair is kept, and the results are the same as the dense table's.
+"""
+from typing import Callable
+
+import numpy as np
+from numba import njit
+
+from Core.PS import STAR
+from Core.custom_types import ArrayOfFloats, ArrayOfInts
+
+
+@njit
+def get_linkages_of_fixed_pairs_in_rows(indptr: ArrayOfInts,
+                                        indices: ArrayOfInts,
+                                        data: ArrayOfFloats,
+                                        ps_matrix: np.ndarray,
+                                        include_diagonal: bool) -> (ArrayOfFloats, ArrayOfInts):
+    """
+    For each row of ps_matrix, gathers the stored linkages between pairs of its fixed variables (var_a <= var_b).
+    :return: the linkages of all the rows, concatenated, and where the linkages of each row start (with an extra end)
+    """
+    amount_of_rows, amount_of_vars = ps_matrix.shape
+    starts = np.zeros(amount_of_rows + 1, dtype=np.int64)
+    for row in range(amount_of_rows):
+        amount_of_pairs = 0
+        for var_a in range(amount_of_vars):
+            if ps_matrix[row, var_a] == STAR:
+                continue
+            for entry in range(indptr[var_a], indptr[var_a + 1]):
+                var_b = indices[entry]
+                if (var_b > var_a or (include_diagonal and var_b == var_a)) and ps_matrix[row, var_b] != STAR:
+                    amount_of_pairs += 1
+        starts[row + 1] = starts[row] + amount_of_pairs
+
+    linkages = np.empty(starts[amount_of_rows], dtype=np.float64)
+    for row in range(amount_of_rows):
+        position = starts[row]
+        for var_a in range(amount_of_vars):
+            if ps_matrix[row, var_a] == STAR:
+                continue
+            for entry in range(indptr[var_a], indptr[var_a + 1]):
+                var_b = indices[entry]
+                if (var_b > var_a or (include_diagonal and var_b == var_a)) and ps_matrix[row, var_b] != STAR:
+                    linkages[position] = data[entry]
+                    position += 1
+    return linkages, starts
+
+
+def aggregate_linkages_of_rows(linkages: ArrayOfFloats,
+                               starts: ArrayOfInts,
+                               nan_aggregate: Callable,
+                               max_chunk_cells: int = 2 ** 22) -> (ArrayOfFloats, ArrayOfInts):
+    """
+    Aggregates the linkages of each row, given as in get_linkages_of_fixed_pairs_in_rows.
+    The linkages of the rows are placed in a matrix padded with nans, so nan_aggregate should ignore nans
+    (eg np.nanmean, np.nanmin, np.nanmedian), and the rows are processed in chunks to keep the memory bounded.
+    :return: the aggregates, which are nan when the row has no pairs or when one of its linkages is nan
+             (as the non-nan aggregates would give), and the amount of pairs of each row
+    """
+    amounts_of_pairs = np.diff(starts)
+    aggregates = np.full(len(amounts_of_pairs), np.nan)
+    rows_with_pairs = np.flatnonzero(amounts_of_pairs)
+    if len(rows_with_pairs) == 0:
+        return aggregates, amounts_of_pairs
+
+    chunk_size = max(1, max_chunk_cells // int(np.max(amounts_of_pairs)))
+    for chunk_start in range(0, len(rows_with_pairs), chunk_size):
+        rows = rows_with_pairs[chunk_start:chunk_start + chunk_size]
+        amounts = amounts_of_pairs[rows]
+        is_linkage = np.arange(np.max(amounts))[np.newaxis, :] < amounts[:, np.newaxis]
+        padded = np.full(is_linkage.shape, np.nan)
+        padded[is_linkage] = linkages[starts[rows[0]]:starts[rows[-1] + 1]]  # the rows are consecutive
+
+        chunk_aggregates = nan_aggregate(padded, axis=1)
+        chunk_aggregates[np.any(np.isnan(padded) & is_linkage, axis=1)] = np.nan
+        aggregates[rows] = chunk_aggregates
+    return aggregates, amounts_of_pairs
+
+
+class SparseLinkageTable:
+    amount_of_vars: int
+    top_k: int
+    indptr: ArrayOfInts  # the partners of var are indices[indptr[var]:indptr[var+1]], in increasing order
+    indices: ArrayOfInts
+    data: ArrayOfFloats
+
+    def __init__(self, amount_of_vars: int, top_k: int, indptr: ArrayOfInts, indices: ArrayOfInts, data: ArrayOfFloats):
+        self.amount_of_vars = amount_of_vars
+        self.top_k = top_k
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    def __repr__(self):
+        return f"SparseLinkageTable({self.amount_of_vars} vars, top_k = {self.top_k}, {len(self.data)} entries)"
+
+    @property
+    def shape(self) -> (int, int):
+        return self.amount_of_vars, self.amount_of_vars
+
+    @property
+    def nbytes(self) -> int:
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+    @classmethod
+    def from_dense(cls, table: np.ndarray, top_k: int, include_diagonal: bool = True):
+        """
+        Keeps the top_k partners of each variable (by decreasing linkage, where nans are the weakest),
+        mirrored so that the table is symmetric, and the diagonal if include_diagonal
+        """
+        amount_of_vars = table.shape[0]
+        amount_of_partners = min(top_k, amount_of_vars - 1)
+
+        kept = np.zeros(table.shape, dtype=bool)
+        if amount_of_partners > 0:
+            ranking = np.where(np.isnan(table), -np.inf, table)
+            np.fill_diagonal(ranking, -np.inf)  # the diagonal is not a partner
+            partners = np.argpartition(-ranking, amount_of_partners - 1, axis=1)[:, :amount_of_partners]
+            kept[np.arange(amount_of_vars)[:, np.newaxis], partners] = True
+            kept |= kept.T
+        np.fill_diagonal(kept, include_diagonal)
+
+        rows, columns = np.nonzero(kept)  # in row major order, as required by CSR
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=amount_of_vars)))).astype(np.int64)
+        return cls(amount_of_vars=amount_of_vars,
+                   top_k=top_k,
+                   indptr=indptr,
+                   indices=columns.astype(np.int64),
+                   data=np.asarray(table[rows, columns], dtype=np.float64))
+
+    def get_rows_of_entries(self) -> ArrayOfInts:
+        return np.repeat(np.arange(self.amount_of_vars), np.diff(self.indptr))
+
+    def with_values_from(self, table: np.ndarray):
+        """A table with the same pairs as this one, but the values of the given dense table (eg its normalised version)"""
+        return SparseLinkageTable(amount_of_vars=self.amount_of_vars,
+                                  top_k=self.top_k,
+                                  indptr=self.indptr,
+                                  indices=self.indices,
+                                  data=np.asarray(table[self.get_rows_of_entries(), self.indices], dtype=np.float64))
+
+    def to_dense(self, fill_value: float = np.nan) -> np.ndarray:
+        """the pairs which are not stored get fill_value"""
+        result = np.full(self.shape, fill_value, dtype=float)
+        result[self.get_rows_of_entries(), self.indices] = self.data
+        return result
+
+    def get_linkages_of_fixed_pairs(self, ps_values: ArrayOfInts, include_diagonal: bool = False) -> ArrayOfFloats:
+        linkages, _ = get_linkages_of_fixed_pairs_in_rows(self.indptr,
+                                                          self.indices,
+                                                          self.data,
+                                                          np.asarray(ps_values, dtype=np.int64).reshape((1, -1)),
+                                                          include_diagonal)
+        return linkages
+
+    def aggregate_linkages_of_fixed_pairs(self,
+                                          ps_matrix: np.ndarray,
+                                          nan_aggregate: Callable,
+                                          include_diagonal: bool = False) -> (ArrayOfFloats, ArrayOfInts):
+        """The same as Linkage.aggregate_linkages_of_fixed_pairs, but only the stored pairs are considered"""
+        linkages, starts = get_linkages_of_fixed_pairs_in_rows(self.indptr,
+                                                               self.indices,
+                                                               self.data,
+                                                               np.asarray(ps_matrix, dtype=np.int64),
+                                                               include_diagonal)
+        return aggregate_linkages_of_rows(linkages, starts, nan_aggregate)
@@ -0,0 +1,101 @@
+"""
+A folder of precomputed arrays (usually linkage tables), so that they are not recalculated every time
+a miner or the Detector is started on the same PRef.
+
+Each array is keyed by the fingerprint of the PRef, the name of the array and the parameters used to compute it,
+and it is stored as a .npy file together with a small .json file describing it, which is used to validate it
+when it is loaded. The arrays are only loaded when they are requested.
+"""
+import hashlib
+import json
+import os
+from typing import Callable, Optional
+
+import numpy as np
+
+
+class PrecomputationStore:
+    folder: str
+    loaded_arrays: dict[str, np.ndarray]
+
+    hits: int
+    misses: int
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.loaded_arrays = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"PrecomputationStore({self.folder}, hits = {self.hits}, misses = {self.misses})"
+
+    @staticmethod
+    def get_description(pRef_fingerprint: str, name: str, parameters: dict) -> dict:
+        return {"pRef_fingerprint": pRef_fingerprint,
+                "name": name,
+                "parameters": parameters}
+
+    @staticmethod
+    def key_of(description: dict) -> str:
+        digest = hashlib.blake2b(json.dumps(description, sort_keys=True).encode(), digest_size=16).hexdigest()
+        return f"{description['name']}_{digest}"
+
+    def get_paths(self, key: str) -> (str, str):
+        return os.path.join(self.folder, key + ".npy"), os.path.join(self.folder, key + ".json")
+
+    def load(self, key: str, description: dict) -> Optional[np.ndarray]:
+        """returns None when the array is missing, or when it does not match its description"""
+        array_path, description_path = self.get_paths(key)
+        if not (os.path.exists(array_path) and os.path.exists(description_path)):
+            return None
+        try:
+            with open(description_path, "r") as file:
+                stored_description = json.load(file)
+            array = np.load(array_path)
+        except (OSError, ValueError):
+            return None
+
+        expected_description = dict(description, shape=list(array.shape), dtype=str(array.dtype))
+        expected_description = json.loads(json.dumps(expected_description))  # eg tuples become lists
+        if stored_description != expected_description:
+            return None
+        return array
+
+    def save(self, key: str, description: dict, array: np.ndarray):
+        """the files are written under temporary names first, so that interrupted writes are never loaded"""
+        os.makedirs(self.folder, exist_ok=True)
+        array_path, description_path = self.get_paths(key)
+        np.save(array_path + ".tmp.npy", array)
+        with open(description_path + ".tmp", "w") as file:
+            json.dump(dict(description, shape=list(array.shape), dtype=str(array.dtype)), file, indent=4)
+        os.replace(array_path + ".tmp.npy", array_path)
+        os.replace(description_path + ".tmp", description_path)
+
+    def get_or_compute(self,
+                       pRef_fingerprint: str,
+                       name: str,
+                       parameters: dict,
+                       compute: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        :param pRef_fingerprint: from PRef.fingerprint()
+        :param name: the name of the array, which is also used as the prefix of the file name
+        :param parameters: anything else that the array depends on, it has to be serialisable as json
+        :param compute: used when the array is not stored (or is not valid)
+        """
+        description = self.get_description(pRef_fingerprint, name, parameters)
+        key = self.key_of(description)
+        array = self.loaded_arrays.get(key)
+        if array is None:
+            array = self.load(key, description)
+
+        if array is None:
+            self.misses += 1
+            array = np.array(compute())  # a copy, since compute might return an array that its owner modifies
+            self.save(key, description, array)
+        else:
+            self.hits += 1
+
+        array.setflags(write=False)  # the same array is given to every caller
+        self.loaded_arrays[key] = array
+        return array
@@ -0,0 +1,124 @@
+"""
+A query planner for the observations of a PS in a PRef.
+
+The frequencies of each (var, val) pair are precomputed, so that the fixed values of a PS can be applied
+from the rarest (ie the most selective) to the most common. While the candidate rows are many,
+they are filtered using full column comparisons, but once they become few the filtering is done
+only on their row ids, and if posting lists are available the rarest value doesn't even need a column scan.
+"""
+from typing import Optional
+
+import numpy as np
+
+from Core.PS import STAR
+from Core.SearchSpace import SearchSpace
+from Core.custom_types import ArrayOfInts
+
+
+class QueryPlanner:
+    full_solution_matrix: np.ndarray
+    offsets: ArrayOfInts  # where each variable starts in the hot encoded arrays, ie search_space.precomputed_offsets
+    frequencies: ArrayOfInts  # how many rows have each (var, val), hot encoded
+    posting_lists: Optional[list[ArrayOfInts]]  # for each var, the row ids sorted by the value they have (then by row id)
+    posting_starts: Optional[ArrayOfInts]  # where the rows of each (var, val) start within posting_lists[var]
+    row_id_threshold: int  # below this amount of candidates, the filtering uses row ids instead of full columns
+
+    queries: int
+    rows_scanned: int
+    last_rows_scanned: int
+
+    def __init__(self,
+                 full_solution_matrix: np.ndarray,
+                 search_space: SearchSpace,
+                 use_posting_lists: bool = False,
+                 row_id_threshold: float = 0.05):
+        """
+        :param full_solution_matrix: the matrix of the PRef
+        :param search_space: the search space of the PRef
+        :param use_posting_lists: whether to precompute the row ids for each (var, val). Uses 4 bytes per cell
+                                  (int32 row ids), ie 4 times the memory of the compact (int8) matrix
+        :param row_id_threshold: the proportion of the sample size below which row ids are used
+        """
+        self.full_solution_matrix = full_solution_matrix
+        self.offsets = search_space.precomputed_offsets
+        sample_size = full_solution_matrix.shape[0]
+        self.row_id_threshold = int(row_id_threshold * sample_size)
+
+        def value_counts(var: int) -> ArrayOfInts:
+            return np.bincount(full_solution_matrix[:, var], minlength=search_space.cardinalities[var])
+
+        self.frequencies = np.concatenate([value_counts(var) for var in range(search_space.amount_of_parameters)])
+
+        if use_posting_lists:
+            row_id_dtype = np.int32 if sample_size < np.iinfo(np.int32).max else np.int64
+            self.posting_lists = [np.argsort(full_solution_matrix[:, var], kind="stable").astype(row_id_dtype)
+                                  for var in range(search_space.amount_of_parameters)]
+            self.posting_starts = np.concatenate([np.concatenate(([0], np.cumsum(value_counts(var))[:-1]))
+                                                  for var in range(search_space.amount_of_parameters)])
+        else:
+            self.posting_lists = None
+            self.posting_starts = None
+
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        self.queries = 0
+        self.rows_scanned = 0
+        self.last_rows_scanned = 0
+
+    def get_statistics(self) -> dict:
+        return {"queries": self.queries,
+                "rows_scanned": self.rows_scanned,
+                "average_rows_scanned": self.rows_scanned / self.queries if self.queries > 0 else 0.0,
+                "last_rows_scanned": self.last_rows_scanned}
+
+    def get_plan(self, ps_values: ArrayOfInts) -> (ArrayOfInts, ArrayOfInts):
+        """returns the fixed variables and their values, from the most selective to the least selective"""
+        fixed_vars = np.flatnonzero(ps_values != STAR)
+        fixed_vals = ps_values[fixed_vars]
+        order = np.argsort(self.frequencies[self.offsets[fixed_vars] + fixed_vals], kind="stable")
+        return fixed_vars[order], fixed_vals[order]
+
+    def get_posting_list(self, var: int, val: int) -> ArrayOfInts:
+        which = self.offsets[var] + val
+        start = self.posting_starts[which]
+        return self.posting_lists[var][start:start + self.frequencies[which]]
+
+    def get_matching_rows(self, ps_values: ArrayOfInts) -> np.ndarray:
+        """
+        Returns the rows which match the PS, in increasing order.
+        The result is either a boolean mask or an array of row ids, and both can be used to index the fitnesses
+        """
+        fixed_vars, fixed_vals = self.get_plan(ps_values)
+        sample_size = self.full_solution_matrix.shape[0]
+        rows_scanned = 0
+
+        mask = None
+        row_ids = None
+        if len(fixed_vars) == 0:
+            row_ids = np.arange(sample_size)
+
+        for var, val in zip(fixed_vars, fixed_vals):
+            column = self.full_solution_matrix[:, var]
+            val = int(val)
+            if row_ids is not None:
+                rows_scanned += len(row_ids)
+                row_ids = row_ids[column[row_ids] == val]
+            elif mask is not None:
+                rows_scanned += sample_size
+                np.logical_and(mask, column == val, out=mask)
+            elif self.posting_lists is not None and self.frequencies[self.offsets[var] + val] <= self.row_id_threshold:
+                row_ids = self.get_posting_list(var, val)
+                rows_scanned += len(row_ids)
+            else:
+                rows_scanned += sample_size
+                mask = column == val
+
+            if mask is not None and np.count_nonzero(mask) <= self.row_id_threshold:
+                row_ids = np.flatnonzero(mask)
+                mask = None
+
+        self.queries += 1
+        self.rows_scanned += rows_scanned
+        self.last_rows_scanned = rows_scanned
+        return mask if mask is not None else row_ids
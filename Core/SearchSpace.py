@@ -18,6 +18,15 @@ class SearchSpace(Sized):
     def hot_encoded_length(self) -> int:
         return int(np.sum(self.cardinalities))
 
+    @property
+    def compact_dtype(self) -> np.dtype:
+        """The narrowest signed integer type which can hold all the values, and also -1, which represents * in PSs"""
+        largest_value = int(np.max(self.cardinalities, initial=1)) - 1
+        for dtype in (np.int8, np.int16, np.int32):
+            if largest_value <= np.iinfo(dtype).max:
+                return np.dtype(dtype)
+        return np.dtype(np.int64)
+
     @property
     def dimensions(self) -> int:
         return len(self.cardinalities)
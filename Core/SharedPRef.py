@@ -0,0 +1,164 @@
+"""
+Sharing a PRef between processes without copying it, using multiprocessing.shared_memory.
+
+The owner process copies the arrays of the PRef (and the tables of its marginals, if calculated) into shared memory
+segments once, and the workers attach to them by name, obtaining a PRef whose arrays are read-only views of the
+same buffers. The names, dtypes and shapes of the arrays are stored as json in a small metadata segment,
+whose name is the only thing that needs to be sent to the workers.
+
+Lifecycle:
+    - the owner unlinks the segments when close() is called, when the SharedPRef is garbage collected, or at exit.
+      If the owner crashes, the resource tracker of multiprocessing unlinks them.
+    - the workers never unlink the segments, so a worker crashing doesn't affect the owner or the other workers.
+      The workers started by multiprocessing share the resource tracker of the owner, so registering the segments
+      again when attaching is harmless (and unregistering them would remove the registration of the owner).
+      In python >= 3.13 the workers don't register them at all.
+
+Usage, where the workers receive only the name (as in BivariateANOVALinkage.get_bivariate_tables):
+    def worker(name: str):
+        pRef = PRef.attach(name)
+        ...
+
+    with pRef.to_shared_memory() as shared_pRef, ProcessPoolExecutor(mp_context=get_context("spawn")) as executor:
+        results = list(executor.map(worker, [shared_pRef.name] * amount_of_tasks))
+
+The workers should be started with the "spawn" (or "forkserver") start method: once numba's threading layer
+has started (ie a parallel kernel ran, see USE_PARALLEL_KERNELS in Core.PRef), forking the owner is unsafe,
+and the owner can hang, eg at exit.
+"""
+import json
+import secrets
+import weakref
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional
+
+import numpy as np
+
+from Core.PRef import PRef
+from Core.PRefMarginals import PRefMarginals
+from Core.SearchSpace import SearchSpace
+
+METADATA_LENGTH_BYTES = 8  # the metadata segment starts with the length of the json, since segments can be rounded up
+
+MARGINAL_TABLE_NAMES = ["univariate_counts", "univariate_sums", "univariate_sums_of_squares",
+                        "bivariate_counts", "bivariate_sums", "bivariate_sums_of_squares"]
+
+
+def attach_to_segment(name: str) -> SharedMemory:
+    """see the module docstring about the resource tracker"""
+    try:
+        return SharedMemory(name=name, track=False)  # python >= 3.13
+    except TypeError:
+        return SharedMemory(name=name)
+
+
+def release_segments(segments: list[SharedMemory], unlink: bool):
+    for segment in segments:
+        try:
+            segment.close()
+        except BufferError:
+            pass  # some arrays still use the buffer, it will be unmapped when they are garbage collected
+        if unlink:
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class SharedPRef:
+    name: str  # the name of the metadata segment
+    is_owner: bool
+    segments: list[SharedMemory]
+    pRef: Optional[PRef]  # only for the workers, the owner already has the original PRef
+
+    def __init__(self, name: str, is_owner: bool, segments: list[SharedMemory], pRef: Optional[PRef] = None):
+        self.name = name
+        self.is_owner = is_owner
+        self.segments = segments
+        self.pRef = pRef
+        # this doesn't reference self, so that the SharedPRef can be garbage collected. It is also called at exit
+        self.finalizer = weakref.finalize(self, release_segments, segments, is_owner)
+
+    def __repr__(self):
+        return f"SharedPRef({self.name}, {'owner' if self.is_owner else 'attached'}, {len(self.segments)} segments)"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """releases the segments, which are also unlinked if this is the owner"""
+        self.finalizer()
+
+    @classmethod
+    def create(cls, pRef: PRef):
+        arrays = {"full_solution_matrix": np.ascontiguousarray(pRef.full_solution_matrix,
+                                                               dtype=pRef.search_space.compact_dtype),
+                  "fitness_array": np.ascontiguousarray(pRef.fitness_array)}
+        if pRef.weights is not None:
+            arrays["weights"] = np.ascontiguousarray(pRef.weights)
+        if pRef.cached_marginals is not None:
+            for table_name in MARGINAL_TABLE_NAMES:
+                table = getattr(pRef.cached_marginals, table_name)
+                if table is not None:
+                    arrays["marginals." + table_name] = table
+
+        segments = []
+        try:
+            descriptions = {}
+            for array_name, array in arrays.items():
+                segment = SharedMemory(create=True, size=max(array.nbytes, 1))
+                segments.append(segment)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+                descriptions[array_name] = {"segment": segment.name, "dtype": str(array.dtype), "shape": list(array.shape)}
+
+            metadata = json.dumps({"cardinalities": [int(cardinality) for cardinality in pRef.search_space.cardinalities],
+                                   "arrays": descriptions}).encode()
+            name = "pRef_" + secrets.token_hex(8)
+            metadata_segment = SharedMemory(name=name, create=True, size=METADATA_LENGTH_BYTES + len(metadata))
+            segments.append(metadata_segment)
+            metadata_segment.buf[:METADATA_LENGTH_BYTES] = len(metadata).to_bytes(METADATA_LENGTH_BYTES, "little")
+            metadata_segment.buf[METADATA_LENGTH_BYTES:METADATA_LENGTH_BYTES + len(metadata)] = metadata
+        except BaseException:
+            release_segments(segments, unlink=True)
+            raise
+
+        return cls(name=name, is_owner=True, segments=segments)
+
+    @classmethod
+    def attach(cls, name: str):
+        metadata_segment = attach_to_segment(name)
+        segments = [metadata_segment]
+        try:
+            metadata_length = int.from_bytes(metadata_segment.buf[:METADATA_LENGTH_BYTES], "little")
+            metadata = json.loads(bytes(metadata_segment.buf[METADATA_LENGTH_BYTES:METADATA_LENGTH_BYTES + metadata_length]))
+
+            arrays = {}
+            for array_name, description in metadata["arrays"].items():
+                segment = attach_to_segment(description["segment"])
+                segments.append(segment)
+                array = np.ndarray(description["shape"], dtype=np.dtype(description["dtype"]), buffer=segment.buf)
+                array.setflags(write=False)
+                arrays[array_name] = array
+        except BaseException:
+            release_segments(segments, unlink=False)
+            raise
+
+        search_space = SearchSpace(metadata["cardinalities"])
+        pRef = PRef(fitness_array=arrays["fitness_array"],
+                    full_solution_matrix=arrays["full_solution_matrix"],
+                    search_space=search_space,
+                    weights=arrays.get("weights"))
+        marginal_tables = {table_name: arrays.get("marginals." + table_name) for table_name in MARGINAL_TABLE_NAMES}
+        if marginal_tables["univariate_counts"] is not None:
+            pRef.cached_marginals = PRefMarginals.from_tables(pRef.full_solution_matrix,
+                                                              pRef.fitness_array,
+                                                              search_space,
+                                                              marginal_tables,
+                                                              weights=pRef.weights)
+
+        result = cls(name=name, is_owner=False, segments=segments, pRef=pRef)
+        pRef.shared_memory = result  # the segments need to stay open while the PRef is used
+        return result
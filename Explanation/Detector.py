@@ -337,7 +337,8 @@ class Detector:
     def generate_files_with_default_settings(self,
                                              pRef_size: Optional[int] = 10000,
                                              pss_budget: Optional[int] = 10000,
-                                             force_include_in_pRef: Optional[list[FullSolution]] = None):
+                                             force_include_in_pRef: Optional[list[FullSolution]] = None,
+                                             pss_sketch_size: Optional[int] = None):
 
         answer = input("Are you sure you want to regenerate the files?")
         if answer == "yessir":
@@ -348,7 +349,8 @@ class Detector:
             self.mined_ps_manager.generate_ps_file(pRef = self.pRef,
                                                    population_size=50,
                                                    ps_budget_in_total=pss_budget,
-                                                   ps_budget_per_run=1000)
+                                                   ps_budget_per_run=1000,
+                                                   sketch_size=pss_sketch_size)
             self.mined_ps_manager.generate_control_pss_file(samples_for_each_category=1000)
 
             self.ps_property_manager.generate_property_table_file(self.mined_ps_manager.pss, self.mined_ps_manager.control_pss)
@@ -74,7 +74,16 @@ class MinedPSManager:
                  pRef: PRef,
                  population_size: int,
                  ps_budget_per_run: int,
-                 ps_budget_in_total: int) -> list[EvaluatedPS]:
+                 ps_budget_in_total: int,
+                 sketch_size: Optional[int] = None) -> list[EvaluatedPS]:
+        """
+        :param sketch_size: if given, the PSs are mined on a sketch of pRef with this many rows (see PRef.sketch),
+                            and then the results are re-scored on the whole pRef
+        """
+        full_pRef = pRef
+        if sketch_size is not None and sketch_size < pRef.sample_size:
+            pRef = full_pRef.sketch(sketch_size, strategy="fitness")
+
         algorithm = SequentialCrowdingMiner(pRef = pRef,
                                             budget_per_run=ps_budget_per_run,
                                             population_size_per_run=population_size,
@@ -89,6 +98,12 @@ class MinedPSManager:
         result_ps = algorithm.get_results(None)
         result_ps = AbstractPSMiner.without_duplicates(result_ps)
         result_ps = [ps for ps in result_ps if not ps.is_empty()]
+        if pRef is not full_pRef:
+            # unlike ArchivePSMiner.get_results_rescored_on, there is no screening by the standard errors:
+            # all of the results are kept (there is no amount to reach), and they are sorted by atomicity,
+            # whose error on the sketch can't be estimated, so every result needs to be re-scored anyway
+            with announce(f"Re-scoring the {len(result_ps)} PSs mined on the sketch using {full_pRef}", self.verbose):
+                result_ps = SequentialCrowdingMiner.rescored_on(full_pRef, result_ps)
 
         return result_ps
 
@@ -97,13 +112,15 @@ class MinedPSManager:
                          pRef: PRef,
                          population_size: int,
                          ps_budget_per_run: int,
-                         ps_budget_in_total: int):
+                         ps_budget_in_total: int,
+                         sketch_size: Optional[int] = None):
 
         with announce(f"Mining the partial solutions"):
             self.cached_pss = self.mine_pss(pRef=pRef,
                                             population_size=population_size,
                                             ps_budget_in_total=ps_budget_in_total,
-                                            ps_budget_per_run=ps_budget_per_run)
+                                            ps_budget_per_run=ps_budget_per_run,
+                                            sketch_size=sketch_size)
 
 
 
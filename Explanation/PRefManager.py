@@ -1,3 +1,4 @@
+import os
 from math import ceil
 from typing import Optional, Literal
 
@@ -7,7 +8,9 @@ from scipy.stats import t
 from BenchmarkProblems.BenchmarkProblem import BenchmarkProblem
 from Core.FullSolution import FullSolution
 from Core.PRef import PRef, plot_solutions_in_pRef
+from Core.PRefBuilder import PRefBuilder
 from Core.PS import PS
+from Core.PrecomputationStore import PrecomputationStore
 from Core.PSMetric.Classic3 import Classic3PSEvaluator
 from PSMiners.Mining import get_history_pRef
 from utils import announce
@@ -20,13 +23,16 @@ class PRefManager:
     cached_pRef: Optional[PRef]
     pRef_mean: Optional[float]
     evaluator: Optional[Classic3PSEvaluator]
+    use_bitmap_index: bool  # the index reads every column, so memory mapped PRefs would be loaded entirely
 
     def __init__(self,
                  problem: BenchmarkProblem,
                  pRef_file: str,
-                 verbose: bool = False):
+                 verbose: bool = False,
+                 use_bitmap_index: bool = False):
         self.problem = problem
         self.pRef_file = pRef_file
+        self.use_bitmap_index = use_bitmap_index
         self.cached_pRef = None
         self.evaluator = None
         self.pRef_mean = None
@@ -48,22 +54,37 @@ class PRefManager:
                                  sample_size=sample_size_for_each,
                                  verbose=verbose)
 
-        pRefs = [make_pRef_with_method(method) for method in methods]
+        force_include = [] if force_include is None else force_include
+        builder = PRefBuilder(problem.search_space,
+                              initial_capacity=sample_size_for_each * len(methods) + len(force_include))
+        for method in methods:  # each PRef is released once it's copied into the builder
+            builder.append_pRef(make_pRef_with_method(method))
 
-        if force_include is not None and len(force_include) > 0:
-            forced_pRef = PRef.from_full_solutions(force_include,
-                                                   fitness_values=[problem.fitness_function(fs) for fs in force_include],
-                                                   search_space=problem.search_space)
-            pRefs.append(forced_pRef)
+        for forced_solution in force_include:
+            builder.append_solution(forced_solution, problem.fitness_function(forced_solution))
 
-        return PRef.concat(pRefs)
+        return builder.freeze()
 
     def instantiate_evaluator(self):
         self.evaluator = Classic3PSEvaluator(self.cached_pRef)
 
 
+    @property
+    def precomputation_folder(self) -> str:
+        """the tables of the metrics are stored next to the PRef (or inside it, if it is saved as a folder)"""
+        if os.path.isdir(self.pRef_file):
+            return os.path.join(self.pRef_file, "precomputed")
+        return os.path.splitext(self.pRef_file)[0] + "_precomputed"
+
+    def attach_precomputation_store(self):
+        self.cached_pRef.precomputation_store = PrecomputationStore(self.precomputation_folder)
+
+    def build_bitmap_index_if_used(self):
+        if self.use_bitmap_index:
+            self.cached_pRef.build_bitmap_index()
+
     def instantiate_mean(self):
-        self.pRef_mean = np.average(self.cached_pRef.fitness_array)
+        self.pRef_mean = self.cached_pRef.mean_fitness()
 
     def generate_pRef_file(self, sample_size: int,
                            which_algorithm,
@@ -77,6 +98,8 @@ class PRefManager:
                                                      force_include=force_include,
                                                      verbose=self.verbose)
         plot_solutions_in_pRef(self.cached_pRef)
+        self.build_bitmap_index_if_used()
+        self.attach_precomputation_store()
         #self.instantiate_evaluator()
         self.instantiate_mean()
 
@@ -90,16 +113,21 @@ class PRefManager:
     def pRef(self) -> PRef:
         if self.cached_pRef is None:
             self.cached_pRef = PRef.load(self.pRef_file)
+            self.build_bitmap_index_if_used()
+            self.attach_precomputation_store()
             #self.instantiate_evaluator()
             self.instantiate_mean()
         return self.cached_pRef
 
 
     def t_test_for_mean_with_ps(self, ps: PS) -> (float, float):
-        observations = self.pRef.fitnesses_of_observations(ps)
-        n = len(observations)
-        sample_mean = np.average(observations)
-        sample_stdev = np.std(observations)
+        # the observations are weighted, so that this also works for deduplicated PRefs and sketches
+        observations, weights = self.pRef.fitnesses_and_weights_of_observations(ps)
+        n = np.sum(weights)
+        if len(observations) == 0:
+            return -1, -1
+        sample_mean = np.average(observations, weights=weights)
+        sample_stdev = np.sqrt(np.average(np.square(observations - sample_mean), weights=weights))
 
         if n < 1 or sample_stdev == 0:
             return -1, -1
@@ -110,8 +138,12 @@ class PRefManager:
 
     def get_average_when_present_and_absent(self, ps: PS) -> (float, float):
         p_value, _ = self.t_test_for_mean_with_ps(ps)
-        observations, not_observations = self.pRef.fitnesses_of_observations_and_complement(ps)
-        return np.average(observations), np.average(not_observations)
+        observations, weights = self.pRef.fitnesses_and_weights_of_observations(ps)
+        all_weights = self.pRef.get_weights()
+        weight_present = np.sum(weights)
+        sum_present = np.sum(observations * weights)
+        return (sum_present / weight_present,
+                (np.sum(self.pRef.fitness_array * all_weights) - sum_present) / (np.sum(all_weights) - weight_present))
 
 
     def get_atomicity_contributions(self, ps: PS) -> np.ndarray:
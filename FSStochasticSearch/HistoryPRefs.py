@@ -1,7 +1,7 @@
 from BenchmarkProblems.BenchmarkProblem import BenchmarkProblem
 from Core import TerminationCriteria
-from Core.EvaluatedFS import EvaluatedFS
 from Core.PRef import PRef
+from Core.PRefBuilder import PRefBuilder
 from FSStochasticSearch.GA import GA
 from FSStochasticSearch.Operators import SinglePointFSMutation, TwoPointFSCrossover, TournamentSelection
 from FSStochasticSearch.SA import SA
@@ -26,14 +26,14 @@ def pRef_from_GA(benchmark_problem: BenchmarkProblem,
                    population_size=ga_population_size,
                    fitness_function=benchmark_problem.fitness_function)
 
-    solutions : list[EvaluatedFS] = []
-    solutions.extend(algorithm.current_population)
+    builder = PRefBuilder(benchmark_problem.search_space, initial_capacity=sample_size + ga_population_size)
+    builder.append_evaluated_solutions(algorithm.current_population)
 
-    while len(solutions) < sample_size:
+    while len(builder) < sample_size:
         algorithm.step()
-        solutions.extend(algorithm.current_population)
+        builder.append_evaluated_solutions(algorithm.current_population)
 
-    return PRef.from_evaluated_full_solutions(solutions, benchmark_problem.search_space)
+    return builder.freeze()
 
 def pRef_from_SA(benchmark_problem: BenchmarkProblem,
                  sample_size: int,
@@ -42,16 +42,15 @@ def pRef_from_SA(benchmark_problem: BenchmarkProblem,
                    search_space=benchmark_problem.search_space,
                    mutation_operator=SinglePointFSMutation(benchmark_problem.search_space))
 
-    solutions : list[EvaluatedFS] = []
-
-    while len(solutions) < sample_size:
-        solutions.extend(algorithm.get_one_with_attempts(max_trace= max_trace))
+    builder = PRefBuilder(benchmark_problem.search_space, initial_capacity=sample_size)
 
-    solutions = solutions[:sample_size]
+    while len(builder) < sample_size:
+        attempts = algorithm.get_one_with_attempts(max_trace= max_trace)
+        builder.append_evaluated_solutions(attempts[:sample_size - len(builder)])
 
     # best_solution = max(solutions)
     # df = benchmark_problem.details_of_solution(best_solution.full_solution)   # Experimental
-    return PRef.from_evaluated_full_solutions(solutions, benchmark_problem.search_space)
+    return builder.freeze()
 
 
 
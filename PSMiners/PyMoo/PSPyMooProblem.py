@@ -35,7 +35,7 @@ class PSPyMooProblem(Problem):
 
     def _evaluate(self, X, out, *args, **kwargs):
         """ I believe that since this class inherits from Problem, x should be a group of solutions, and not just one"""
-        metrics = np.array([self.objectives_evaluator.get_S_MF_A(self.individual_to_ps(row)) for row in X])
+        metrics = self.objectives_evaluator.get_S_MF_A_batch(X)
         out["F"] = -metrics  # minus sign because it's a maximisation task
 
         # sharing_values = get_sharing_scores(X, 0.5, 12)
@@ -10,6 +10,7 @@ import utils
 from Core.EvaluatedPS import EvaluatedPS
 from Core.PRef import PRef
 from Core.PSMetric.Additivity import Influence, sort_by_influence
+from Core.PSMetric.Classic3 import Classic3PSEvaluator
 from Core.TerminationCriteria import TerminationCriteria, PSEvaluationLimit, UnionOfCriteria, IterationLimit, \
     SearchSpaceIsCovered
 from PSMiners.AbstractPSMiner import AbstractPSMiner
@@ -124,8 +125,12 @@ class SequentialCrowdingMiner(AbstractPSMiner):
         # def get_simplicity(ps: EvaluatedPS) -> float:
         #     return ps.metric_scores[0]
 
+        # the influences are calculated together, and then looked up by the sorting
+        influences = self.influence_metric.get_scores_batch(np.array([ps.values for ps in pss]))
+        influence_of_ps = {id(ps): influence for ps, influence in zip(pss, influences)}
+
         def get_influence_delta(ps: EvaluatedPS) -> float:
-            return self.influence_metric.get_single_score(ps)
+            return influence_of_ps[id(ps)]
 
         return utils.sort_by_combination_of(pss, key_functions=[get_influence_delta], reverse=True)
 
@@ -215,6 +220,19 @@ class SequentialCrowdingMiner(AbstractPSMiner):
 
 
 
+    @classmethod
+    def rescored_on(cls, pRef: PRef, e_pss: list[EvaluatedPS]) -> list[EvaluatedPS]:
+        """For when the miner ran on a sketch of pRef (see PRef.sketch): the metrics of the results are recalculated
+        on pRef (inverted, as in the output of the miner), and they are sorted again.
+        All of them are re-scored, see MinedPSManager.mine_pss about why they are not screened"""
+        if len(e_pss) == 0:
+            return e_pss
+        metrics = Classic3PSEvaluator(pRef).get_S_MF_A_batch(np.array([e_ps.values for e_ps in e_pss]))
+        rescored = [EvaluatedPS(e_ps.values, metric_scores=-scores) for e_ps, scores in zip(e_pss, metrics)]
+        return cls.sort_by_atomicity(rescored)
+
+
+
 def test_sequential_miner(pRef: PRef, total_budget: int):
     miner = SequentialCrowdingMiner.with_default_settings(pRef)
     termination_criteria = UnionOfCriteria(PSEvaluationLimit(total_budget),
@@ -0,0 +1,26 @@
+import numpy as np
+
+from Core.PRef import PRef, NUMBA_MATCHING_THRESHOLD
+from Core.PS import PS
+from Core.PSMetric.BivariateANOVALinkage import BivariateANOVALinkage
+from Core.SearchSpace import SearchSpace
+
+
+def make_pRef(amount_of_rows: int, amount_of_variables: int = 8, cardinality: int = 3) -> PRef:
+    rng = np.random.default_rng(0)
+    solutions = rng.integers(0, cardinality, size=(amount_of_rows, amount_of_variables))
+    fitnesses = solutions[:, 0] + (solutions[:, 1] == solutions[:, 2]) * 2.0 + rng.random(amount_of_rows)
+    return PRef(fitnesses, solutions, SearchSpace([cardinality] * amount_of_variables))
+
+
+def test_parallel_tables_after_numba_kernel():
+    """the pool used to be forked, which deadlocks once numba's threading layer has started"""
+    pRef = make_pRef(NUMBA_MATCHING_THRESHOLD * 2)
+    pRef.fitnesses_of_observations(PS([0, 1] + [-1] * 6))  # runs the parallel matching kernel
+
+    serial = BivariateANOVALinkage()
+    serial.set_pRef(pRef)
+    parallel = BivariateANOVALinkage(processes=2)
+    parallel.set_pRef(pRef)
+
+    assert np.allclose(serial.linkage_table, parallel.linkage_table)